@@ -1,8 +1,9 @@
 from django.contrib import admin
-from .models import Camera, ParkingSpace, Runtime, Record, ObjectTypes
+from .models import Camera, ParkingSpace, Runtime, Record, ObjectTypes, OccupancyHour
 
 admin.site.register(Camera)
 admin.site.register(ParkingSpace)
 admin.site.register(Runtime)
 admin.site.register(Record)
-admin.site.register(ObjectTypes)
\ No newline at end of file
+admin.site.register(ObjectTypes)
+admin.site.register(OccupancyHour)
\ No newline at end of file
@@ -0,0 +1,75 @@
+import logging
+from collections import defaultdict
+from typing import Iterable
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.db import transaction
+
+from .models import Camera, ParkingSpace, Record
+
+
+def camera_group(camera_id) -> str:
+    return f"cam_{camera_id}"
+
+
+def send_to_camera(camera_id, message: dict) -> None:
+    """Sends a message to every websocket of a camera once the current transaction commits."""
+    def send():
+        try:
+            async_to_sync(get_channel_layer().group_send)(camera_group(camera_id), message)
+        except Exception as err:
+            logging.error(f"Could not broadcast {message['type']} to camera {camera_id}: {err}")
+    transaction.on_commit(send)
+
+
+def publish_occupancy(parking_space_ids: Iterable) -> None:
+    """Broadcasts the current occupancy of the given parking spaces to their cameras."""
+    parking_space_ids = set(parking_space_ids)
+    if not parking_space_ids:
+        return
+    spaces = dict(ParkingSpace.objects.filter(pk__in=parking_space_ids).values_list("pk", "camera_id"))
+    open_records = Record.objects.filter(
+        parking_space__in=spaces, out_time__isnull=True
+    ).order_by("in_time").values_list("parking_space_id", "obj_type")
+    obj_types = dict(open_records)
+
+    changes = defaultdict(list)
+    for parking_space_id, camera_id in spaces.items():
+        changes[camera_id].append({
+            "parking_space": str(parking_space_id),
+            "occupied": parking_space_id in obj_types,
+            "obj_type": obj_types.get(parking_space_id),
+        })
+    for camera_id, camera_changes in changes.items():
+        send_to_camera(camera_id, {"type": "occupancy.update", "camera": camera_id, "changes": camera_changes})
+
+
+def selection_coordinates(space: ParkingSpace) -> list:
+    """The outline clients get, the same simplified polygon as ``/api/cams/<id>/geometry/``."""
+    if space.geometry:
+        return space.geometry["polygon"]
+    return [[point.get("x"), point.get("y")] for point in space.selection or []]
+
+
+def publish_selection(camera_id, upserts: Iterable[ParkingSpace] = (), deletes: Iterable = ()) -> int:
+    """Bumps the selection version of a camera and broadcasts the diff that produced it.
+
+    Must run inside the transaction that changed the parking spaces, so the version
+    and the spaces are committed together.
+    """
+    camera = Camera.objects.select_for_update().get(pk=camera_id)
+    camera.selection_version += 1
+    camera.save(update_fields=["selection_version"])
+    parking_spaces = [
+        {"id": str(space.id), "op": "upsert", "coordinates": selection_coordinates(space)}
+        for space in upserts
+    ]
+    parking_spaces += [{"id": str(space_id), "op": "delete"} for space_id in deletes]
+    send_to_camera(camera_id, {
+        "type": "selection.update",
+        "camera": camera_id,
+        "version": camera.selection_version,
+        "parking_spaces": parking_spaces,
+    })
+    return camera.selection_version
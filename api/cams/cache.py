@@ -0,0 +1,103 @@
+import hashlib
+import logging
+import time
+from functools import wraps
+from typing import Callable, Dict, Union
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from rest_framework.response import Response
+
+# what a cached response was computed from, a write bumps the generation of its scopes
+RECORDS = "records"  # any record change, heartbeats included
+OCCUPANCY = "occupancy"  # records entering or leaving and the hourly rollup
+PARKING_SPACES = "parking_spaces"
+
+_views = set()
+
+
+def response_cache():
+    return caches[settings.RESPONSE_CACHE]
+
+
+def _generation_key(scope: str) -> str:
+    return f"generation:{scope}"
+
+
+def _stats_key(view: str, outcome: str) -> str:
+    return f"stats:{view}:{outcome}"
+
+
+def invalidate(*scopes: str) -> None:
+    """Drops the cached responses computed from ``scopes`` once the current transaction commits.
+
+    Nothing is deleted, the scopes get a new generation and the stale entries
+    are never looked up again until they expire.
+    """
+    def bump():
+        try:
+            response_cache().set_many({_generation_key(scope): time.time_ns() for scope in scopes}, timeout=None)
+        except Exception as err:
+            logging.error(f"Could not invalidate the cached {', '.join(scopes)} responses: {err}")
+    transaction.on_commit(bump)
+
+
+def _count(cache, view: str, outcome: str) -> None:
+    key = _stats_key(view, outcome)
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.add(key, 1, timeout=None)
+
+
+def cached_response(*scopes: str, timeout: Union[int, Callable[[], int]] = None):
+    """Caches the successful responses of a view ``get`` for ``timeout`` seconds
+    (``RESPONSE_CACHE_TTL`` by default) or until one of ``scopes`` is invalidated.
+    ``timeout`` may be a function, for responses that go stale with time alone.
+
+    Responses are keyed by the full URL, query string included, and every tab
+    polling the same URL shares one entry, so the database sees one query per
+    invalidation or TTL instead of one per client. The data is cached before
+    rendering, content negotiation still happens per request.
+    """
+    def decorator(get):
+        view = get.__qualname__.split(".")[0]
+        _views.add(view)
+
+        @wraps(get)
+        def wrapper(self, request, *args, **kwargs):
+            cache = response_cache()
+            try:
+                generations = cache.get_many([_generation_key(scope) for scope in scopes])
+                url = hashlib.blake2b(request.build_absolute_uri().encode(), digest_size=16).hexdigest()
+                key = f"response:{view}:{url}:" + ":".join(str(generations.get(_generation_key(scope), 0)) for scope in scopes)
+                data = cache.get(key)
+                _count(cache, view, "misses" if data is None else "hits")
+            except Exception as err:
+                logging.error(f"Response cache unavailable for {view}: {err}")
+                return get(self, request, *args, **kwargs)
+
+            if data is not None:
+                return Response(data, headers={"X-Cache": "hit"})
+            response = get(self, request, *args, **kwargs)
+            if response.status_code == 200:
+                ttl = settings.RESPONSE_CACHE_TTL if timeout is None else timeout() if callable(timeout) else timeout
+                try:
+                    cache.set(key, response.data, timeout=ttl)
+                except Exception as err:
+                    # the response is still good, only the next request misses too
+                    logging.error(f"Could not cache the {view} response: {err}")
+            response["X-Cache"] = "miss"
+            return response
+        return wrapper
+    return decorator
+
+
+def stats() -> Dict[str, Dict[str, int]]:
+    """Hits and misses of every cached view, across all the API processes sharing the cache."""
+    counts = response_cache().get_many([_stats_key(view, outcome) for view in _views for outcome in ("hits", "misses")])
+    return {
+        view: {outcome: counts.get(_stats_key(view, outcome), 0) for outcome in ("hits", "misses")}
+        for view in sorted(_views)
+    }
@@ -1,17 +1,64 @@
+import hmac
 import json
+import logging
 
+from asgiref.sync import async_to_sync
 from channels.generic.websocket import WebsocketConsumer
+from django.conf import settings
+
+from .broadcast import camera_group
+
+def is_runtime(scope) -> bool:
+    """Whether a connection presented ``RUNTIME_TOKEN`` in its ``Authorization`` header."""
+    if not settings.RUNTIME_TOKEN:
+        return False
+    headers = dict(scope.get("headers", []))
+    return hmac.compare_digest(headers.get(b"authorization", b""), f"Bearer {settings.RUNTIME_TOKEN}".encode())
 
 class SelectionConsumer(WebsocketConsumer):
+    """Per-camera websocket. Clients join the camera group and receive the
+    occupancy changes broadcast by the record views and the versioned
+    selection diffs broadcast by the parking space views.
+
+    An inference runtime in the metadata output mode sends the overlay of each
+    inferred frame here, it is relayed to the other clients of the camera. Only
+    connections authenticated as a runtime (see ``is_runtime``) may send them."""
     def connect(self):
-        self.room_name = self.scope["url_route"]["kwargs"]["room_name"]
-        self.room_group_name = f"cam_{self.room_name}"
+        self.cam_id = self.scope["url_route"]["kwargs"]["cam_id"]
+        self.room_group_name = camera_group(self.cam_id)
+        self.runtime = is_runtime(self.scope)
+        async_to_sync(self.channel_layer.group_add)(self.room_group_name, self.channel_name)
         self.accept()
 
     def disconnect(self, close_code):
-        pass
+        async_to_sync(self.channel_layer.group_discard)(self.room_group_name, self.channel_name)
 
     def receive(self, text_data):
-        text_data_json = json.loads(text_data)
-        message = text_data_json["message"]
-        self.send(text_data=json.dumps({"message": message}))
\ No newline at end of file
+        try:
+            message = json.loads(text_data)
+        except ValueError:
+            return
+        if not isinstance(message, dict) or message.get("type") != "overlay":
+            return
+        if not self.runtime:
+            logging.warning(f"Dropped an overlay from an unauthenticated client of camera {self.cam_id}")
+            return
+        async_to_sync(self.channel_layer.group_send)(
+            self.room_group_name, {"type": "overlay.update", "sender": self.channel_name, "overlay": message}
+        )
+
+    def occupancy_update(self, event):
+        self.send(text_data=json.dumps({"type": "occupancy_update", "camera": event["camera"], "changes": event["changes"]}))
+
+    def overlay_update(self, event):
+        if event["sender"] != self.channel_name:
+            self.send(text_data=json.dumps(event["overlay"]))
+
+
+    def selection_update(self, event):
+        self.send(text_data=json.dumps({
+            "type": "selection_update",
+            "camera": event["camera"],
+            "version": event["version"],
+            "parking_spaces": event["parking_spaces"],
+        }))
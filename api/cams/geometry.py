@@ -0,0 +1,86 @@
+import hashlib
+import json
+from typing import List, Optional, Tuple
+
+# pixels a simplified outline may deviate from the drawn one
+SIMPLIFY_TOLERANCE = 1.0
+
+Point = Tuple[float, float]
+
+
+def selection_points(selection) -> List[Point]:
+    """The ``(x, y)`` points of a selection, without incomplete points and repeated vertices."""
+    points = []
+    for point in selection or []:
+        if not isinstance(point, dict) or point.get("x") is None or point.get("y") is None:
+            continue
+        xy = (point["x"], point["y"])
+        if not points or points[-1] != xy:
+            points.append(xy)
+    if len(points) > 1 and points[0] == points[-1]:
+        points.pop()
+    return points
+
+
+def polygon_area(points: List[Point]) -> float:
+    """Shoelace area of a closed outline."""
+    twice = 0.0
+    for (x0, y0), (x1, y1) in zip(points, points[1:] + points[:1]):
+        twice += x0 * y1 - x1 * y0
+    return abs(twice) / 2
+
+
+def _distance(point: Point, start: Point, end: Point) -> float:
+    (x, y), (x0, y0), (x1, y1) = point, start, end
+    dx, dy = x1 - x0, y1 - y0
+    length = (dx * dx + dy * dy) ** 0.5
+    if length == 0:
+        return ((x - x0) ** 2 + (y - y0) ** 2) ** 0.5
+    return abs(dy * x - dx * y + x1 * y0 - y1 * x0) / length
+
+
+def _simplify_path(points: List[Point], tolerance: float) -> List[Point]:
+    # Douglas-Peucker with an explicit stack, keeps both ends
+    keep = [False] * len(points)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(points) - 1)]
+    while stack:
+        first, last = stack.pop()
+        farthest, distance = None, tolerance
+        for i in range(first + 1, last):
+            d = _distance(points[i], points[first], points[last])
+            if d > distance:
+                farthest, distance = i, d
+        if farthest is not None:
+            keep[farthest] = True
+            stack += [(first, farthest), (farthest, last)]
+    return [point for point, kept in zip(points, keep) if kept]
+
+
+def simplify(points: List[Point], tolerance: float = SIMPLIFY_TOLERANCE) -> List[Point]:
+    """Drops the vertices of a closed outline that are within ``tolerance`` of the simplified one."""
+    if len(points) <= 3:
+        return list(points)
+    # a closed ring is split at the vertex farthest from the first one
+    split = max(range(len(points)), key=lambda i: (points[i][0] - points[0][0]) ** 2 + (points[i][1] - points[0][1]) ** 2)
+    simplified = _simplify_path(points[:split + 1], tolerance)[:-1] + _simplify_path(points[split:] + points[:1], tolerance)[:-1]
+    return simplified if len(simplified) >= 3 else list(points)
+
+
+def bounding_box(points: List[Point]) -> Optional[List[float]]:
+    if not points:
+        return None
+    xs, ys = [x for x, _ in points], [y for _, y in points]
+    return [min(xs), min(ys), max(xs), max(ys)]
+
+
+def selection_geometry(selection) -> dict:
+    """Geometry derived from a selection, stored with the parking space when it is saved.
+
+    ``polygon`` is the simplified outline as ``[x, y]`` pairs, ``bbox`` is
+    ``[x_min, y_min, x_max, y_max]`` and ``hash`` changes whenever the outline does.
+    """
+    points = selection_points(selection)
+    polygon = [list(point) for point in simplify(points)]
+    digest = hashlib.blake2b(json.dumps(polygon).encode(), digest_size=8).hexdigest()
+    return {"bbox": bounding_box(points), "area": polygon_area(points), "polygon": polygon, "hash": digest}
@@ -0,0 +1,86 @@
+import time
+import uuid
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.utils import timezone
+
+from cams.models import Camera, ParkingSpace, Record
+
+BENCHMARK_CAMERA_ID = 999999
+
+
+class Command(BaseCommand):
+    help = (
+        "Seeds a synthetic records table and prints the query plans of the record endpoints. "
+        "To compare indexes run it once on 'migrate cams 0002' and once on the latest migration."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--seed", type=int, default=0, help="number of records to insert before explaining")
+        parser.add_argument("--spaces", type=int, default=200, help="parking spaces of the benchmark camera")
+        parser.add_argument("--days", type=int, default=60, help="time span of the seeded records")
+        parser.add_argument("--cleanup", action="store_true", help="delete the benchmark camera and its records")
+
+    def handle(self, *args, **options):
+        if options["cleanup"]:
+            Camera.objects.filter(pk=BENCHMARK_CAMERA_ID).delete()
+            self.stdout.write("Deleted benchmark data")
+            return
+        if options["seed"]:
+            self.seed(options["seed"], options["spaces"], options["days"])
+
+        space = ParkingSpace.objects.filter(camera=BENCHMARK_CAMERA_ID).first()
+        if space is None:
+            self.stderr.write("No benchmark data, run with --seed first")
+            return
+        now = timezone.now()
+        spaces = ParkingSpace.objects.filter(camera=BENCHMARK_CAMERA_ID)
+        queries = {
+            "records list, first 100": Record.objects.reportable().order_by("-in_time")[:100],
+            "open records by parking space": Record.objects.filter(out_time__isnull=True, parking_space__in=spaces),
+            "one space, last 24h": Record.objects.filter(parking_space=space, in_time__gte=now - timedelta(hours=24)),
+            "reportable, one space": Record.objects.reportable().filter(parking_space=space),
+            "stays longer than 2h": Record.objects.with_duration().filter(duration__gt=timedelta(hours=2)),
+        }
+        for name, queryset in queries.items():
+            self.stdout.write(self.style.MIGRATE_HEADING(name))
+            # first run warms the cache so both sides of a comparison start equal
+            queryset.explain(analyze=True)
+            self.stdout.write(queryset.explain(analyze=True, buffers=True))
+            self.stdout.write("")
+
+    def seed(self, count, n_spaces, days):
+        camera, _ = Camera.objects.get_or_create(
+            pk=BENCHMARK_CAMERA_ID, defaults={"location": "benchmark", "url": "benchmark"}
+        )
+        spaces = list(ParkingSpace.objects.filter(camera=camera).values_list("pk", flat=True))
+        if len(spaces) < n_spaces:
+            new_spaces = [
+                ParkingSpace(id=uuid.uuid4(), label=f"B{i}", camera=camera, selection=[])
+                for i in range(len(spaces), n_spaces)
+            ]
+            ParkingSpace.objects.bulk_create(new_spaces)
+            spaces += [space.pk for space in new_spaces]
+
+        start = time.monotonic()
+        # a third of the records are sub-minute tracker flicker and one in a thousand is still open
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"""
+                INSERT INTO {Record._meta.db_table} (in_time, out_time, last_seen, obj_id, obj_type, parking_space_id)
+                SELECT t, CASE WHEN o THEN NULL ELSE t + d END, t + d, g::text, '2.0', (%s::uuid[])[1 + g %% %s]
+                FROM (
+                    SELECT g,
+                        now() - random() * %s * interval '1 day' AS t,
+                        CASE WHEN random() < 0.3 THEN random() * interval '50 seconds'
+                             ELSE random() * interval '3 hours' END AS d,
+                        random() < 0.001 AS o
+                    FROM generate_series(1, %s) g
+                ) s
+                """,
+                [spaces, len(spaces), days, count],
+            )
+            cursor.execute(f"ANALYZE {Record._meta.db_table}")
+        self.stdout.write(f"Seeded {count} records in {time.monotonic() - start:.1f} s")
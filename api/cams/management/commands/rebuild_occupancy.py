@@ -0,0 +1,19 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from cams import occupancy
+
+
+class Command(BaseCommand):
+    help = "Recomputes the hourly occupancy rollup from the records table (backfill and periodic compaction)."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--days", type=int, default=30, help="how many days back to rebuild")
+
+    def handle(self, *args, **options):
+        until = timezone.now()
+        since = until - timedelta(days=options["days"])
+        occupancy.rebuild(since, until)
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt occupancy rollup from {since.isoformat()} to {until.isoformat()}"))
@@ -0,0 +1,30 @@
+# Generated by Django 4.2.6 on 2026-10-18 18:10
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cams', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OccupancyHour',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('hour', models.DateTimeField()),
+                ('records', models.PositiveIntegerField(default=0)),
+                ('parking_space', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='cams.parkingspace')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['hour'], name='occupancy_hour_hour_idx')],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='occupancyhour',
+            constraint=models.UniqueConstraint(fields=('parking_space', 'hour'), name='occupancy_hour_space_hour_unique'),
+        ),
+    ]
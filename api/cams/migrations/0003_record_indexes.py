@@ -0,0 +1,30 @@
+# Generated by Django 4.2.6 on 2026-10-18 18:11
+
+from django.db import migrations, models
+import django.db.models.expressions
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cams', '0002_occupancyhour'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='record',
+            index=models.Index(fields=['parking_space', 'in_time'], name='record_space_in_time_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='record',
+            index=models.Index(fields=['in_time', 'id'], name='record_in_time_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='record',
+            index=models.Index(condition=models.Q(('out_time__isnull', True)), fields=['parking_space'], name='record_open_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='record',
+            index=models.Index(django.db.models.expressions.CombinedExpression(models.F('out_time'), '-', models.F('in_time')), name='record_duration_idx'),
+        ),
+    ]
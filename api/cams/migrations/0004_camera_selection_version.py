@@ -0,0 +1,18 @@
+# Generated by Django 4.2.6 on 2026-10-18 18:15
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cams', '0003_record_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='camera',
+            name='selection_version',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+    ]
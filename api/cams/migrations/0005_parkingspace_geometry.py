@@ -0,0 +1,29 @@
+# Generated by Django 4.2.6 on 2026-10-18 19:08
+
+from django.db import migrations, models
+
+from cams.geometry import selection_geometry
+
+
+def compute_geometry(apps, schema_editor):
+    ParkingSpace = apps.get_model("cams", "ParkingSpace")
+    spaces = list(ParkingSpace.objects.only("id", "selection"))
+    for space in spaces:
+        space.geometry = selection_geometry(space.selection)
+    ParkingSpace.objects.bulk_update(spaces, ["geometry"], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cams', '0004_camera_selection_version'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='parkingspace',
+            name='geometry',
+            field=models.JSONField(default=dict),
+        ),
+        migrations.RunPython(compute_geometry, migrations.RunPython.noop),
+    ]
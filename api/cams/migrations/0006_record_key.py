@@ -0,0 +1,18 @@
+# Generated by Django 4.2.6 on 2026-10-18 21:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cams', '0005_parkingspace_geometry'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='record',
+            name='key',
+            field=models.CharField(max_length=32, null=True, unique=True),
+        ),
+    ]
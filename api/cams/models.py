@@ -1,6 +1,11 @@
 from django.db import models
 from django.utils import timezone
-from datetime import datetime
+from datetime import datetime, timedelta
+
+from .geometry import selection_geometry
+
+# records shorter than this are tracker noise and are hidden from reports
+MIN_RECORD_DURATION = timedelta(minutes=1)
 
 class ObjectTypes(models.Model):
     name = models.CharField(max_length=20, unique=True)
@@ -9,18 +14,40 @@ class Camera(models.Model):
     id = models.PositiveBigIntegerField(primary_key=True)
     location = models.CharField(max_length=100)
     url = models.CharField(max_length=1000)
+    # bumped on every parking space change, clients use it to detect missed updates
+    selection_version = models.PositiveBigIntegerField(default=0)
 
 class ParkingSpace(models.Model):
     id = models.UUIDField(primary_key=True)
     label = models.CharField(max_length=30)
     camera = models.ForeignKey(to=Camera, on_delete=models.CASCADE)
     selection = models.JSONField("selection", default=dict)
+    # derived from the selection when it is saved, see cams.geometry
+    geometry = models.JSONField(default=dict)
+
+    def save(self, *args, **kwargs):
+        # here rather than in the views, so the admin and the shell keep it in step too
+        self.geometry = selection_geometry(self.selection)
+        update_fields = kwargs.get("update_fields")
+        if update_fields is not None and "selection" in update_fields:
+            kwargs["update_fields"] = {*update_fields, "geometry"}
+        super().save(*args, **kwargs)
 
 class Runtime(models.Model):
     id = models.UUIDField(primary_key=True)
     camera = models.ForeignKey(to=Camera, on_delete=models.CASCADE)
     creation_time = models.DateTimeField(default=timezone.now)
 
+class RecordQuerySet(models.QuerySet):
+    def with_duration(self):
+        return self.alias(duration=models.F("out_time") - models.F("in_time"))
+
+    def reportable(self):
+        """Open records and records that lasted longer than MIN_RECORD_DURATION."""
+        return self.with_duration().filter(
+            models.Q(out_time__isnull=True) | models.Q(duration__gt=MIN_RECORD_DURATION)
+        )
+
 class Record(models.Model):
     in_time = models.DateTimeField(null=True)
     out_time = models.DateTimeField(null=True)
@@ -29,9 +56,41 @@ class Record(models.Model):
     obj_type = models.CharField()
     parking_space = models.ForeignKey(to=ParkingSpace, on_delete=models.CASCADE)
     runtime = models.ForeignKey(to=Runtime, on_delete=models.CASCADE, null=True)
+    # client side key of the enter event, a replayed enter maps to the record it created
+    key = models.CharField(max_length=32, null=True, unique=True)
+
+    objects = RecordQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["parking_space", "in_time"], name="record_space_in_time_idx"),
+            models.Index(fields=["in_time", "id"], name="record_in_time_id_idx"),
+            models.Index(fields=["parking_space"], condition=models.Q(out_time__isnull=True), name="record_open_idx"),
+            # matches Record.objects.with_duration(), keeps the duration filter sargable
+            models.Index(models.F("out_time") - models.F("in_time"), name="record_duration_idx"),
+        ]
     
     def get_parking_space_id(self):
         return self.parking_space.id
     
     def is_active(self):
-        return self.out_time is None
\ No newline at end of file
+        return self.out_time is None
+
+class OccupancyHour(models.Model):
+    """Number of finished records that overlapped each hour, per parking space.
+
+    Maintained incrementally when records are closed (see ``cams.occupancy``) and
+    rebuilt on demand by the ``rebuild_occupancy`` command. Open records are not
+    stored here, they are added when the table is read.
+    """
+    parking_space = models.ForeignKey(to=ParkingSpace, on_delete=models.CASCADE)
+    hour = models.DateTimeField()
+    records = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["parking_space", "hour"], name="occupancy_hour_space_hour_unique"),
+        ]
+        indexes = [
+            models.Index(fields=["hour"], name="occupancy_hour_hour_idx"),
+        ]
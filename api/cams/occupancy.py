@@ -0,0 +1,97 @@
+from collections import Counter
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, List, Tuple
+
+from django.db import connection, transaction
+from django.db.models import F, Sum
+from django.db.models.functions import Greatest
+from django.utils import timezone
+
+from . import cache
+from .models import MIN_RECORD_DURATION, OccupancyHour, Record
+
+
+def floor_hour(time: datetime) -> datetime:
+    return time.replace(minute=0, second=0, microsecond=0)
+
+
+def record_hours(in_time: datetime, out_time: datetime, since: datetime = None, until: datetime = None) -> List[datetime]:
+    """Every hour touched by a record, optionally clipped to ``[since, until]``."""
+    start, end = floor_hour(in_time), floor_hour(out_time)
+    if since is not None:
+        start = max(start, floor_hour(since))
+    if until is not None:
+        end = min(end, floor_hour(until))
+    hours = []
+    while start <= end:
+        hours.append(start)
+        start += timedelta(hours=1)
+    return hours
+
+
+def _hour_counts(records: Iterable[Tuple[str, datetime, datetime]], since: datetime = None, until: datetime = None) -> Counter:
+    counts = Counter()
+    for parking_space_id, in_time, out_time in records:
+        if in_time is None or out_time is None or out_time - in_time <= MIN_RECORD_DURATION:
+            continue
+        for hour in record_hours(in_time, out_time, since, until):
+            counts[(str(parking_space_id), hour)] += 1
+    return counts
+
+
+def add_closed_records(records: Iterable[Tuple[str, datetime, datetime]], since: datetime = None, until: datetime = None) -> None:
+    """Adds ``(parking_space_id, in_time, out_time)`` records to the rollup with a single upsert."""
+    counts = _hour_counts(records, since, until)
+    if not counts:
+        return
+
+    table = OccupancyHour._meta.db_table
+    # adapted like the ORM would, so ids and datetimes are stored the way each backend expects them
+    space_field, hour_field = OccupancyHour._meta.get_field("parking_space"), OccupancyHour._meta.get_field("hour")
+    values = ", ".join(["(%s, %s, %s)"] * len(counts))
+    params = [
+        value
+        for (parking_space_id, hour), n in counts.items()
+        for value in (space_field.get_db_prep_value(parking_space_id, connection), hour_field.get_db_prep_value(hour, connection), n)
+    ]
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"INSERT INTO {table} (parking_space_id, hour, records) VALUES {values} "
+            f"ON CONFLICT (parking_space_id, hour) DO UPDATE SET records = {table}.records + EXCLUDED.records",
+            params,
+        )
+
+
+def remove_closed_records(records: Iterable[Tuple[str, datetime, datetime]]) -> None:
+    """Takes records added by ``add_closed_records`` back out of the rollup, e.g. before their times change."""
+    for (parking_space_id, hour), n in _hour_counts(records).items():
+        OccupancyHour.objects.filter(parking_space_id=parking_space_id, hour=hour).update(records=Greatest(F("records") - n, 0))
+
+
+def rebuild(since: datetime, until: datetime) -> None:
+    """Recomputes the rollup rows of ``[since, until]`` from the records table."""
+    since, until = floor_hour(since), floor_hour(until)
+    records = Record.objects.filter(
+        out_time__isnull=False, in_time__lt=until + timedelta(hours=1), out_time__gte=since
+    ).values_list("parking_space_id", "in_time", "out_time")
+    with transaction.atomic():
+        OccupancyHour.objects.filter(hour__gte=since, hour__lte=until).delete()
+        add_closed_records(records.iterator(chunk_size=10000), since, until)
+        cache.invalidate(cache.OCCUPANCY)
+
+
+def count_by_hour(since: datetime, until: datetime) -> Dict[datetime, int]:
+    """Number of records present in every hour of ``[since, until]``, open records included."""
+    counts = {hour: 0 for hour in record_hours(since, until)}
+    rows = OccupancyHour.objects.filter(
+        hour__gte=floor_hour(since), hour__lte=floor_hour(until)
+    ).values("hour").annotate(total=Sum("records"))
+    for row in rows:
+        counts[row["hour"]] += row["total"]
+
+    open_records = Record.objects.filter(out_time__isnull=True, in_time__isnull=False).values_list("in_time", flat=True)
+    now = timezone.now()
+    for in_time in open_records:
+        for hour in record_hours(in_time, now, since, until):
+            counts[hour] += 1
+    return counts
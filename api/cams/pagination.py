@@ -0,0 +1,58 @@
+import base64
+from datetime import datetime
+
+from django.db.models import Q
+from rest_framework.exceptions import ValidationError
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+
+class RecordCursorPagination(BasePagination):
+    """Keyset pagination over ``(in_time, id)``, newest first.
+
+    Each page is one index range scan on ``record_in_time_id_idx`` no matter how
+    deep the client has paged. The cursor is the position of the last record of
+    the previous page. Pagination only applies when ``?limit=`` or ``?cursor=`` is
+    given, so clients that expect the plain list keep working.
+    """
+    default_limit = 100
+    max_limit = 1000
+
+    def paginate_queryset(self, queryset, request, view=None):
+        params = request.query_params
+        if "limit" not in params and "cursor" not in params:
+            return None
+        try:
+            limit = min(max(int(params.get("limit", self.default_limit)), 1), self.max_limit)
+        except ValueError:
+            raise ValidationError({"limit": "must be an integer"})
+
+        queryset = queryset.filter(in_time__isnull=False).order_by("-in_time", "-id")
+        if params.get("cursor"):
+            in_time, record_id = self.decode_cursor(params["cursor"])
+            queryset = queryset.filter(Q(in_time__lt=in_time) | Q(in_time=in_time, id__lt=record_id))
+
+        page = list(queryset[:limit + 1])
+        self.request = request
+        self.next_cursor = self.encode_cursor(page[limit - 1]) if len(page) > limit else None
+        return page[:limit]
+
+    def get_paginated_response(self, data):
+        next_url = None
+        if self.next_cursor is not None:
+            next_url = replace_query_param(self.request.build_absolute_uri(), "cursor", self.next_cursor)
+        return Response({"next": next_url, "results": data})
+
+    @staticmethod
+    def encode_cursor(record):
+        position = f"{record.in_time.isoformat()}|{record.id}"
+        return base64.urlsafe_b64encode(position.encode()).decode()
+
+    @staticmethod
+    def decode_cursor(cursor):
+        try:
+            in_time, record_id = base64.urlsafe_b64decode(cursor.encode()).decode().split("|")
+            return datetime.fromisoformat(in_time), int(record_id)
+        except ValueError:
+            raise ValidationError({"cursor": "invalid cursor"})
@@ -10,7 +10,7 @@ class CameraSerializer(serializers.ModelSerializer):
 class ParkingSpaceSerializer(serializers.ModelSerializer):
     class Meta:
         model = ParkingSpace
-        fields = "__all__"
+        exclude = ["geometry"]
 
 class RecordSerializer(serializers.ModelSerializer):
     parking_space_label = serializers.CharField(read_only=True)
@@ -18,6 +18,12 @@ class RecordSerializer(serializers.ModelSerializer):
         model = Record
         fields = "__all__"
 
+    def __init__(self, *args, fields=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        if fields is not None:
+            for name in set(self.fields) - set(fields):
+                self.fields.pop(name)
+
 class RecordByParkingSpaceSerializer(serializers.ModelSerializer):
     record_set = RecordSerializer(many=True, read_only=True)
     class Meta:
@@ -1,3 +1,442 @@
-from django.test import TestCase
+import uuid
+from unittest import mock
+from datetime import datetime, timedelta, timezone as dt_timezone
 
-# Create your tests here.
+from channels.db import database_sync_to_async
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+
+from . import cache, occupancy
+from .broadcast import publish_occupancy, publish_selection
+from .models import Camera, OccupancyHour, ParkingSpace, Record
+from .urls import websocket_urlpatterns
+from .views import until_next_hour
+
+IN_MEMORY_LAYER = {"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}}
+# the response cache is tested on its own, everywhere else a write must show in the next read
+NO_CACHE = {"default": {"BACKEND": "django.core.cache.backends.dummy.DummyCache"}}
+
+SQUARE = [{"x": 0, "y": 0}, {"x": 10, "y": 0}, {"x": 10, "y": 10}, {"x": 0, "y": 10}]
+# the square drawn with a redundant vertex halfway along its first edge
+DRAWN_SQUARE = [{"x": 0, "y": 0}, {"x": 5, "y": 0}, *SQUARE[1:]]
+
+
+def make_space(camera, label="A1", selection=SQUARE) -> ParkingSpace:
+    return ParkingSpace.objects.create(id=uuid.uuid4(), camera=camera, label=label, selection=selection)
+
+
+class CameraSocketTestCase(TestCase):
+    def setUp(self):
+        self.camera = Camera.objects.create(id=1, location="gate", url="rtsp://gate")
+        self.application = URLRouter(websocket_urlpatterns)
+
+    async def connect(self, camera_id=1, headers=()):
+        communicator = WebsocketCommunicator(self.application, f"/ws/{camera_id}/", headers=list(headers))
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator
+
+    def commit(self, publish, *args, **kwargs):
+        # broadcasts are sent on commit, which a TestCase never reaches on its own
+        with self.captureOnCommitCallbacks(execute=True):
+            return publish(*args, **kwargs)
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_LAYER, CACHES=NO_CACHE)
+class SelectionConsumerTests(CameraSocketTestCase):
+    async def test_subscribers_get_the_occupancy_of_their_camera_only(self):
+        space = await database_sync_to_async(make_space)(self.camera)
+        await database_sync_to_async(Camera.objects.create)(id=2, location="exit", url="rtsp://exit")
+        subscriber, other = await self.connect(1), await self.connect(2)
+        await database_sync_to_async(Record.objects.create)(obj_id="7", obj_type="car", parking_space=space)
+        await database_sync_to_async(self.commit)(publish_occupancy, [space.pk])
+
+        message = await subscriber.receive_json_from()
+        self.assertEqual(message, {
+            "type": "occupancy_update",
+            "camera": 1,
+            "changes": [{"parking_space": str(space.pk), "occupied": True, "obj_type": "car"}],
+        })
+        self.assertTrue(await other.receive_nothing())
+        await subscriber.disconnect()
+        await other.disconnect()
+
+    async def test_unsubscribed_clients_get_nothing(self):
+        space = await database_sync_to_async(make_space)(self.camera)
+        communicator = await self.connect()
+        await communicator.disconnect()
+        await database_sync_to_async(self.commit)(publish_occupancy, [space.pk])
+        self.assertTrue(await communicator.receive_nothing())
+
+    async def test_selection_diffs_carry_increasing_versions(self):
+        communicator = await self.connect()
+        space = await database_sync_to_async(make_space)(self.camera)
+        first = await database_sync_to_async(self.commit)(publish_selection, 1, upserts=[space])
+        second = await database_sync_to_async(self.commit)(publish_selection, 1, deletes=[space.pk])
+
+        self.assertEqual((first, second), (1, 2))
+        self.assertEqual(await communicator.receive_json_from(), {
+            "type": "selection_update",
+            "camera": 1,
+            "version": 1,
+            "parking_spaces": [{"id": str(space.pk), "op": "upsert", "coordinates": [[0, 0], [10, 0], [10, 10], [0, 10]]}],
+        })
+        self.assertEqual(await communicator.receive_json_from(), {
+            "type": "selection_update",
+            "camera": 1,
+            "version": 2,
+            "parking_spaces": [{"id": str(space.pk), "op": "delete"}],
+        })
+        await communicator.disconnect()
+
+    async def test_selection_diffs_carry_the_simplified_outline(self):
+        communicator = await self.connect()
+        space = await database_sync_to_async(make_space)(self.camera, selection=DRAWN_SQUARE)
+        await database_sync_to_async(self.commit)(publish_selection, 1, upserts=[space])
+
+        message = await communicator.receive_json_from()
+        self.assertEqual(message["parking_spaces"], [
+            {"id": str(space.pk), "op": "upsert", "coordinates": [[0, 0], [10, 0], [10, 10], [0, 10]]},
+        ])
+        await communicator.disconnect()
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_LAYER, CACHES=NO_CACHE, RUNTIME_TOKEN="secret")
+class OverlayRelayTests(CameraSocketTestCase):
+    async def test_overlays_are_relayed_from_runtimes_only(self):
+        viewer = await self.connect()
+        runtime = await self.connect(headers=[(b"authorization", b"Bearer secret")])
+        intruder = await self.connect(headers=[(b"authorization", b"Bearer guess")])
+
+        with self.assertLogs(level="WARNING"):
+            await intruder.send_json_to({"type": "overlay", "boxes": []})
+            self.assertTrue(await viewer.receive_nothing())
+        await runtime.send_json_to({"type": "overlay", "boxes": [[1, 2, 3, 4]]})
+        self.assertEqual(await viewer.receive_json_from(), {"type": "overlay", "boxes": [[1, 2, 3, 4]]})
+        # the sender does not get its own overlay back
+        self.assertTrue(await runtime.receive_nothing())
+        for communicator in (viewer, runtime, intruder):
+            await communicator.disconnect()
+
+    @override_settings(RUNTIME_TOKEN=None)
+    async def test_without_a_runtime_token_nobody_relays_overlays(self):
+        viewer = await self.connect()
+        runtime = await self.connect(headers=[(b"authorization", b"Bearer None")])
+
+        with self.assertLogs(level="WARNING"):
+            await runtime.send_json_to({"type": "overlay", "boxes": []})
+            self.assertTrue(await viewer.receive_nothing())
+        for communicator in (viewer, runtime):
+            await communicator.disconnect()
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_LAYER, CACHES=NO_CACHE)
+class CameraViewTests(TestCase):
+    def setUp(self):
+        self.camera = Camera.objects.create(id=1, location="gate", url="rtsp://gate")
+
+    def test_parking_space_writes_bump_the_selection_version(self):
+        space_id = uuid.uuid4()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(f"/api/parking_space/{space_id}/", {"label": "A1", "camera": 1, "selection": SQUARE}, content_type="application/json")
+            self.client.patch(f"/api/parking_space/{space_id}/", {"label": "A2"}, content_type="application/json")
+        self.camera.refresh_from_db()
+        self.assertEqual(self.camera.selection_version, 2)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.delete(f"/api/parking_space/{space_id}/")
+        self.camera.refresh_from_db()
+        self.assertEqual(self.camera.selection_version, 3)
+
+    def test_an_up_to_date_client_gets_a_304(self):
+        make_space(self.camera)
+        Camera.objects.filter(pk=1).update(selection_version=4)
+
+        response = self.client.get("/api/cams/1/")
+        self.assertEqual(response["ETag"], '"4"')
+        self.assertEqual(len(response.json()["parking_spaces"]), 1)
+        response = self.client.get("/api/cams/1/", HTTP_IF_NONE_MATCH='"4"')
+        self.assertEqual(response.status_code, 304)
+        response = self.client.get("/api/cams/1/", HTTP_IF_NONE_MATCH='"3"')
+        self.assertEqual(response.status_code, 200)
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_LAYER, CACHES=NO_CACHE)
+class CameraGeometryViewTests(TestCase):
+    def setUp(self):
+        self.camera = Camera.objects.create(id=1, location="gate", url="rtsp://gate", selection_version=2)
+
+    def test_spaces_come_with_their_precomputed_geometry(self):
+        space = make_space(self.camera, selection=DRAWN_SQUARE)
+
+        response = self.client.get("/api/cams/1/geometry/")
+        self.assertEqual(response["ETag"], '"2"')
+        geometry = response.json()["parking_spaces"][0]
+        self.assertEqual(geometry["id"], str(space.pk))
+        self.assertEqual(geometry["polygon"], [[0, 0], [10, 0], [10, 10], [0, 10]])
+        self.assertEqual(geometry["bbox"], [0, 0, 10, 10])
+        self.assertEqual(geometry["area"], 100)
+        self.assertEqual(geometry["hash"], space.geometry["hash"])
+
+    def test_the_geometry_follows_selection_updates(self):
+        space = make_space(self.camera)
+        space.selection = [{"x": 0, "y": 0}, {"x": 20, "y": 0}, {"x": 20, "y": 10}, {"x": 0, "y": 10}]
+        space.save(update_fields=["selection"])
+        space.refresh_from_db()
+        self.assertEqual(space.geometry["bbox"], [0, 0, 20, 10])
+        # rows written around save() are derived when they are read
+        ParkingSpace.objects.filter(pk=space.pk).update(selection=SQUARE, geometry={})
+        geometry = self.client.get("/api/cams/1/geometry/").json()["parking_spaces"][0]
+        self.assertEqual(geometry["bbox"], [0, 0, 10, 10])
+
+    def test_an_up_to_date_client_gets_a_304(self):
+        response = self.client.get("/api/cams/1/geometry/", HTTP_IF_NONE_MATCH='"2"')
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response["ETag"], '"2"')
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_LAYER, CACHES=NO_CACHE)
+class RecordBulkViewTests(TestCase):
+    def setUp(self):
+        self.camera = Camera.objects.create(id=1, location="gate", url="rtsp://gate")
+        self.space = make_space(self.camera)
+
+    def post(self, *events):
+        with self.captureOnCommitCallbacks(execute=True):
+            return self.client.post("/api/records/bulk/", {"events": list(events)}, content_type="application/json")
+
+    def enter(self, key="k1", time="2026-10-18T10:00:00Z", **event):
+        return {"type": "enter", "key": key, "time": time, "obj_id": 7, "obj_type": "car", "parking_space": str(self.space.pk), **event}
+
+    def test_a_replayed_enter_returns_the_existing_record(self):
+        first = self.post(self.enter()).json()
+        second = self.post(self.enter()).json()
+
+        self.assertEqual(second, first)
+        self.assertEqual(Record.objects.count(), 1)
+        self.assertEqual(Record.objects.get().pk, first["records"]["k1"])
+
+    def test_enter_and_exit_in_the_same_batch(self):
+        data = self.post(self.enter(), {"type": "exit", "key": "k1", "time": "2026-10-18T10:30:00Z"}).json()
+
+        record = Record.objects.get(pk=data["records"]["k1"])
+        self.assertEqual(record.out_time, datetime(2026, 10, 18, 10, 30, tzinfo=dt_timezone.utc))
+        self.assertEqual(record.last_seen, record.out_time)
+        self.assertEqual(OccupancyHour.objects.get().records, 1)
+
+    def test_heartbeats_and_exits_find_their_record_by_key_across_batches(self):
+        pk = self.post(self.enter()).json()["records"]["k1"]
+        self.post({"type": "heartbeat", "key": "k1", "time": "2026-10-18T10:10:00Z"})
+        record = Record.objects.get(pk=pk)
+        self.assertEqual(record.last_seen, datetime(2026, 10, 18, 10, 10, tzinfo=dt_timezone.utc))
+        self.assertIsNone(record.out_time)
+
+        data = self.post({"type": "exit", "key": "k1", "time": "2026-10-18T11:05:00Z"}).json()
+        record.refresh_from_db()
+        self.assertEqual(data["rejected"], [])
+        self.assertEqual(record.out_time, datetime(2026, 10, 18, 11, 5, tzinfo=dt_timezone.utc))
+        self.assertEqual(OccupancyHour.objects.filter(records=1).count(), 2)
+
+    def test_a_second_exit_is_rejected(self):
+        pk = self.post(self.enter(), {"type": "exit", "key": "k1", "time": "2026-10-18T10:30:00Z"}).json()["records"]["k1"]
+
+        data = self.post({"type": "exit", "record": pk, "time": "2026-10-18T12:00:00Z"}).json()
+        self.assertEqual(data["rejected"], [pk])
+        self.assertEqual(Record.objects.get(pk=pk).out_time, datetime(2026, 10, 18, 10, 30, tzinfo=dt_timezone.utc))
+        self.assertEqual(OccupancyHour.objects.get().records, 1)
+
+    def test_unknown_spaces_and_records_are_rejected(self):
+        data = self.post(
+            self.enter(key="k2", parking_space=str(uuid.uuid4())),
+            {"type": "heartbeat", "record": 404, "time": "2026-10-18T10:00:00Z"},
+        ).json()
+
+        self.assertEqual(data, {"records": {}, "rejected": ["k2", 404]})
+        self.assertFalse(Record.objects.exists())
+
+    def test_malformed_events_are_a_bad_request(self):
+        for event in (self.enter(time="yesterday"), self.enter(parking_space="A1"), {"type": "exit", "time": "2026-10-18T10:00:00Z"}):
+            with self.subTest(event=event):
+                self.assertEqual(self.post(event).status_code, 400)
+        self.assertFalse(Record.objects.exists())
+
+
+def utc(*args) -> datetime:
+    return datetime(*args, tzinfo=dt_timezone.utc)
+
+
+class RecordHoursTests(SimpleTestCase):
+    def test_records_across_midnight_count_in_both_days(self):
+        self.assertEqual(
+            occupancy.record_hours(utc(2026, 10, 18, 22, 30), utc(2026, 10, 19, 1, 10)),
+            [utc(2026, 10, 18, 22), utc(2026, 10, 18, 23), utc(2026, 10, 19, 0), utc(2026, 10, 19, 1)],
+        )
+
+    def test_records_across_the_end_of_a_month_count_in_both_months(self):
+        self.assertEqual(
+            occupancy.record_hours(utc(2026, 9, 30, 23, 50), utc(2026, 10, 1, 0, 20)),
+            [utc(2026, 9, 30, 23), utc(2026, 10, 1, 0)],
+        )
+
+    def test_hours_are_clipped_to_the_range(self):
+        hours = occupancy.record_hours(utc(2026, 10, 18, 8), utc(2026, 10, 18, 20), since=utc(2026, 10, 18, 10, 30), until=utc(2026, 10, 18, 11, 59))
+        self.assertEqual(hours, [utc(2026, 10, 18, 10), utc(2026, 10, 18, 11)])
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_LAYER, CACHES=NO_CACHE)
+class OccupancyRollupTests(TestCase):
+    def setUp(self):
+        self.camera = Camera.objects.create(id=1, location="gate", url="rtsp://gate")
+        self.space = make_space(self.camera)
+
+    def rollup(self):
+        return dict(OccupancyHour.objects.filter(records__gt=0).values_list("hour", "records"))
+
+    def test_closed_records_add_up_per_hour(self):
+        occupancy.add_closed_records([
+            (self.space.pk, utc(2026, 10, 18, 23, 30), utc(2026, 10, 19, 0, 30)),
+            (self.space.pk, utc(2026, 10, 19, 0, 10), utc(2026, 10, 19, 0, 50)),
+            # shorter than MIN_RECORD_DURATION, and still open
+            (self.space.pk, utc(2026, 10, 19, 0, 10), utc(2026, 10, 19, 0, 10, 30)),
+            (self.space.pk, utc(2026, 10, 19, 0, 10), None),
+        ])
+        occupancy.add_closed_records([(str(self.space.pk), utc(2026, 10, 19, 0, 5), utc(2026, 10, 19, 0, 15))])
+        self.assertEqual(self.rollup(), {utc(2026, 10, 18, 23): 1, utc(2026, 10, 19, 0): 3})
+
+    def test_removed_records_leave_the_rollup(self):
+        record = (self.space.pk, utc(2026, 10, 18, 10, 30), utc(2026, 10, 18, 11, 30))
+        occupancy.add_closed_records([record, record])
+        occupancy.remove_closed_records([record])
+        self.assertEqual(self.rollup(), {utc(2026, 10, 18, 10): 1, utc(2026, 10, 18, 11): 1})
+
+    def test_counts_include_open_records_and_empty_hours(self):
+        now = timezone.now()
+        hour = occupancy.floor_hour(now)
+        occupancy.add_closed_records([(self.space.pk, hour - timedelta(minutes=170), hour - timedelta(minutes=130))])
+        Record.objects.create(obj_id="7", obj_type="car", parking_space=self.space, in_time=hour - timedelta(minutes=50))
+
+        counts = occupancy.count_by_hour(now - timedelta(hours=4), now)
+        self.assertEqual(counts, {hour - timedelta(hours=h): n for h, n in ((4, 0), (3, 1), (2, 0), (1, 1), (0, 1))})
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_LAYER, CACHES=NO_CACHE)
+class RecordViewTests(TestCase):
+    def setUp(self):
+        self.camera = Camera.objects.create(id=1, location="gate", url="rtsp://gate")
+        self.space = make_space(self.camera)
+
+    def send(self, method, url, data):
+        with self.captureOnCommitCallbacks(execute=True):
+            return getattr(self.client, method)(url, data, content_type="application/json")
+
+    def rollup(self):
+        return dict(OccupancyHour.objects.filter(records__gt=0).values_list("hour", "records"))
+
+    def test_a_record_posted_closed_is_counted(self):
+        response = self.send("post", "/api/records/1/", {
+            "in_time": "2026-10-18T10:30:00Z", "out_time": "2026-10-18T11:10:00Z",
+            "obj_id": "7", "obj_type": "car", "parking_space": str(self.space.pk),
+        })
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.rollup(), {utc(2026, 10, 18, 10): 1, utc(2026, 10, 18, 11): 1})
+
+    def test_closing_a_record_twice_counts_it_once(self):
+        record = Record.objects.create(obj_id="7", obj_type="car", parking_space=self.space, in_time=utc(2026, 10, 18, 10, 30))
+        for _ in range(2):
+            self.send("patch", f"/api/records/{record.pk}/", {"out_time": "2026-10-18T10:50:00Z"})
+        self.assertEqual(self.rollup(), {utc(2026, 10, 18, 10): 1})
+
+    def test_editing_a_closed_record_moves_its_hours(self):
+        record = Record.objects.create(obj_id="7", obj_type="car", parking_space=self.space, in_time=utc(2026, 10, 18, 10, 30))
+        self.send("patch", f"/api/records/{record.pk}/", {"out_time": "2026-10-18T11:10:00Z"})
+        self.send("patch", f"/api/records/{record.pk}/", {"in_time": "2026-10-18T11:00:00Z", "out_time": "2026-10-18T12:10:00Z"})
+        self.assertEqual(self.rollup(), {utc(2026, 10, 18, 11): 1, utc(2026, 10, 18, 12): 1})
+
+        # reopened records are counted when they are read, not in the rollup
+        self.send("patch", f"/api/records/{record.pk}/", {"out_time": None})
+        self.assertEqual(self.rollup(), {})
+
+
+@override_settings(
+    CHANNEL_LAYERS=IN_MEMORY_LAYER,
+    CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache", "LOCATION": "tests"}},
+    RESPONSE_CACHE_TTL=10,
+)
+class CachedResponseTests(TestCase):
+    def setUp(self):
+        cache.response_cache().clear()
+        self.camera = Camera.objects.create(id=1, location="gate", url="rtsp://gate")
+        self.space = make_space(self.camera)
+
+    def send(self, method, url, data):
+        with self.captureOnCommitCallbacks(execute=True):
+            return getattr(self.client, method)(url, data, content_type="application/json")
+
+    def generations(self):
+        scopes = (cache.RECORDS, cache.OCCUPANCY, cache.PARKING_SPACES)
+        return dict(zip(scopes, map(cache.response_cache().get, map(cache._generation_key, scopes))))
+
+    def bumped(self, write):
+        before = self.generations()
+        write()
+        after = self.generations()
+        return {scope for scope in after if after[scope] != before[scope]}
+
+    def test_a_miss_then_a_hit(self):
+        first = self.client.get("/api/records_by_parking_space/")
+        second = self.client.get("/api/records_by_parking_space/")
+        self.assertEqual((first["X-Cache"], second["X-Cache"]), ("miss", "hit"))
+        self.assertEqual(second.json(), first.json())
+        # the query string is part of the key
+        self.assertEqual(self.client.get("/api/count_last_24h/?hours=2")["X-Cache"], "miss")
+        self.assertEqual(self.client.get("/api/count_last_24h/?hours=3")["X-Cache"], "miss")
+
+    def test_record_writes_bump_the_records_and_occupancy(self):
+        record = Record.objects.create(obj_id="7", obj_type="car", parking_space=self.space, in_time=utc(2026, 10, 18, 10))
+        patch = lambda: self.send("patch", f"/api/records/{record.pk}/", {"out_time": "2026-10-18T11:00:00Z"})
+        enter = lambda: self.send("post", "/api/records/bulk/", {"events": [
+            {"type": "enter", "key": "k1", "time": "2026-10-18T12:00:00Z", "obj_id": 7, "obj_type": "car", "parking_space": str(self.space.pk)},
+        ]})
+        self.assertEqual(self.bumped(patch), {cache.RECORDS, cache.OCCUPANCY})
+        self.assertEqual(self.bumped(enter), {cache.RECORDS, cache.OCCUPANCY})
+
+    def test_heartbeats_leave_the_hourly_counts_cached(self):
+        self.send("post", "/api/records/bulk/", {"events": [
+            {"type": "enter", "key": "k1", "time": "2026-10-18T12:00:00Z", "obj_id": 7, "obj_type": "car", "parking_space": str(self.space.pk)},
+        ]})
+        self.client.get("/api/count_last_24h/")
+        heartbeat = lambda: self.send("post", "/api/records/bulk/", {"events": [{"type": "heartbeat", "key": "k1", "time": "2026-10-18T12:01:00Z"}]})
+
+        self.assertEqual(self.bumped(heartbeat), {cache.RECORDS})
+        self.assertEqual(self.client.get("/api/count_last_24h/")["X-Cache"], "hit")
+        self.assertEqual(self.client.get("/api/records_by_parking_space/")["X-Cache"], "miss")
+
+    def test_parking_space_writes_bump_the_parking_spaces(self):
+        space_id = uuid.uuid4()
+        url = f"/api/parking_space/{space_id}/"
+        self.assertEqual(self.bumped(lambda: self.send("post", url, {"label": "A2", "camera": 1, "selection": SQUARE})), {cache.PARKING_SPACES})
+        self.assertEqual(self.bumped(lambda: self.send("patch", url, {"label": "A3"})), {cache.PARKING_SPACES})
+        # its records and rollup rows go with it
+        self.assertEqual(self.bumped(lambda: self.send("delete", url, None)), {cache.PARKING_SPACES, cache.RECORDS, cache.OCCUPANCY})
+
+    @override_settings(RESPONSE_CACHE_TTL=60)
+    def test_hourly_counts_expire_when_the_hour_turns(self):
+        for now, ttl in ((utc(2026, 10, 18, 10, 59, 30), 30), (utc(2026, 10, 18, 10, 59, 59, 500000), 1), (utc(2026, 10, 18, 10), 60)):
+            with self.subTest(now=now), mock.patch("cams.views.timezone.now", return_value=now):
+                self.assertEqual(until_next_hour(), ttl)
+
+    def test_stats_count_hits_and_misses_per_view(self):
+        for _ in range(3):
+            self.client.get("/api/count_last_24h/")
+        stats = self.client.get("/api/cache_stats/").json()
+        self.assertEqual(stats["CountLast24HView"], {"hits": 2, "misses": 1})
+        self.assertEqual(stats["ListRecordsByParkingSpace"], {"hits": 0, "misses": 0})
+
+    def test_an_unavailable_cache_serves_uncached_responses(self):
+        self.client.get("/api/records_by_parking_space/")
+        # the generations and the entry are read, then the connection drops
+        for method in ("incr", "add", "set"):
+            with self.subTest(method=method), mock.patch.object(cache.response_cache(), method, side_effect=ConnectionError("gone")), self.assertLogs(level="ERROR"):
+                response = self.client.get("/api/count_last_24h/?hours=1")
+                self.assertEqual(response.status_code, 200)
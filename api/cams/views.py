@@ -1,14 +1,26 @@
 from .models import Camera, ParkingSpace, Record, ObjectTypes, Runtime
 from django.utils import timezone
 from .serializers import CameraSerializer, ParkingSpaceSerializer, RecordSerializer, ObjectTypeSerializer, RuntimeSerializer, RecordByParkingSpaceSerializer
+from .pagination import RecordCursorPagination
+from . import occupancy
+from . import cache
+from .cache import cached_response, invalidate
+from .broadcast import publish_occupancy, publish_selection
+from .geometry import selection_geometry
 from rest_framework.views import APIView
 from rest_framework.generics import ListAPIView
 from rest_framework.response import Response
+from rest_framework.exceptions import ValidationError
 from django.shortcuts import get_object_or_404
-from django.db.models import Q, F, Prefetch
-from datetime import timedelta
-import jsonschema, json
+from django.db import transaction
+from django.db.models import F, Prefetch
+from django.utils.dateparse import parse_datetime
+from datetime import timedelta, timezone as dt_timezone
+from django.conf import settings
+import jsonschema
 import logging
+import math
+import uuid
 
 schema = {
   "$schema": "http://json-schema.org/draft-07/schema#",
@@ -28,6 +40,36 @@ schema = {
   }
 }
 
+bulk_schema = {
+  "$schema": "http://json-schema.org/draft-07/schema#",
+  "type": "array",
+  "items": {
+    "type": "object",
+    "required": ["type", "time"],
+    "properties": {
+      "type": {"enum": ["enter", "heartbeat", "exit"]},
+      "key": {"type": "string"},
+      "record": {"type": "integer"},
+      "time": {"type": "string"},
+      "obj_id": {"type": ["string", "number"]},
+      "obj_type": {"type": ["string", "number"]},
+      "parking_space": {"type": "string"},
+      "runtime": {"type": ["string", "null"]}
+    },
+    "if": {"properties": {"type": {"const": "enter"}}},
+    "then": {"required": ["key", "obj_id", "obj_type", "parking_space"]},
+    "else": {"anyOf": [{"required": ["record"]}, {"required": ["key"]}]}
+  }
+}
+
+def parse_event_time(value):
+    time = parse_datetime(value)
+    if time is None:
+        raise ValueError(f"invalid datetime {value}")
+    if timezone.is_naive(time):
+        time = timezone.make_aware(time, dt_timezone.utc)
+    return time
+
 class CameraListViewSet(ListAPIView):
     model = Camera
     serializer_class = CameraSerializer
@@ -38,12 +80,17 @@ class CameraListViewSet(ListAPIView):
 class CameraView(APIView):
     def get(self, request, camera_id):
         camera = get_object_or_404(Camera, pk=camera_id)
+        # the selection version identifies the parking spaces, so runtimes that
+        # reconnect with an up to date version skip serializing them
+        etag = f'"{camera.selection_version}"'
+        if etag in request.headers.get("If-None-Match", ""):
+            return Response(status=304, headers={"ETag": etag})
         camera_serializer = CameraSerializer(camera)
         spaces = ParkingSpace.objects.filter(camera=camera_id)
         spaces_serializer = ParkingSpaceSerializer(spaces, many=True)
         data = camera_serializer.data
         data["parking_spaces"] = spaces_serializer.data
-        return Response(data)
+        return Response(data, headers={"ETag": etag})
     def post(self, request, camera_id):
         data = {}
         data["id"] = camera_id
@@ -54,7 +101,31 @@ class CameraView(APIView):
             camera_serializer.save()
             return Response(camera_serializer.data, status=201)
         return Response(camera_serializer.errors, status=400)        
-  
+
+class CameraGeometryView(APIView):
+    """Precomputed geometry of the parking spaces of a camera.
+
+    Outlines come simplified and as ``[x, y]`` pairs, with their bounding box,
+    area and hash, so clients use them as they are. The ETag is the selection
+    version, a client that is up to date gets a 304 without the spaces being read.
+    """
+    def get(self, request, camera_id):
+        camera = get_object_or_404(Camera, pk=camera_id)
+        etag = f'"{camera.selection_version}"'
+        if etag in request.headers.get("If-None-Match", ""):
+            return Response(status=304, headers={"ETag": etag})
+        spaces = ParkingSpace.objects.filter(camera=camera_id).values_list("id", "label", "geometry", "selection")
+        data = {
+            "camera": camera.id,
+            "version": camera.selection_version,
+            # rows written around ParkingSpace.save(), e.g. by a queryset update, have no geometry yet
+            "parking_spaces": [
+                {"id": str(pk), "label": label, **(geometry or selection_geometry(selection))}
+                for pk, label, geometry, selection in spaces
+            ],
+        }
+        return Response(data, headers={"ETag": etag})
+
 class ParkingSpaceView(APIView):
     def get(self, request, parking_space_id):
         parking_space = get_object_or_404(ParkingSpace, pk=parking_space_id)
@@ -74,13 +145,15 @@ class ParkingSpaceView(APIView):
         }
         serializer = ParkingSpaceSerializer(data=data)
         if(serializer.is_valid()):
-            serializer.save()
+            with transaction.atomic():
+                parking_space = serializer.save()
+                publish_selection(parking_space.camera_id, upserts=[parking_space])
+                invalidate(cache.PARKING_SPACES)
             return Response(serializer.data, status=200)
         logging.error(serializer.errors)
         return Response(serializer.errors, status=400)
     def patch(self, request, parking_space_id):
         parking_space = get_object_or_404(ParkingSpace, pk=parking_space_id)
-        print(parking_space.selection)
         data = {
             "id": parking_space_id,
             "label": request.data.get("label", parking_space.label),
@@ -93,21 +166,73 @@ class ParkingSpaceView(APIView):
                 return Response({"details": f"selection validation error: {err.message}"}, status=400)
         serializer = ParkingSpaceSerializer(parking_space, data=data, partial=True)
         if(serializer.is_valid()):
-            serializer.update(parking_space, serializer.validated_data)
+            with transaction.atomic():
+                serializer.update(parking_space, serializer.validated_data)
+                publish_selection(parking_space.camera_id, upserts=[parking_space])
+                invalidate(cache.PARKING_SPACES)
             return Response(serializer.data)
         logging.error(serializer.errors)
         return Response(serializer.errors, status=400)
     def delete(self, request, parking_space_id):
         parking_space = get_object_or_404(ParkingSpace, pk=parking_space_id)
-        parking_space.delete()
+        with transaction.atomic():
+            publish_selection(parking_space.camera_id, deletes=[parking_space.pk])
+            parking_space.delete()
+            # its records and rollup rows go with it
+            invalidate(cache.PARKING_SPACES, cache.RECORDS, cache.OCCUPANCY)
         return Response({"details": "successfully deleted requested item"}, status=204)
 
 class RecordListViewSet(ListAPIView):
+    """Reportable records, newest first.
+
+    Optional query parameters: ``since``/``until`` (in_time range), ``parking_space``
+    and ``camera`` (comma separated ids), ``fields`` (comma separated projection)
+    and ``limit``/``cursor`` for keyset pagination (see RecordCursorPagination).
+    """
     model = Record
     serializer_class = RecordSerializer
-    queryset = Record.objects.filter(
-            Q(out_time__isnull=True) | Q(out_time__gt=F('in_time') + timedelta(minutes=1))
-        ).annotate(parking_space_label=F("parking_space__label")).order_by("-in_time")
+    pagination_class = RecordCursorPagination
+    queryset = Record.objects.reportable().order_by("-in_time")
+
+    def get_fields(self):
+        fields = self.request.query_params.get("fields")
+        if not fields:
+            return None
+        fields = [field for field in fields.split(",") if field]
+        unknown = set(fields) - set(RecordSerializer().fields)
+        if unknown:
+            raise ValidationError({"fields": f"unknown fields {sorted(unknown)}"})
+        return fields
+
+    @cached_response(cache.RECORDS, cache.PARKING_SPACES)
+    def get(self, request, *args, **kwargs):
+        return super().get(request, *args, **kwargs)
+
+    def get_serializer(self, *args, **kwargs):
+        return super().get_serializer(*args, fields=self.get_fields(), **kwargs)
+
+    def get_queryset(self):
+        params = self.request.query_params
+        queryset = super().get_queryset()
+        try:
+            if params.get("since"):
+                queryset = queryset.filter(in_time__gte=parse_event_time(params["since"]))
+            if params.get("until"):
+                queryset = queryset.filter(in_time__lt=parse_event_time(params["until"]))
+            if params.get("parking_space"):
+                queryset = queryset.filter(parking_space__in=[uuid.UUID(pk) for pk in params["parking_space"].split(",")])
+            if params.get("camera"):
+                queryset = queryset.filter(parking_space__camera__in=[int(pk) for pk in params["camera"].split(",")])
+        except ValueError as err:
+            raise ValidationError({"details": str(err)})
+
+        fields = self.get_fields()
+        if fields is None or "parking_space_label" in fields:
+            queryset = queryset.annotate(parking_space_label=F("parking_space__label"))
+        if fields is not None:
+            columns = {field.name for field in Record._meta.concrete_fields} & set(fields)
+            queryset = queryset.only("id", "in_time", *columns)
+        return queryset
 
 class RecordView(APIView):
     def get(self, request, record_id):
@@ -126,25 +251,147 @@ class RecordView(APIView):
         }
         serializer = RecordSerializer(data=data)
         if(serializer.is_valid()):
-            serializer.save()
+            with transaction.atomic():
+                record = serializer.save()
+                if record.out_time is not None:
+                    occupancy.add_closed_records([(record.parking_space_id, record.in_time, record.out_time)])
+                publish_occupancy([record.parking_space_id])
+                invalidate(cache.RECORDS, cache.OCCUPANCY)
             return Response(serializer.data, status=200)
         return Response(serializer.errors, status=400)
     def patch(self, request, record_id):
-        record = get_object_or_404(Record, pk=record_id)
-        data = {
-            "in_time": request.data.get("in_time", record.in_time),
-            "out_time": request.data.get("out_time", record.out_time),
-            "obj_id": request.data.get("obj_id", record.obj_id),
-            "obj_type": request.data.get("obj_type", record.obj_type),
-            "last_seen": request.data.get("last_seen"),
-            "parking_space": request.data.get("parking_space", record.parking_space.id),
-        }
-        serializer = RecordSerializer(record, data=data, partial=True)
-        if(serializer.is_valid()):
+        with transaction.atomic():
+            # locked, so concurrent closes of the same record add it to the rollup once
+            record = get_object_or_404(Record.objects.select_for_update(), pk=record_id)
+            data = {
+                "in_time": request.data.get("in_time", record.in_time),
+                "out_time": request.data.get("out_time", record.out_time),
+                "obj_id": request.data.get("obj_id", record.obj_id),
+                "obj_type": request.data.get("obj_type", record.obj_type),
+                "last_seen": request.data.get("last_seen"),
+                "parking_space": request.data.get("parking_space", record.parking_space_id),
+            }
+            before = (record.parking_space_id, record.in_time, record.out_time)
+            serializer = RecordSerializer(record, data=data, partial=True)
+            if not serializer.is_valid():
+                logging.error(serializer.errors)
+                return Response(serializer.errors, status=400)
             serializer.update(record, serializer.validated_data)
-            return Response(serializer.data)
-        logging.error(serializer.errors)
-        return Response(serializer.errors, status=400)
+            after = (record.parking_space_id, record.in_time, record.out_time)
+            invalidate(cache.RECORDS, cache.OCCUPANCY)
+            if after != before:
+                # the hours of an edited closed record are counted again from its new times
+                if before[2] is not None:
+                    occupancy.remove_closed_records([before])
+                if after[2] is not None:
+                    occupancy.add_closed_records([after])
+                publish_occupancy({before[0], after[0]})
+        return Response(serializer.data)
+
+class RecordBulkView(APIView):
+    """Applies a batch of enter, heartbeat and exit events from an inference runtime.
+
+    Enters are inserted with one bulk_create and the remaining events are folded
+    per record into one bulk_update for heartbeats and one for exits, all inside a
+    single transaction. Heartbeats and exits reference a record by its ``record`` id
+    or by the ``key`` of an enter from the same or an earlier batch. Enters are
+    idempotent on their key, so a batch resent after a lost response creates no
+    duplicates. The response maps the key of every enter to its record id and
+    lists in ``rejected`` the keys of enters for unknown parking spaces and the
+    ids of records that are unknown or already closed.
+    """
+    def post(self, request):
+        events = request.data.get("events") if isinstance(request.data, dict) else None
+        try:
+            jsonschema.validate(events, bulk_schema)
+            times = [parse_event_time(event["time"]) for event in events]
+            for event in events:
+                for field in ("parking_space", "runtime"):
+                    if event.get(field):
+                        event[field] = str(uuid.UUID(event[field]))
+        except jsonschema.exceptions.ValidationError as err:
+            return Response({"details": f"events validation error: {err.message}"}, status=400)
+        except ValueError as err:
+            return Response({"details": f"events validation error: {err}"}, status=400)
+
+        enters = [(event, time) for event, time in zip(events, times) if event["type"] == "enter"]
+        known_spaces = {str(pk) for pk in ParkingSpace.objects.filter(
+            pk__in={event["parking_space"] for event, _ in enters}
+        ).values_list("pk", flat=True)}
+        known_runtimes = {str(pk) for pk in Runtime.objects.filter(
+            pk__in={event["runtime"] for event, _ in enters if event.get("runtime")}
+        ).values_list("pk", flat=True)}
+        existing = dict(Record.objects.filter(
+            key__in={event["key"] for event in events if event.get("key")}
+        ).values_list("key", "pk"))
+
+        new_records = {}
+        rejected = []
+        for event, time in enters:
+            if event["key"] in existing:
+                continue
+            if event["parking_space"] not in known_spaces:
+                rejected.append(event["key"])
+                continue
+            new_records[event["key"]] = Record(
+                key=event["key"],
+                in_time=time,
+                last_seen=time,
+                obj_id=str(event["obj_id"]),
+                obj_type=str(event["obj_type"]),
+                parking_space_id=event["parking_space"],
+                runtime_id=event.get("runtime") if event.get("runtime") in known_runtimes else None,
+            )
+
+        seen, exits = {}, {}
+        for event, time in zip(events, times):
+            if event["type"] == "enter":
+                continue
+            record = new_records.get(event.get("key"))
+            if record is not None:
+                record.last_seen = max(record.last_seen, time)
+                if event["type"] == "exit":
+                    record.out_time = time
+                continue
+            pk = event.get("record")
+            if pk is None:
+                pk = existing.get(event.get("key"))
+            if pk is not None:
+                seen[pk] = max(seen.get(pk, time), time)
+                if event["type"] == "exit":
+                    exits[pk] = time
+
+        with transaction.atomic():
+            # closed records are left alone, a replayed exit must not move the out_time the rollup counted
+            open_records = {pk: (parking_space_id, in_time) for pk, parking_space_id, in_time in Record.objects.select_for_update().filter(
+                pk__in=seen, out_time__isnull=True
+            ).values_list("pk", "parking_space_id", "in_time")}
+            rejected += [pk for pk in seen if pk not in open_records]
+            closed = [(*open_records[pk], time) for pk, time in exits.items() if pk in open_records]
+            closed += [(r.parking_space_id, r.in_time, r.out_time) for r in new_records.values() if r.out_time is not None]
+            Record.objects.bulk_create(new_records.values())
+            Record.objects.bulk_update(
+                [Record(pk=pk, last_seen=time) for pk, time in seen.items() if pk in open_records and pk not in exits],
+                ["last_seen"],
+            )
+            Record.objects.bulk_update(
+                [Record(pk=pk, last_seen=seen[pk], out_time=time) for pk, time in exits.items() if pk in open_records],
+                ["last_seen", "out_time"],
+            )
+            occupancy.add_closed_records(closed)
+            changed_spaces = {parking_space_id for parking_space_id, _, _ in closed}
+            changed_spaces.update(record.parking_space_id for record in new_records.values())
+            publish_occupancy(changed_spaces)
+            # heartbeats alone leave the occupancy counts as they are
+            if changed_spaces:
+                invalidate(cache.RECORDS, cache.OCCUPANCY)
+            elif seen:
+                invalidate(cache.RECORDS)
+
+        records = {event["key"]: existing[event["key"]] for event, _ in enters if event["key"] in existing}
+        records.update((key, record.pk) for key, record in new_records.items())
+        data = {"records": records, "rejected": rejected}
+        return Response(data, status=200)
 
 class RuntimeListViewSet(ListAPIView):
     model = Runtime
@@ -190,29 +437,36 @@ class ObjectTypeView(APIView):
         return Response(serializer.errors, status=400)
 
 class ListRecordsByParkingSpace(APIView):
+    @cached_response(cache.RECORDS, cache.PARKING_SPACES)
     def get(self, request):
         parking_spaces = ParkingSpace.objects.prefetch_related(Prefetch("record_set", queryset=Record.objects.filter(out_time__isnull=True)))
         serializer = RecordByParkingSpaceSerializer(instance=parking_spaces, many=True)
         return Response(serializer.data, status=200)
 
+def until_next_hour() -> int:
+    """Seconds the hourly counts stay valid, at most ``RESPONSE_CACHE_TTL``."""
+    now = timezone.now()
+    next_hour = occupancy.floor_hour(now) + timedelta(hours=1)
+    return max(1, min(settings.RESPONSE_CACHE_TTL, math.ceil((next_hour - now).total_seconds())))
+
 class CountLast24HView(APIView):
+    """Records present in every hour of the last 24 hours (or ``?hours=``, up to 30 days).
+
+    Cached until a record enters or leaves (heartbeats do not change the counts)
+    or the hour turns, when open records start counting in the new hour.
+    """
+    @cached_response(cache.OCCUPANCY, timeout=until_next_hour)
     def get(self, request):
+        try:
+            hours = min(max(int(request.query_params.get("hours", 24)), 1), 24 * 30)
+        except ValueError:
+            return Response({"details": "hours must be an integer"}, status=400)
         now = timezone.now()
-        query = ((Q(in_time__gte=now-timedelta(hours=24)) | Q(out_time__gte=now-timedelta(hours=24))) & Q(out_time__gt=F('in_time') + timedelta(minutes=1))) | Q(out_time__isnull = True)
-        records = Record.objects.filter(query).order_by("in_time")
-        keys = []
-        for i in range(24+1):
-            time = now-timedelta(hours=24-i)
-            key = time.replace(minute=0, second=0, microsecond=0).isoformat()
-            keys.append(key)
-        r = {k: 0 for k in keys}
-        for record in records:
-            in_time = record.in_time
-            out_time = record.out_time or now
-            delta_hours = out_time.hour - in_time.hour if in_time.day == out_time.day else out_time.hour+(24-in_time.hour)
-            for h in range(delta_hours+1):
-                time = in_time + timedelta(hours=h)
-                key = time.replace(minute=0, second=0, microsecond=0).isoformat()
-                r[key] += 1
-
-        return Response(r, status=200)
\ No newline at end of file
+        counts = occupancy.count_by_hour(now - timedelta(hours=hours), now)
+        r = {hour.isoformat(): count for hour, count in counts.items()}
+        return Response(r, status=200)
+
+class CacheStatsView(APIView):
+    """Hits and misses of the response cache per view."""
+    def get(self, request):
+        return Response(cache.stats(), status=200)
@@ -151,11 +151,49 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 APPEND_SLASH = True
 
-CHANNEL_LAYERS = {
-    "default": {
-        "BACKEND": "channels.layers.InMemoryChannelLayer"
-    },
-}
+# Redis lets every API process reach every websocket, the in-memory layer is
+# the in-process fallback for local runs and tests
+if environ.get("REDIS_URL"):
+    CHANNEL_LAYERS = {
+        "default": {
+            "BACKEND": "channels_redis.core.RedisChannelLayer",
+            "CONFIG": {
+                "hosts": [environ.get("REDIS_URL")],
+            },
+        },
+    }
+else:
+    CHANNEL_LAYERS = {
+        "default": {
+            "BACKEND": "channels.layers.InMemoryChannelLayer"
+        },
+    }
+
+# response cache of the dashboard and report endpoints, see cams/cache.py; shared
+# through Redis when there is one, so invalidations reach every API process
+if environ.get("REDIS_URL"):
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.redis.RedisCache",
+            "LOCATION": environ.get("REDIS_URL"),
+            "KEY_PREFIX": "smartpark",
+        },
+    }
+else:
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+            "LOCATION": "smartpark",
+        },
+    }
+
+RESPONSE_CACHE = "default"
+# seconds a cached response lives without being invalidated by a write
+RESPONSE_CACHE_TTL = int(environ.get("RESPONSE_CACHE_TTL", 10))
+
+# shared with the inference runtimes, only websockets that present it as a bearer
+# token may publish overlays; without one nobody can
+RUNTIME_TOKEN = environ.get("RUNTIME_TOKEN")
 
 #django-channels setting
 ASGI_APPLICATION = "smartpark.asgi.application"
@@ -8,6 +8,8 @@ def try_and_retry(n_attempts, delay):
             subprocess.call(['python', 'manage.py', 'makemigrations'])
             logging.warning("trying to migrate")
             subprocess.call(['python', 'manage.py', 'migrate'])
+            logging.warning("trying to rebuild occupancy rollup")
+            subprocess.call(['python', 'manage.py', 'rebuild_occupancy'])
             logging.warning("trying to runserver")
             subprocess.call(['python', 'manage.py', 'runserver', "0.0.0.0:8000"])
             break
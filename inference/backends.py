@@ -0,0 +1,304 @@
+import abc
+import argparse
+import ast
+import logging
+from pathlib import Path
+from typing import Dict, List, Tuple, Union
+
+import cv2
+import numpy as np
+import torch
+from ultralytics import YOLO
+from ultralytics.data.augment import LetterBox
+from ultralytics.engine.results import Results
+from ultralytics.trackers.byte_tracker import BYTETracker
+from ultralytics.utils import IterableSimpleNamespace, yaml_load
+from ultralytics.utils.checks import check_yaml
+
+BACKENDS = ("ultralytics", "onnx", "openvino")
+PRECISIONS = ("fp32", "fp16", "int8")
+
+# class offset of the class-aware NMS, same as ultralytics
+MAX_WH = 7680
+
+
+class StreamTracker:
+    """ByteTrack state of a single stream.
+
+    ``model.track`` keeps one tracker per batch slot of its own predictor, so
+    batches built from different cameras would mix their tracks. This applies
+    the same update as ultralytics' ``on_predict_postprocess_end`` to the
+    results of one stream, whatever backend produced them.
+    """
+    def __init__(self, tracker: str = "bytetrack.yaml", frame_rate: int = 30) -> None:
+        cfg = IterableSimpleNamespace(**yaml_load(check_yaml(tracker)))
+        if cfg.tracker_type != "bytetrack":
+            raise ValueError(f"tracker must be a bytetrack config, but got {cfg.tracker_type}")
+        self._tracker = BYTETracker(args=cfg, frame_rate=frame_rate)
+
+    def update(self, result):
+        det = result.boxes.cpu().numpy()
+        if len(det) == 0:
+            return result
+        tracks = self._tracker.update(det, result.orig_img)
+        if len(tracks) == 0:
+            return result
+        idx = tracks[:, -1].astype(int)
+        result = result[idx]
+        result.update(boxes=torch.as_tensor(tracks[:, :-1]))
+        return result
+
+
+def backend_of(path: str) -> str:
+    path = Path(path)
+    if path.suffix == ".onnx":
+        return "onnx"
+    if path.suffix == ".xml" or path.name.endswith("_openvino_model"):
+        return "openvino"
+    return "ultralytics"
+
+
+def load_model(path: str, threads: int = None, imgsz: int = None) -> Union[YOLO, "ExportedModel"]:
+    """Loads weights with the backend their format needs.
+
+    ``.onnx`` files run on ONNX Runtime, OpenVINO IR (the ``.xml`` or the
+    ``_openvino_model`` directory ultralytics exports) on OpenVINO, anything
+    else is handed to ultralytics' ``YOLO``.
+    """
+    backend = backend_of(path)
+    if backend == "onnx":
+        return OnnxModel(path, threads=threads, imgsz=imgsz)
+    if backend == "openvino":
+        return OpenVinoModel(path, threads=threads, imgsz=imgsz)
+    if threads:
+        torch.set_num_threads(threads)
+    return YOLO(path)
+
+
+def export_model(weights: str, backend: str = "onnx", imgsz: int = 640, precision: str = "fp32", dynamic: bool = False) -> str:
+    """Exports ``.pt`` weights for ``load_model`` and returns the path to load.
+
+    ONNX INT8 is a dynamic quantization of the FP32 export; ONNX FP16 needs a
+    GPU to export. OpenVINO INT8 is calibrated by ultralytics on its default
+    dataset.
+    """
+    if backend not in BACKENDS[1:]:
+        raise ValueError(f"backend must be one of {BACKENDS[1:]}, but got {backend}")
+    if precision not in PRECISIONS:
+        raise ValueError(f"precision must be one of {PRECISIONS}, but got {precision}")
+    model = YOLO(weights)
+    if backend == "openvino":
+        return model.export(
+            format="openvino", imgsz=imgsz, dynamic=dynamic, half=precision == "fp16", int8=precision == "int8"
+        )
+    if precision == "fp16":
+        return model.export(format="onnx", imgsz=imgsz, half=True, device=0)
+    path = model.export(format="onnx", imgsz=imgsz, dynamic=dynamic)
+    if precision == "int8":
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+
+        quantized = str(Path(path).with_name(f"{Path(path).stem}_int8.onnx"))
+        quantize_dynamic(path, quantized, weight_type=QuantType.QUInt8)
+        path = quantized
+    return path
+
+
+def nms(boxes: np.ndarray, scores: np.ndarray, iou: float, max_det: int = None) -> np.ndarray:
+    """Greedy NMS, indices of the kept ``boxes`` by decreasing score, at most ``max_det`` of them."""
+    x0, y0, x1, y1 = boxes.T
+    areas = (x1 - x0) * (y1 - y0)
+    order = np.argsort(-scores)
+    keep = []
+    while len(order) and (max_det is None or len(keep) < max_det):
+        i, rest = order[0], order[1:]
+        keep.append(i)
+        w = np.clip(np.minimum(x1[i], x1[rest]) - np.maximum(x0[i], x0[rest]), 0, None)
+        h = np.clip(np.minimum(y1[i], y1[rest]) - np.maximum(y0[i], y0[rest]), 0, None)
+        inter = w * h
+        order = rest[inter / (areas[i] + areas[rest] - inter) <= iou]
+    return np.array(keep, dtype=np.int64)
+
+
+def decode_masks(protos: np.ndarray, coefficients: np.ndarray, boxes: np.ndarray, shape: Tuple[int, int]) -> np.ndarray:
+    """Binary masks at the network input ``shape``, as ultralytics' ``process_mask`` with upsampling."""
+    channels, mask_height, mask_width = protos.shape
+    masks = 1 / (1 + np.exp(-(coefficients @ protos.reshape(channels, -1))))
+    masks = masks.reshape(-1, mask_height, mask_width)
+    scale = np.array([mask_width / shape[1], mask_height / shape[0]] * 2, dtype=np.float32)
+    x0, y0, x1, y1 = np.split((boxes * scale)[:, :, None, None], 4, axis=1)
+    cols = np.arange(mask_width, dtype=np.float32)[None, None, None, :]
+    rows = np.arange(mask_height, dtype=np.float32)[None, None, :, None]
+    masks = masks * ((cols >= x0) & (cols < x1) & (rows >= y0) & (rows < y1))[:, 0]
+    # resized and thresholded in place, mask by mask, to skip full size temporaries
+    upsampled = np.empty((len(masks),) + tuple(shape), dtype=np.float32)
+    for mask, out in zip(masks, upsampled):
+        cv2.resize(mask, shape[::-1], dst=out, interpolation=cv2.INTER_LINEAR)
+        cv2.threshold(out, 0.5, 1.0, cv2.THRESH_BINARY, dst=out)
+    return upsampled
+
+
+def scale_boxes(boxes: np.ndarray, shape: Tuple[int, int], orig_shape: Tuple[int, int]) -> np.ndarray:
+    """Maps boxes from the letterboxed network input back to the frame."""
+    gain = min(shape[0] / orig_shape[0], shape[1] / orig_shape[1])
+    pad_x = round((shape[1] - orig_shape[1] * gain) / 2 - 0.1)
+    pad_y = round((shape[0] - orig_shape[0] * gain) / 2 - 0.1)
+    boxes = (boxes - [pad_x, pad_y, pad_x, pad_y]) / gain
+    return np.clip(boxes, 0, [orig_shape[1], orig_shape[0], orig_shape[1], orig_shape[0]])
+
+
+class ExportedModel(abc.ABC):
+    """A YOLOv8 detection or segmentation model exported out of PyTorch.
+
+    Implements the part of the ``YOLO`` API the streams and the inference
+    runtime use, ``names``, ``predict`` and ``track``, and returns ultralytics
+    ``Results`` so tracking, evaluation and the overlay work unchanged. Pre and
+    post processing (letterbox, NMS, mask decode) run in NumPy, subclasses only
+    run the network.
+
+    Models exported with a fixed input size always run at that size, dynamic
+    ones at ``imgsz`` letterboxed the way the ``.pt`` weights are. Models exported
+    with a fixed batch run the frames of a batch one by one.
+    """
+    def __init__(
+        self,
+        names: Dict[int, str],
+        input_shape: Tuple,
+        imgsz: int = None,
+        stride: int = 32,
+        conf: float = 0.25,
+        iou: float = 0.7,
+        max_det: int = 300,
+        max_nms: int = 30000,
+    ) -> None:
+        self.names = names
+        batch, _, height, width = input_shape
+        self._batch = batch if isinstance(batch, int) else None
+        self._fixed_shape = (height, width) if isinstance(height, int) and isinstance(width, int) else None
+        self.imgsz = imgsz or 640
+        self.stride = stride
+        self.conf = conf
+        self.iou = iou
+        self.max_det = max_det
+        self.max_nms = max_nms
+        self._input_dtype = np.float32
+        self._tracker = None
+
+    def predict(self, source, classes: List[int] = None, imgsz: int = None, conf: float = None, **kwargs) -> List[Results]:
+        images = source if isinstance(source, list) else [source]
+        if self._fixed_shape is not None:
+            letterbox = LetterBox(self._fixed_shape, auto=False)
+        else:
+            # like the .pt path, frames of one size are padded to a multiple of the stride only
+            same_shapes = all(image.shape == images[0].shape for image in images)
+            letterbox = LetterBox((imgsz or self.imgsz,) * 2, auto=same_shapes, stride=self.stride)
+        results = []
+        step = self._batch or len(images)
+        for start in range(0, len(images), step):
+            chunk = images[start:start + step]
+            blob = np.stack([letterbox(image=image) for image in chunk])
+            shape = blob.shape[1:3]
+            # BGR HWC uint8 to RGB CHW in [0, 1]
+            blob = np.ascontiguousarray(blob[..., ::-1].transpose(0, 3, 1, 2)).astype(self._input_dtype) / 255
+            outputs = self._infer(blob)
+            predictions = outputs[0].astype(np.float32)
+            protos = outputs[1].astype(np.float32) if len(outputs) > 1 else None
+            for i, image in enumerate(chunk):
+                results.append(self._postprocess(
+                    predictions[i], None if protos is None else protos[i], image, shape, classes,
+                    self.conf if conf is None else conf,
+                ))
+        return results
+
+    def track(self, source, persist: bool = False, classes: List[int] = None, tracker: str = "bytetrack.yaml", **kwargs) -> List[Results]:
+        """Tracks the frames of a single stream, like ``YOLO.track`` with one source."""
+        if self._tracker is None or not persist:
+            self._tracker = StreamTracker(tracker)
+        return [self._tracker.update(result) for result in self.predict(source, classes=classes, **kwargs)]
+
+    @abc.abstractmethod
+    def _infer(self, blob: np.ndarray) -> List[np.ndarray]:
+        """Runs the network on an NCHW float blob and returns its raw outputs."""
+
+    def _postprocess(self, prediction, protos, image, shape, classes, conf) -> Results:
+        n_classes = len(self.names)
+        prediction = prediction.T
+        scores = prediction[:, 4:4 + n_classes]
+        cls = scores.argmax(1)
+        confidence = scores[np.arange(len(scores)), cls]
+        keep = confidence > conf
+        if classes is not None:
+            keep &= np.isin(cls, classes)
+        prediction, cls, confidence = prediction[keep], cls[keep], confidence[keep]
+        order = np.argsort(-confidence)[:self.max_nms]
+        prediction, cls, confidence = prediction[order], cls[order], confidence[order]
+
+        xywh = prediction[:, :4]
+        boxes = np.concatenate([xywh[:, :2] - xywh[:, 2:] / 2, xywh[:, :2] + xywh[:, 2:] / 2], axis=1)
+        keep = nms(boxes + cls[:, None] * MAX_WH, confidence, self.iou, self.max_det)
+        boxes, cls, confidence = boxes[keep], cls[keep], confidence[keep]
+
+        masks = None
+        if protos is not None:
+            masks = decode_masks(protos, prediction[keep, 4 + n_classes:], boxes, shape)
+            masks = torch.from_numpy(masks)
+        boxes = scale_boxes(boxes, shape, image.shape[:2])
+        data = np.concatenate([boxes, confidence[:, None], cls[:, None]], axis=1).astype(np.float32)
+        return Results(image, "", self.names, boxes=torch.from_numpy(data), masks=masks)
+
+
+class OnnxModel(ExportedModel):
+    """``ExportedModel`` on ONNX Runtime's CPU provider with ``threads`` intra-op threads."""
+    def __init__(self, path: str, threads: int = None, **kwargs) -> None:
+        import onnxruntime as ort
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        options.inter_op_num_threads = 1
+        if threads:
+            options.intra_op_num_threads = threads
+        self._session = ort.InferenceSession(str(path), options, providers=["CPUExecutionProvider"])
+        metadata = self._session.get_modelmeta().custom_metadata_map
+        model_input = self._session.get_inputs()[0]
+        names = ast.literal_eval(metadata["names"])
+        super().__init__(names, model_input.shape, stride=int(metadata.get("stride", 32)), **kwargs)
+        self._input_name = model_input.name
+        if model_input.type == "tensor(float16)":
+            self._input_dtype = np.float16
+        logging.log(logging.INFO, f"Loaded {path} on ONNX Runtime with input {model_input.shape} {model_input.type}")
+
+    def _infer(self, blob: np.ndarray) -> List[np.ndarray]:
+        return self._session.run(None, {self._input_name: blob})
+
+
+class OpenVinoModel(ExportedModel):
+    """``ExportedModel`` on OpenVINO's CPU plugin with ``threads`` inference threads."""
+    def __init__(self, path: str, threads: int = None, **kwargs) -> None:
+        import openvino as ov
+
+        path = Path(path)
+        xml = path if path.suffix == ".xml" else next(path.glob("*.xml"))
+        core = ov.Core()
+        model = core.read_model(xml)
+        config = {"PERFORMANCE_HINT": "LATENCY"}
+        if threads:
+            config["INFERENCE_NUM_THREADS"] = threads
+        self._model = core.compile_model(model, "CPU", config)
+        metadata = yaml_load(xml.with_name("metadata.yaml"))
+        shape = [dim.get_length() if dim.is_static else None for dim in model.input(0).get_partial_shape()]
+        super().__init__(metadata["names"], tuple(shape), stride=int(metadata.get("stride", 32)), **kwargs)
+        logging.log(logging.INFO, f"Loaded {xml} on OpenVINO with input {shape}")
+
+    def _infer(self, blob: np.ndarray) -> List[np.ndarray]:
+        outputs = self._model(blob)
+        return [outputs[output] for output in self._model.outputs]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Exports YOLO weights for the ONNX Runtime and OpenVINO backends")
+    parser.add_argument("weights")
+    parser.add_argument("--backend", choices=BACKENDS[1:], default="onnx")
+    parser.add_argument("--imgsz", type=int, default=640)
+    parser.add_argument("--precision", choices=PRECISIONS, default="fp32")
+    parser.add_argument("--dynamic", action="store_true", help="variable batch and input size")
+    args = parser.parse_args()
+    print(export_model(args.weights, args.backend, args.imgsz, args.precision, args.dynamic))
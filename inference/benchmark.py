@@ -0,0 +1,597 @@
+import argparse
+import json
+import logging
+import os
+import shutil
+import subprocess as sp
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+import cv2
+from shapely.geometry import Polygon
+from typing import Callable, List, Tuple
+from ultralytics.data.augment import LetterBox
+from ultralytics.utils.plotting import Annotator, colors
+
+from script import OccupationDetector, ParkingSpace, RasterIndex, RecordReporter, SpatialIndex
+
+
+def timeit(fn: Callable, repeat: int) -> Tuple[float, float]:
+    fn()
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - start)
+    samples = np.array(samples) * 1000
+    return float(np.median(samples)), float(np.percentile(samples, 95))
+
+
+def report(name: str, p50: float, p95: float, baseline: float = None) -> None:
+    speedup = f"  x{baseline / p50:.1f}" if baseline else ""
+    print(f"{name:<12} p50 {p50:9.3f} ms   p95 {p95:9.3f} ms{speedup}")
+
+
+def draw_results(result, frame: np.ndarray) -> np.ndarray:
+    """Draws what ``Results.plot`` draws, but on ``frame`` itself instead of a deep copy of it."""
+    import torch
+
+    names = result.names
+    annotator = Annotator(frame, example=names)
+    if result.masks is not None and len(result.masks):
+        img = LetterBox(result.masks.shape[1:])(image=frame)
+        im_gpu = torch.as_tensor(img, dtype=torch.float16, device=result.masks.data.device).permute(
+            2, 0, 1).flip(0).contiguous() / 255
+        idx = result.boxes.cls if result.boxes is not None and len(result.boxes) else range(len(result.masks))
+        annotator.masks(result.masks.data, colors=[colors(x, True) for x in idx], im_gpu=im_gpu)
+    if result.boxes is not None:
+        for d in reversed(result.boxes):
+            c, conf, id = int(d.cls), float(d.conf), None if d.id is None else int(d.id.item())
+            name = ('' if id is None else f'id:{id} ') + names[c]
+            annotator.box_label(d.xyxy.squeeze(), f'{name} {conf:.2f}', color=colors(c, True))
+    image = annotator.result()
+    if image is not frame:
+        # non ascii labels are drawn with PIL on a copy
+        np.copyto(frame, image)
+    return frame
+
+
+def make_spaces(n_spaces: int, width: int, height: int) -> List[ParkingSpace]:
+    cols = int(np.ceil(np.sqrt(n_spaces * width / height)))
+    rows = int(np.ceil(n_spaces / cols))
+    w, h = width / cols, height / rows
+    spaces = []
+    for i in range(n_spaces):
+        x, y = (i % cols) * w, (i // cols) * h
+        pts = [(x + 2, y + 2), (x + w - 2, y + 2), (x + w - 2, y + h - 2), (x + 2, y + h - 2)]
+        spaces.append(ParkingSpace(id=i, selection=pts))
+    return spaces
+
+
+def make_vehicles(n_vehicles: int, width: int, height: int, size: float, rng) -> List[np.ndarray]:
+    angles = np.linspace(0, 2 * np.pi, 32, endpoint=False)
+    outlines = []
+    for cx, cy in rng.uniform((2 * size, 2 * size), (width - 2 * size, height - 2 * size), (n_vehicles, 2)):
+        rx, ry = size * rng.uniform(0.6, 1.4, 2)
+        outlines.append(np.stack([cx + rx * np.cos(angles), cy + ry * np.sin(angles)], axis=1).astype(np.float32))
+    return outlines
+
+
+def bench_eval(args) -> None:
+    rng = np.random.default_rng(args.seed)
+    spaces = make_spaces(args.spaces, args.width, args.height)
+    outlines = make_vehicles(args.vehicles, args.width, args.height, args.vehicle_size, rng)
+    polygons = [Polygon(outline) for outline in outlines]
+    # YOLO masks come at the letterboxed network input size, not at frame size
+    frame_shape, mask_shape = (args.height, args.width), (args.mask_height, args.mask_width)
+    gain = min(mask_shape[0] / frame_shape[0], mask_shape[1] / frame_shape[1])
+    pad = np.array([(mask_shape[1] - frame_shape[1] * gain) / 2, (mask_shape[0] - frame_shape[0] * gain) / 2])
+    masks = np.zeros((len(outlines),) + mask_shape, dtype=np.uint8)
+    for mask, outline in zip(masks, outlines):
+        cv2.fillPoly(mask, [np.round(outline * gain + pad).astype(np.int32)], 1)
+
+    def legacy():
+        for polygon in polygons:
+            for space in spaces:
+                intersection = space.selection_polygon.intersection(polygon)
+                if intersection.area:
+                    intersection.area / polygon.area
+
+    spatial = SpatialIndex()
+    spatial.sync(spaces)
+    raster = RasterIndex()
+    raster.sync(spaces, frame_shape, mask_shape)
+
+    print(
+        f"{args.spaces} spaces, {args.vehicles} vehicles, {args.width}x{args.height} frame, "
+        f"{args.mask_width}x{args.mask_height} masks, {args.repeat} runs"
+    )
+    base, base95 = timeit(legacy, args.repeat)
+    report("eval_vehicle", base, base95)
+    report("strtree", *timeit(lambda: spatial.query(polygons), args.repeat), baseline=base)
+    report("raster", *timeit(lambda: raster.query(masks), args.repeat), baseline=base)
+    rebuild = RasterIndex()
+    report("raster sync", *timeit(lambda: (setattr(rebuild, "_signature", None), rebuild.sync(spaces, frame_shape, mask_shape)), args.repeat))
+
+
+def bench_batch(args) -> None:
+    from ultralytics import YOLO
+
+    model = YOLO(args.model)
+    rng = np.random.default_rng(args.seed)
+    frames = [rng.integers(0, 256, (args.height, args.width, 3), dtype=np.uint8) for _ in range(max(args.streams))]
+    print(f"{args.model}, {args.width}x{args.height} frames, {args.repeat} runs, per frame latency")
+    base = None
+    for n in args.streams:
+        batch = frames[:n]
+        p50, p95 = timeit(lambda: model.predict(batch, verbose=False), args.repeat)
+        p50, p95 = p50 / n, p95 / n
+        # baseline is the same n frames as n single-frame passes
+        if base is None and n == 1:
+            base = p50
+        report(f"batch {n}", p50, p95, baseline=base if n > 1 else None)
+
+
+def write_clip(path: str, n_frames: int, width: int, height: int, rng) -> None:
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*"mp4v"), 30, (width, height))
+    background = rng.integers(0, 256, (height, width, 3), dtype=np.uint8)
+    for i in range(n_frames):
+        frame = background.copy()
+        cv2.rectangle(frame, (i * 7 % width, height // 3), (i * 7 % width + width // 10, height // 2), (0, 0, 255), -1)
+        writer.write(frame)
+    writer.release()
+
+
+def bench_frames(args) -> None:
+    import torch
+    from ultralytics.engine.results import Results
+    from pipeline import FramePool
+
+    rng = np.random.default_rng(args.seed)
+    names = {2: "car", 7: "truck"}
+    xy = rng.uniform((0, 0), (args.width - 100, args.height - 100), (args.vehicles, 2))
+    boxes = torch.tensor([[x, y, x + 100, y + 80, 0.9, 2] for x, y in xy], dtype=torch.float32)
+    masks = None
+    if args.masks:
+        masks = torch.zeros(args.vehicles, args.mask_height, args.mask_width)
+        for mask, (x, y) in zip(masks, xy * args.mask_width / args.width):
+            mask[int(y):int(y) + 25, int(x):int(x) + 33] = 1
+
+    def run(path: str, zero_copy: bool, trace: bool) -> List[float]:
+        # cat drains the pipe like ffmpeg would, without the encoding cost
+        sink = sp.Popen(["cat"], stdin=sp.PIPE, stdout=sp.DEVNULL)
+        vcap = cv2.VideoCapture(path, cv2.CAP_FFMPEG)
+        pool = FramePool((args.height, args.width, 3), 2)
+        samples = []
+        while True:
+            if trace:
+                tracemalloc.reset_peak()
+                base = tracemalloc.get_traced_memory()[0]
+            start = time.perf_counter()
+            if zero_copy:
+                buffer = pool.acquire()
+                ret, frame = vcap.read(buffer)
+            else:
+                ret, frame = vcap.read()
+            if not ret:
+                break
+            result = Results(frame, "clip", names, boxes=boxes, masks=masks)
+            if zero_copy:
+                sink.stdin.write(draw_results(result, frame).data)
+                pool.release(frame)
+            else:
+                sink.stdin.write(result.plot().tobytes())
+            if trace:
+                samples.append(tracemalloc.get_traced_memory()[1] - base)
+            else:
+                samples.append(time.perf_counter() - start)
+        vcap.release()
+        sink.stdin.close()
+        sink.wait()
+        return samples
+
+    frame_mb = args.width * args.height * 3 / 2 ** 20
+    print(
+        f"{args.frames} frames {args.width}x{args.height}, {args.vehicles} boxes"
+        f"{' with masks' if args.masks else ''}, capture -> overlay -> pipe"
+    )
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "clip.mp4")
+        write_clip(path, args.frames, args.width, args.height, rng)
+        base = None
+        for name, zero_copy in (("copying", False), ("zero-copy", True)):
+            times = np.array(run(path, zero_copy, trace=False)) * 1000
+            tracemalloc.start()
+            allocs = np.array(run(path, zero_copy, trace=True)) / 2 ** 20
+            tracemalloc.stop()
+            p50 = float(np.median(times))
+            report(name, p50, float(np.percentile(times, 95)), baseline=base)
+            print(f"{'':<12} {frame_mb * 1000 / p50:7.0f} MB/s   peak alloc {np.median(allocs):6.1f} MB/frame")
+            base = base or p50
+
+
+def bench_overlay(args) -> None:
+    import torch
+    from ultralytics.engine.results import Results
+    from script import OverlayRenderer
+
+    rng = np.random.default_rng(args.seed)
+    spaces = make_spaces(args.spaces, args.width, args.height)
+    for space in spaces[::3]:
+        space._occupants = 1
+    frame = rng.integers(0, 256, (args.height, args.width, 3), dtype=np.uint8)
+    outlines = make_vehicles(args.vehicles, args.width, args.height, args.vehicle_size, rng)
+    boxes = torch.tensor(
+        [[*outline.min(0), *outline.max(0), i, 0.9, 2] for i, outline in enumerate(outlines)], dtype=torch.float32
+    )
+    gain = min(args.mask_height / args.height, args.mask_width / args.width)
+    pad = np.array([(args.mask_width - args.width * gain) / 2, (args.mask_height - args.height * gain) / 2])
+    masks = np.zeros((len(outlines), args.mask_height, args.mask_width), dtype=np.uint8)
+    for mask, outline in zip(masks, outlines):
+        cv2.fillPoly(mask, [np.round(outline * gain + pad).astype(np.int32)], 1)
+    result = Results(frame, "frame", {2: "car"}, boxes=boxes, masks=torch.from_numpy(masks).float())
+
+    renderer = OverlayRenderer()
+    mask_renderer = OverlayRenderer(draw_masks=True)
+    print(f"{args.spaces} spaces, {args.vehicles} vehicles, {args.width}x{args.height} frame, {args.repeat} runs")
+    base, base95 = timeit(lambda: result.plot(), args.repeat)
+    report("plot", base, base95)
+    report("plot inplace", *timeit(lambda: draw_results(result, frame), args.repeat), baseline=base)
+    report("overlay", *timeit(lambda: renderer.render(frame, result, spaces), args.repeat), baseline=base)
+    report("with masks", *timeit(lambda: mask_renderer.render(frame, result, spaces), args.repeat), baseline=base)
+    report("layer build", *timeit(lambda: (setattr(renderer, "_signature", None), renderer.render(frame, None, spaces)), args.repeat))
+
+
+def bench_roi(args) -> None:
+    from ultralytics import YOLO
+    from script import RoiCropper
+
+    model = YOLO(args.model)
+    rng = np.random.default_rng(args.seed)
+    frame = rng.integers(0, 256, (args.height, args.width, 3), dtype=np.uint8)
+    # a lot along the bottom of the frame, sky and buildings above it
+    lot_height = int(args.height * args.lot)
+    spaces = make_spaces(args.spaces, args.width // 2, lot_height)
+    for space in spaces:
+        space.selection_list = [[x + args.width // 4, y + args.height - lot_height] for x, y in space.selection_list]
+    cropper = RoiCropper(margin=args.margin, max_crops=args.max_crops)
+    crops = cropper.crops(frame, spaces)
+    pixels = sum(crop.shape[0] * crop.shape[1] for crop in crops)
+    print(
+        f"{args.model}, {args.width}x{args.height} frame, {len(crops)} crops over "
+        f"{pixels / (args.width * args.height):.0%} of it, {args.repeat} runs"
+    )
+    base, base95 = timeit(lambda: model.predict(frame, verbose=False), args.repeat)
+    report("full frame", base, base95)
+    report("roi", *timeit(lambda: cropper.merge(frame, model.predict(crops, verbose=False)), args.repeat), baseline=base)
+    for imgsz in args.imgsz:
+        predict = lambda: cropper.merge(frame, model.predict(crops, imgsz=imgsz, verbose=False))
+        report(f"roi {imgsz}", *timeit(predict, args.repeat), baseline=base)
+
+
+def box_iou(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    w = np.clip(np.minimum(a[:, None, 2], b[None, :, 2]) - np.maximum(a[:, None, 0], b[None, :, 0]), 0, None)
+    h = np.clip(np.minimum(a[:, None, 3], b[None, :, 3]) - np.maximum(a[:, None, 1], b[None, :, 1]), 0, None)
+    inter = w * h
+    areas_a = (a[:, 2] - a[:, 0]) * (a[:, 3] - a[:, 1])
+    areas_b = (b[:, 2] - b[:, 0]) * (b[:, 3] - b[:, 1])
+    return inter / (areas_a[:, None] + areas_b[None, :] - inter)
+
+
+def match(reference: np.ndarray, detections: np.ndarray, threshold: float = 0.5) -> List[float]:
+    """IoUs of the detections matched one to one to a reference ``(xyxy, conf, cls)`` of the same class."""
+    if not len(reference) or not len(detections):
+        return []
+    iou = box_iou(reference[:, :4], detections[:, :4])
+    iou[reference[:, None, 5] != detections[None, :, 5]] = 0
+    ious = []
+    for i in np.argsort(-reference[:, 4]):
+        j = int(np.argmax(iou[i]))
+        if iou[i, j] >= threshold:
+            ious.append(float(iou[i, j]))
+            iou[:, j] = 0
+    return ious
+
+
+def bench_backends(args) -> None:
+    from backends import load_model
+
+    vcap = cv2.VideoCapture(args.clip)
+    frames = []
+    while len(frames) < args.frames:
+        ret, frame = vcap.read()
+        if not ret:
+            break
+        frames.append(frame)
+    vcap.release()
+
+    classes = args.classes or None
+
+    def run(model):
+        model.predict(frames[0], classes=classes, verbose=False)
+        detections, times = [], []
+        for frame in frames:
+            start = time.perf_counter()
+            result = model.predict(frame, classes=classes, verbose=False)[0]
+            times.append((time.perf_counter() - start) * 1000)
+            detections.append(result.boxes.data.cpu().numpy())
+        return detections, float(np.median(times)), float(np.percentile(times, 95))
+
+    print(f"{len(frames)} frames of {args.clip}, {args.threads or 'default'} threads, accuracy against {args.weights}")
+    reference, base, base95 = run(load_model(args.weights, threads=args.threads))
+    report(os.path.basename(args.weights), base, base95)
+    n_reference = sum(len(boxes) for boxes in reference)
+    for path in args.models:
+        detections, p50, p95 = run(load_model(path, threads=args.threads, imgsz=args.imgsz))
+        ious = [iou for ref, boxes in zip(reference, detections) for iou in match(ref, boxes)]
+        n_detections = sum(len(boxes) for boxes in detections)
+        report(os.path.basename(os.path.normpath(path)), p50, p95, baseline=base)
+        print(
+            f"{'':<12} precision {len(ious) / max(n_detections, 1):.3f}   recall {len(ious) / max(n_reference, 1):.3f}"
+            f"   box IoU {np.mean(ious) if ious else 0:.3f}"
+        )
+
+
+class RecordedResponse:
+    """The part of a ``requests.Response`` that ``RecordReporter`` reads."""
+    status_code = 200
+
+    def __init__(self, body: dict) -> None:
+        self._body = body
+        self.text = json.dumps(body)
+
+    def json(self) -> dict:
+        return self._body
+
+
+class RecordingSession:
+    """Stands in for the API session of a ``RecordReporter``: keeps the bulk events in memory
+    and answers every enter with a new record id, like ``/api/records/bulk/`` does."""
+    def __init__(self) -> None:
+        self.events: List[dict] = []
+        self._next_id = 1
+
+    def post(self, url: str, json: dict = None, timeout: float = None) -> RecordedResponse:
+        records = {}
+        for event in json["events"]:
+            if event["type"] == "enter":
+                records[event["key"]] = self._next_id
+                self._next_id += 1
+        self.events.extend(json["events"])
+        return RecordedResponse({"records": records})
+
+
+class ReplayDetector(OccupationDetector):
+    """``OccupationDetector`` with fixed selections and no API or websocket."""
+    def __init__(self, selections: List[dict], *args, **kwargs) -> None:
+        self._fixed_selections = selections
+        super().__init__("ws://replay", *args, **kwargs)
+
+    def _register(self, location: str, stream_url: str) -> None:
+        pass
+
+    def _fetch_selections(self):
+        return 0, self._fixed_selections
+
+    def start(self) -> None:
+        pass
+
+
+def load_selections(path: str) -> List[dict]:
+    """Selections from a saved ``/api/cams/<id>/`` response."""
+    with open(path) as f:
+        camera = json.load(f)
+    return [
+        {"id": str(space["id"]), "pts": [(point["x"], point["y"]) for point in space["selection"]]}
+        for space in camera["parking_spaces"]
+    ]
+
+
+def bench_replay(args) -> None:
+    import psutil
+    from backends import StreamTracker, load_model
+    from pipeline import FramePool
+    from script import OverlayRenderer, RoiCropper
+
+    # the stack logs every space and evaluation at INFO
+    logging.getLogger().setLevel(logging.WARNING)
+    vcap = cv2.VideoCapture(args.clip, cv2.CAP_FFMPEG)
+    width = args.width or int(vcap.get(cv2.CAP_PROP_FRAME_WIDTH))
+    height = args.height or int(vcap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    fps = int(vcap.get(cv2.CAP_PROP_FPS)) or 30
+    if args.selections:
+        selections = load_selections(args.selections)
+    else:
+        selections = [{"id": str(space.id), "pts": space.selection_list} for space in make_spaces(args.spaces, width, height)]
+
+    model = load_model(args.model, threads=args.threads)
+    session = RecordingSession()
+    reporter = RecordReporter("http://replay", session=session)
+    reporter.start()
+    detector = ReplayDetector(selections, threshold=0.6, model=model, eval_mode=args.eval_mode, reporter=reporter)
+    tracker = StreamTracker()
+    renderer = OverlayRenderer(draw_masks=args.masks)
+    cropper = RoiCropper() if args.roi else None
+    predict_args = {"imgsz": args.imgsz} if args.imgsz else {}
+    classes = args.classes or None
+    pool = FramePool((height, width, 3), 1)
+    if shutil.which(args.ffmpeg):
+        command = [
+            args.ffmpeg, "-loglevel", "error", "-f", "rawvideo", "-s", f"{width}x{height}", "-pixel_format", "bgr24",
+            "-r", f"{fps}", "-i", "-", "-pix_fmt", "yuv420p", "-c:v", "libx264", "-f", "null", "-",
+        ]
+    else:
+        # still measures the pipe, without the encoding cost
+        print(f"{args.ffmpeg} not found, encoding to cat")
+        command = ["cat"]
+    encoder = sp.Popen(command, stdin=sp.PIPE, stdout=sp.DEVNULL)
+
+    stages = ("capture", "infer", "track", "eval", "overlay", "encode")
+    times = {stage: [] for stage in stages}
+    process = psutil.Process()
+    rss = []
+    cpu_start = sum(process.cpu_times())
+    wall_start = time.perf_counter()
+    while len(times["capture"]) < args.frames:
+        start = time.perf_counter()
+        buffer = pool.acquire()
+        ret, frame = vcap.read(buffer)
+        if not ret:
+            break
+        if frame.shape[:2] != (height, width):
+            frame = cv2.resize(frame, (width, height), dst=buffer)
+        marks = [start, time.perf_counter()]
+        spaces = detector.parking_spaces
+        if cropper is None:
+            result = model.predict(frame, classes=classes, verbose=False, **predict_args)[0]
+        else:
+            crops = cropper.crops(frame, spaces)
+            result = cropper.merge(frame, model.predict(crops, classes=classes, verbose=False, **predict_args))
+        marks.append(time.perf_counter())
+        result = tracker.update(result)
+        marks.append(time.perf_counter())
+        detector._eval_vehicles([result])
+        marks.append(time.perf_counter())
+        renderer.render(frame, result, spaces)
+        marks.append(time.perf_counter())
+        encoder.stdin.write(frame.data)
+        marks.append(time.perf_counter())
+        pool.release(frame)
+        for stage, begin, end in zip(stages, marks, marks[1:]):
+            times[stage].append((end - begin) * 1000)
+        rss.append(process.memory_info().rss)
+    elapsed = time.perf_counter() - wall_start
+    vcap.release()
+    encoder.stdin.close()
+    encoder.wait()
+    reporter.stop()
+    cpu = sum(process.cpu_times()) - cpu_start
+
+    n_frames = len(times["capture"])
+    if not n_frames:
+        print(f"Could not read {args.clip}")
+        return
+    total = np.sum([times[stage] for stage in stages], axis=0)
+    summary = {
+        "frames": n_frames,
+        "resolution": f"{width}x{height}",
+        "spaces": len(selections),
+        "model": args.model,
+        "fps": n_frames / elapsed,
+        "cpu_percent": 100 * cpu / elapsed,
+        "rss_mb": {"peak": max(rss) / 2 ** 20, "last": rss[-1] / 2 ** 20},
+        "records": {kind: sum(event["type"] == kind for event in session.events) for kind in ("enter", "exit")},
+        "stages_ms": {
+            stage: dict(zip(("p50", "p95", "p99"), np.percentile(samples, (50, 95, 99)).tolist()))
+            for stage, samples in list(times.items()) + [("total", total)]
+        },
+    }
+    if args.json:
+        print(json.dumps(summary, indent=2))
+        return
+    print(f"{n_frames} frames of {args.clip} at {width}x{height}, {len(selections)} spaces, {args.model}")
+    for stage, percentiles in summary["stages_ms"].items():
+        print(f"{stage:<12} " + "   ".join(f"{name} {value:9.3f} ms" for name, value in percentiles.items()))
+    print(
+        f"{summary['fps']:.1f} FPS   CPU {summary['cpu_percent']:.0f}%   "
+        f"RSS peak {summary['rss_mb']['peak']:.0f} MB, last {summary['rss_mb']['last']:.0f} MB   "
+        f"records {summary['records']['enter']} entered, {summary['records']['exit']} left"
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Offline benchmarks for the inference runtime")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    eval_parser = subparsers.add_parser("eval", help="compare occupancy evaluation engines on synthetic data")
+    eval_parser.add_argument("--spaces", type=int, default=300)
+    eval_parser.add_argument("--vehicles", type=int, default=40)
+    eval_parser.add_argument("--width", type=int, default=1920)
+    eval_parser.add_argument("--height", type=int, default=1080)
+    eval_parser.add_argument("--mask-width", type=int, default=640)
+    eval_parser.add_argument("--mask-height", type=int, default=384)
+    eval_parser.add_argument("--vehicle-size", type=float, default=40)
+    eval_parser.add_argument("--repeat", type=int, default=20)
+    eval_parser.add_argument("--seed", type=int, default=0)
+    eval_parser.set_defaults(func=bench_eval)
+
+    batch_parser = subparsers.add_parser("batch", help="per frame latency of batched inference over several streams")
+    batch_parser.add_argument("--model", default="yolov8n-seg.pt", help="weights, or a model yaml for random weights")
+    batch_parser.add_argument("--streams", type=int, nargs="+", default=[1, 2, 4, 8])
+    batch_parser.add_argument("--width", type=int, default=1920)
+    batch_parser.add_argument("--height", type=int, default=1080)
+    batch_parser.add_argument("--repeat", type=int, default=10)
+    batch_parser.add_argument("--seed", type=int, default=0)
+    batch_parser.set_defaults(func=bench_batch)
+
+    frames_parser = subparsers.add_parser("frames", help="compare the copying and zero-copy frame paths")
+    frames_parser.add_argument("--frames", type=int, default=150)
+    frames_parser.add_argument("--width", type=int, default=1920)
+    frames_parser.add_argument("--height", type=int, default=1080)
+    frames_parser.add_argument("--vehicles", type=int, default=20)
+    frames_parser.add_argument("--masks", action="store_true", help="also draw segmentation masks")
+    frames_parser.add_argument("--mask-width", type=int, default=640)
+    frames_parser.add_argument("--mask-height", type=int, default=384)
+    frames_parser.add_argument("--seed", type=int, default=0)
+    frames_parser.set_defaults(func=bench_frames)
+
+    overlay_parser = subparsers.add_parser("overlay", help="compare results.plot() with the overlay renderer")
+    overlay_parser.add_argument("--spaces", type=int, default=60)
+    overlay_parser.add_argument("--vehicles", type=int, default=20)
+    overlay_parser.add_argument("--width", type=int, default=1920)
+    overlay_parser.add_argument("--height", type=int, default=1080)
+    overlay_parser.add_argument("--mask-width", type=int, default=640)
+    overlay_parser.add_argument("--mask-height", type=int, default=384)
+    overlay_parser.add_argument("--vehicle-size", type=float, default=60)
+    overlay_parser.add_argument("--repeat", type=int, default=20)
+    overlay_parser.add_argument("--seed", type=int, default=0)
+    overlay_parser.set_defaults(func=bench_overlay)
+
+    roi_parser = subparsers.add_parser("roi", help="compare full frame inference with the parking space crops")
+    roi_parser.add_argument("--model", default="yolov8n-seg.pt", help="weights, or a model yaml for random weights")
+    roi_parser.add_argument("--spaces", type=int, default=40)
+    roi_parser.add_argument("--lot", type=float, default=0.4, help="share of the frame height holding the spaces")
+    roi_parser.add_argument("--margin", type=float, default=0.5)
+    roi_parser.add_argument("--max-crops", type=int, default=1)
+    roi_parser.add_argument("--imgsz", type=int, nargs="*", default=[480, 320])
+    roi_parser.add_argument("--width", type=int, default=1920)
+    roi_parser.add_argument("--height", type=int, default=1080)
+    roi_parser.add_argument("--repeat", type=int, default=10)
+    roi_parser.add_argument("--seed", type=int, default=0)
+    roi_parser.set_defaults(func=bench_roi)
+
+    backends_parser = subparsers.add_parser("backends", help="compare exported models with the .pt weights on a recorded clip")
+    backends_parser.add_argument("clip", help="recorded video of a camera")
+    backends_parser.add_argument("models", nargs="+", help="exported .onnx files or _openvino_model directories")
+    backends_parser.add_argument("--weights", default="yolov8n-seg.pt", help="reference weights run on ultralytics")
+    backends_parser.add_argument("--frames", type=int, default=100)
+    backends_parser.add_argument("--threads", type=int, default=None)
+    backends_parser.add_argument("--imgsz", type=int, default=None, help="input size of dynamic models")
+    backends_parser.add_argument("--classes", type=int, nargs="*", default=[2, 7], help="car and truck by default, empty for all")
+    backends_parser.set_defaults(func=bench_backends)
+
+    replay_parser = subparsers.add_parser("replay", help="replay a recorded clip through the full stack without the API")
+    replay_parser.add_argument("clip", help="recorded video of a camera")
+    replay_parser.add_argument("--model", default="yolov8n-seg.pt", help=".pt weights, .onnx or _openvino_model directory")
+    replay_parser.add_argument("--selections", help="saved /api/cams/<id>/ response, a grid of --spaces otherwise")
+    replay_parser.add_argument("--spaces", type=int, default=60)
+    replay_parser.add_argument("--width", type=int, default=None, help="resize the clip, its own size by default")
+    replay_parser.add_argument("--height", type=int, default=None)
+    replay_parser.add_argument("--frames", type=int, default=300)
+    replay_parser.add_argument("--threads", type=int, default=None)
+    replay_parser.add_argument("--imgsz", type=int, default=None)
+    replay_parser.add_argument("--roi", action="store_true", help="infer only the regions around the spaces")
+    replay_parser.add_argument("--eval-mode", choices=("polygon", "raster"), default="polygon")
+    replay_parser.add_argument("--masks", action="store_true", help="draw the masks in the overlay")
+    replay_parser.add_argument("--classes", type=int, nargs="*", default=[2, 7], help="car and truck by default, empty for all")
+    replay_parser.add_argument("--ffmpeg", default="ffmpeg")
+    replay_parser.add_argument("--json", action="store_true", help="print the summary as JSON, e.g. to compare in CI")
+    replay_parser.set_defaults(func=bench_replay)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
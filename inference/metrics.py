@@ -0,0 +1,109 @@
+import logging
+import time
+from contextlib import contextmanager
+from typing import List, Tuple
+
+from prometheus_client import Counter, Histogram, start_http_server
+from prometheus_client.core import REGISTRY, CounterMetricFamily, GaugeMetricFamily
+
+# from sub-millisecond overlays to seconds of CPU inference
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+STAGE_SECONDS = Histogram(
+    "parking_stage_seconds", "Time a frame spends in each stage", ["camera", "stage"], buckets=LATENCY_BUCKETS
+)
+BATCH_SECONDS = Histogram("parking_inference_batch_seconds", "Time of one model call over a batch", buckets=LATENCY_BUCKETS)
+BATCH_FRAMES = Histogram("parking_inference_batch_frames", "Frames in one model call", buckets=(1, 2, 4, 8, 16, 32, 64))
+FRAMES = Counter("parking_frames", "Frames taken by the inference runtime, inferred or skipped", ["camera", "outcome"])
+OCCUPANCY_CHANGE_SECONDS = Histogram(
+    "parking_occupancy_change_seconds",
+    "Time from the first motion in a parking space to the change of its occupancy",
+    ["camera"],
+    buckets=(0.5, 1.0, 2.5, 5.0, 7.5, 10.0, 15.0, 20.0, 30.0, 60.0),
+)
+
+
+class StageMetrics:
+    """The metrics of one camera, with the labelled children resolved once
+    instead of on every frame."""
+    def __init__(self, camera) -> None:
+        self.camera = str(camera)
+        self._stages = {}
+        self._frames = {}
+        self._occupancy_change = OCCUPANCY_CHANGE_SECONDS.labels(self.camera)
+
+    def observe(self, stage: str, seconds: float) -> None:
+        child = self._stages.get(stage)
+        if child is None:
+            child = self._stages[stage] = STAGE_SECONDS.labels(self.camera, stage)
+        child.observe(seconds)
+
+    @contextmanager
+    def time(self, stage: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start)
+
+    def frame(self, outcome: str) -> None:
+        child = self._frames.get(outcome)
+        if child is None:
+            child = self._frames[outcome] = FRAMES.labels(self.camera, outcome)
+        child.inc()
+
+    def occupancy_change(self, seconds: float) -> None:
+        self._occupancy_change.observe(seconds)
+
+
+class RuntimeCollector:
+    """Exposes what the streams and the reporter count anyway.
+
+    Queue depths, drops and lags, reconnects, ffmpeg restarts, vehicles per parking
+    space and the reporting backlog are read from their owners on each scrape,
+    so none of them costs anything per frame. Counters that live in the decode
+    and encode processes reach this one through shared memory values.
+    """
+    def __init__(self) -> None:
+        self._streams: List[Tuple[str, object]] = []
+        self._reporters = []
+
+    def add_stream(self, camera, stream) -> None:
+        self._streams.append((str(camera), stream))
+
+    def add_reporter(self, reporter) -> None:
+        self._reporters.append(reporter)
+
+    def collect(self):
+        depth = GaugeMetricFamily("parking_queue_frames", "Frames waiting in a stream queue", labels=["camera", "queue"])
+        dropped = CounterMetricFamily("parking_dropped_frames", "Frames dropped by a stream queue", labels=["camera", "queue"])
+        lag = GaugeMetricFamily("parking_queue_lag_seconds", "Time the last frame taken waited in a stream queue", labels=["camera", "queue"])
+        reconnects = CounterMetricFamily("parking_capture_reconnects", "Reconnections to the camera", labels=["camera"])
+        restarts = CounterMetricFamily("parking_ffmpeg_restarts", "Restarts of the ffmpeg encoder", labels=["camera"])
+        vehicles = GaugeMetricFamily("parking_space_vehicles", "Vehicles in a parking space", labels=["camera", "space"])
+        for camera, stream in self._streams:
+            stats = stream.stats()
+            for name, queue in stats.items():
+                if isinstance(queue, dict):
+                    depth.add_metric([camera, name], queue["depth"])
+                    dropped.add_metric([camera, name], queue["dropped"])
+                    if "lag" in queue:
+                        lag.add_metric([camera, name], queue["lag"])
+            reconnects.add_metric([camera], stats["reconnects"])
+            restarts.add_metric([camera], stats["ffmpeg_restarts"])
+            for space in stream.parking_spaces:
+                vehicles.add_metric([camera, str(space.id)], space.occupants)
+        yield from (depth, dropped, lag, reconnects, restarts, vehicles)
+
+        backlog = GaugeMetricFamily("parking_reporter_backlog", "Record events not sent to the API yet")
+        lost = CounterMetricFamily("parking_reporter_dropped_events", "Record events dropped on a full reporter queue")
+        backlog.add_metric([], sum(reporter.backlog for reporter in self._reporters))
+        lost.add_metric([], sum(reporter.dropped for reporter in self._reporters))
+        yield from (backlog, lost)
+
+
+def start_metrics_server(port: int, collector: RuntimeCollector) -> None:
+    """Serves ``/metrics`` on ``port`` from a daemon thread."""
+    REGISTRY.register(collector)
+    start_http_server(port)
+    logging.log(logging.INFO, f"Serving metrics on port {port}")
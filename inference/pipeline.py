@@ -0,0 +1,570 @@
+import copy
+import logging
+import multiprocessing as mp
+import queue
+import select
+import subprocess as sp
+import threading
+import time
+import traceback
+from collections import deque
+from multiprocessing import shared_memory
+from typing import List, Optional, Tuple
+
+import cv2
+import numpy as np
+
+DROP_POLICIES = ("block", "drop_oldest", "drop_newest")
+# "encode" streams the annotated frames, "metadata" relays the source untouched and
+# publishes the overlay geometry instead, "none" has no output at all
+OUTPUT_MODES = ("encode", "metadata", "none")
+# "opencv" decodes with cv2.VideoCapture at the source size, "ffmpeg" with an ffmpeg
+# process that drops and scales the frames before they reach Python
+CAPTURE_BACKENDS = ("opencv", "ffmpeg")
+# seconds an FfmpegReader waits for a frame, like the interrupt timeout of OpenCV's ffmpeg backend
+READ_TIMEOUT = 30.0
+
+# workers must not fork the inference process, it holds the model, CUDA and
+# the websocket/reporter threads
+mp_context = mp.get_context("spawn")
+
+
+def ffmpeg_command(
+    ffmpeg_cmd: str,
+    width: int,
+    height: int,
+    fps: int,
+    output_url: str,
+    codec: str = "libx264",
+    preset: str = "veryfast",
+    tune: str = "zerolatency",
+    output_size: Tuple[int, int] = None,
+) -> List[str]:
+    """Encodes raw bgr24 frames from stdin to ``output_url``.
+
+    The frames are paced by the caller (``YoloRTSP._send_loop`` or
+    ``encode_worker``), so the input is not throttled again with ``-re``.
+    ``codec`` can be a hardware encoder such as ``h264_nvenc``, whose presets
+    and tunes have their own names (e.g. ``p1`` and ``ll``); an empty
+    ``preset`` or ``tune`` leaves the encoder default. ``output_size`` scales
+    the output to ``(width, height)``.
+    """
+    command = [
+        ffmpeg_cmd,
+        "-f",
+        "rawvideo",
+        "-s",
+        f"{width}x{height}",
+        "-pixel_format",
+        "bgr24",
+        "-r",
+        f"{fps}",
+        "-i",
+        "-",
+    ]
+    if output_size is not None and tuple(output_size) != (width, height):
+        command += ["-vf", f"scale={output_size[0]}:{output_size[1]}"]
+    command += ["-pix_fmt", "yuv420p", "-c:v", codec]
+    if preset:
+        command += ["-preset", preset]
+    if tune:
+        command += ["-tune", tune]
+    command += [
+        "-bufsize",
+        "64M",
+        "-maxrate",
+        "4M",
+        "-rtsp_transport",
+        "tcp",
+        "-f",
+        "rtsp",
+        output_url,
+    ]
+    return command
+
+
+def relay_command(ffmpeg_cmd: str, input_url: str, output_url: str) -> List[str]:
+    """Re-streams ``input_url`` to ``output_url`` without decoding it."""
+    command = [ffmpeg_cmd]
+    if input_url.startswith("rtsp"):
+        command += ["-rtsp_transport", "tcp"]
+    else:
+        # files and http sources are read as fast as possible otherwise
+        command += ["-re"]
+    return command + ["-i", input_url, "-c", "copy", "-rtsp_transport", "tcp", "-f", "rtsp", output_url]
+
+
+class Backoff:
+    """Reconnection delays that start at ``initial`` seconds and grow by ``factor``
+    up to ``maximum``, until ``reset`` after a successful read."""
+    def __init__(self, initial: float = 0.5, maximum: float = 30.0, factor: float = 2.0) -> None:
+        self.initial = initial
+        self.maximum = maximum
+        self.factor = factor
+        self._delay = initial
+
+    def next(self) -> float:
+        delay, self._delay = self._delay, min(self._delay * self.factor, self.maximum)
+        return delay
+
+    def reset(self) -> None:
+        self._delay = self.initial
+
+
+class FfmpegReader:
+    """Decodes ``url`` in an ffmpeg process, with the ``cv2.VideoCapture`` calls the streams use.
+
+    ffmpeg drops frames down to ``fps`` and scales them to ``width`` x ``height``
+    before writing raw bgr24 frames to a pipe, and ``read`` fills the caller's
+    buffer straight from it, so frames that would be thrown away are never
+    decoded to full size in Python. ``hwaccel`` is passed to ``-hwaccel``, e.g.
+    ``auto`` to decode on whatever the host has.
+
+    A source that stalls without closing the connection makes ``read`` fail
+    after ``timeout`` seconds without a frame, so the caller reconnects.
+    """
+    def __init__(
+        self,
+        url: str,
+        width: int,
+        height: int,
+        fps: float = None,
+        ffmpeg_cmd: str = "ffmpeg",
+        hwaccel: str = None,
+        timeout: float = READ_TIMEOUT,
+    ) -> None:
+        self.shape = (height, width, 3)
+        self.timeout = timeout
+        self._size = height * width * 3
+        self._scratch = None
+        command = [ffmpeg_cmd, "-loglevel", "error", "-nostdin"]
+        if url.startswith("rtsp"):
+            command += ["-rtsp_transport", "tcp"]
+        if hwaccel:
+            command += ["-hwaccel", hwaccel]
+        filters = ([f"fps={fps}"] if fps else []) + [f"scale={width}:{height}"]
+        command += ["-i", url, "-vf", ",".join(filters), "-f", "rawvideo", "-pix_fmt", "bgr24", "-"]
+        # unbuffered, so waiting on the pipe never misses a frame already read into a buffer
+        self._process = sp.Popen(command, stdin=sp.DEVNULL, stdout=sp.PIPE, bufsize=0)
+
+    def isOpened(self) -> bool:
+        return self._process is not None and self._process.poll() is None
+
+    def read(self, buffer: np.ndarray = None) -> Tuple[bool, Optional[np.ndarray]]:
+        if buffer is None or buffer.shape != self.shape or not buffer.flags.c_contiguous:
+            buffer = np.empty(self.shape, dtype=np.uint8)
+        view = memoryview(buffer.reshape(-1))
+        read = 0
+        deadline = time.monotonic() + self.timeout
+        while read < self._size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or not select.select([self._process.stdout], [], [], remaining)[0]:
+                logging.log(logging.ERROR, f"No frame from ffmpeg within {self.timeout} s")
+                return False, None
+            n = self._process.stdout.readinto(view[read:])
+            if not n:
+                return False, None
+            read += n
+        return True, buffer
+
+    def grab(self) -> bool:
+        if self._scratch is None:
+            self._scratch = np.empty(self.shape, dtype=np.uint8)
+        return self.read(self._scratch)[0]
+
+    def release(self) -> None:
+        if self._process is not None:
+            self._process.kill()
+            self._process.wait()
+            self._process.stdout.close()
+            self._process = None
+
+
+def open_capture(
+    url: str, backend: str = "opencv", width: int = None, height: int = None, fps: float = None, ffmpeg_cmd: str = "ffmpeg"
+):
+    """A ``cv2.VideoCapture``, or an ``FfmpegReader`` that already outputs ``width`` x ``height`` at ``fps``."""
+    if backend not in CAPTURE_BACKENDS:
+        raise ValueError(f"backend must be one of {CAPTURE_BACKENDS}, but got {backend}")
+    if backend == "ffmpeg":
+        return FfmpegReader(url, width, height, fps=fps, ffmpeg_cmd=ffmpeg_cmd)
+    return cv2.VideoCapture(url, cv2.CAP_FFMPEG)
+
+
+class FramePool:
+    """Preallocated frames for a single process, so capture can read into reused
+    arrays instead of allocating a new one per frame.
+
+    ``acquire`` returns None when every frame is in use; frames go back with
+    ``release`` once nothing reads them anymore.
+    """
+    def __init__(self, shape: Tuple[int, int, int], size: int) -> None:
+        self.shape = tuple(shape)
+        self._frames = np.zeros((size,) + self.shape, dtype=np.uint8)
+        self._free = deque(self._frames[i] for i in range(size))
+
+    def acquire(self) -> Optional[np.ndarray]:
+        try:
+            return self._free.popleft()
+        except IndexError:
+            return None
+
+    def release(self, frame: np.ndarray) -> None:
+        if frame is not None and frame.base is self._frames:
+            self._free.append(frame)
+
+
+class FrameMailbox:
+    """Single slot that hands the newest frame from one thread to another.
+
+    ``put`` never blocks: it replaces the frame nobody has taken yet and returns
+    it to the producer, which counts as a drop. ``get`` takes the newest frame
+    with its sequence number, so a consumer sees from the gaps which frames it
+    skipped; ``lag`` is how long the last frame taken waited in the slot. The
+    lock only guards swapping the slot, never a read, inference or write.
+    """
+    def __init__(self) -> None:
+        self._condition = threading.Condition()
+        self._frame = None
+        self._put_time = 0.0
+        self._seq = 0
+        self._dropped = 0
+        self.lag = 0.0
+
+    @property
+    def depth(self) -> int:
+        return int(self._frame is not None)
+
+    @property
+    def dropped(self) -> int:
+        return self._dropped
+
+    @property
+    def published(self) -> int:
+        return self._seq
+
+    def stats(self) -> dict:
+        return {"depth": self.depth, "published": self.published, "dropped": self.dropped, "lag": self.lag}
+
+    def put(self, frame: np.ndarray) -> Optional[np.ndarray]:
+        """Publishes ``frame`` and returns the unread frame it replaced, if any."""
+        with self._condition:
+            previous, self._frame = self._frame, frame
+            self._put_time = time.monotonic()
+            self._seq += 1
+            if previous is not None:
+                self._dropped += 1
+            self._condition.notify()
+        return previous
+
+    def get(self, timeout: float = None) -> Optional[Tuple[np.ndarray, int]]:
+        """The newest ``(frame, seq)``, waiting up to ``timeout`` for one, or None."""
+        with self._condition:
+            if not self._condition.wait_for(lambda: self._frame is not None, timeout):
+                return None
+            frame, self._frame = self._frame, None
+            self.lag = time.monotonic() - self._put_time
+            return frame, self._seq
+
+    def take_back(self) -> Optional[np.ndarray]:
+        """The unread frame for the producer to reuse, counted as dropped."""
+        with self._condition:
+            frame, self._frame = self._frame, None
+            if frame is not None:
+                self._dropped += 1
+        return frame
+
+
+class FrameRing:
+    """Fixed pool of BGR frames in shared memory, handed between processes by slot index.
+
+    Producers ``acquire`` a free slot, fill ``frame(slot)`` in place and
+    ``publish`` it; consumers ``get`` the oldest published slot and ``release``
+    it when done. Only ``(slot, timestamp)`` descriptors go through the queues.
+
+    When every slot is taken the producer follows ``policy``: ``block`` waits
+    for a release, ``drop_newest`` skips the new frame and ``drop_oldest``
+    takes back the oldest published frame that no consumer has picked up yet.
+    A ``max_depth`` bounds the published frames, publishing over it releases
+    the oldest one.
+    """
+    def __init__(self, shape: Tuple[int, int, int], slots: int = 4, policy: str = "drop_oldest", max_depth: int = None) -> None:
+        if policy not in DROP_POLICIES:
+            raise ValueError(f"policy must be one of {DROP_POLICIES}, but got {policy}")
+        if slots < 2:
+            raise ValueError(f"a ring needs at least 2 slots, but got {slots}")
+        self.shape = tuple(shape)
+        self.slots = slots
+        self.policy = policy
+        self.max_depth = max_depth
+        self._shm = shared_memory.SharedMemory(create=True, size=int(np.prod(self.shape)) * slots)
+        self._owner = True
+        self._free = mp_context.Queue()
+        self._ready = mp_context.Queue()
+        for slot in range(slots):
+            self._free.put(slot)
+        self._published = mp_context.Value("Q", 0)
+        self._dropped = mp_context.Value("Q", 0)
+        self._frames = np.ndarray((slots,) + self.shape, dtype=np.uint8, buffer=self._shm.buf)
+
+    def stage(self, max_depth: int = None) -> "FrameRing":
+        """A second ready queue over the same slots and free list.
+
+        A consumer hands the slots it got from this ring to the next process by
+        publishing them to the stage, without copying the frame; whoever
+        consumes the stage releases them.
+        """
+        stage = copy.copy(self)
+        stage.policy = "drop_oldest"
+        stage.max_depth = max_depth
+        stage._owner = False
+        stage._ready = mp_context.Queue()
+        stage._published = mp_context.Value("Q", 0)
+        stage._dropped = mp_context.Value("Q", 0)
+        return stage
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_shm"], state["_frames"]
+        state["name"] = self._shm.name
+        return state
+
+    def __setstate__(self, state):
+        name = state.pop("name")
+        self.__dict__.update(state)
+        self._shm = shared_memory.SharedMemory(name=name)
+        self._owner = False
+        self._frames = np.ndarray((self.slots,) + self.shape, dtype=np.uint8, buffer=self._shm.buf)
+
+    @property
+    def depth(self) -> int:
+        return self._ready.qsize()
+
+    @property
+    def dropped(self) -> int:
+        return self._dropped.value
+
+    @property
+    def published(self) -> int:
+        return self._published.value
+
+    def stats(self) -> dict:
+        return {"policy": self.policy, "depth": self.depth, "published": self.published, "dropped": self.dropped}
+
+    def frame(self, slot: int) -> np.ndarray:
+        return self._frames[slot]
+
+    def acquire(self, timeout: float = None) -> Optional[int]:
+        """A free slot to write the next frame to, or None if the frame has to be dropped."""
+        try:
+            return self._free.get_nowait()
+        except queue.Empty:
+            pass
+        if self.policy == "drop_oldest":
+            try:
+                slot, _ = self._ready.get_nowait()
+                self._drop()
+                return slot
+            except queue.Empty:
+                pass
+        if self.policy != "drop_newest":
+            # blocking, or every slot is held by a consumer and will come back
+            try:
+                return self._free.get(timeout=timeout)
+            except queue.Empty:
+                pass
+        self._drop()
+        return None
+
+    def publish(self, slot: int) -> None:
+        if self.max_depth is not None and self._ready.qsize() >= self.max_depth:
+            try:
+                oldest, _ = self._ready.get_nowait()
+                self.release(oldest)
+                self._drop()
+            except queue.Empty:
+                pass
+        self._ready.put((slot, time.time()))
+        with self._published.get_lock():
+            self._published.value += 1
+
+    def get(self, timeout: float = None) -> Optional[Tuple[int, float]]:
+        """The oldest published ``(slot, timestamp)``, or None after ``timeout``."""
+        try:
+            return self._ready.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def get_latest(self) -> Optional[Tuple[int, float]]:
+        """The newest published ``(slot, timestamp)`` without waiting, older ones are released."""
+        latest = None
+        while True:
+            try:
+                descriptor = self._ready.get_nowait()
+            except queue.Empty:
+                return latest
+            if latest is not None:
+                self.release(latest[0])
+                self._drop()
+            latest = descriptor
+
+    def release(self, slot: int) -> None:
+        self._free.put(slot)
+
+    def close(self) -> None:
+        if self._frames is None:
+            return
+        self._frames = None
+        try:
+            self._shm.close()
+        except BufferError:
+            # frames still referenced (e.g. by results in flight), the mapping goes with the process
+            pass
+        if self._owner:
+            self._shm.unlink()
+
+    def _drop(self) -> None:
+        with self._dropped.get_lock():
+            self._dropped.value += 1
+
+
+def send_sample(samples, stage: str, seconds: float) -> None:
+    """Hands a stage latency to the parent process through the ``samples`` queue,
+    dropped when the queue is full or there is none."""
+    if samples is None:
+        return
+    try:
+        samples.put_nowait((stage, seconds))
+    except queue.Full:
+        pass
+
+
+def decode_worker(
+    input_url: str,
+    ring: FrameRing,
+    stop_event,
+    reconnect_delay: float = 1.0,
+    reconnects=None,
+    backend: str = "opencv",
+    fps: float = None,
+    ffmpeg_cmd: str = "ffmpeg",
+    max_reconnect_delay: float = 30.0,
+    samples=None,
+) -> None:
+    """Decodes ``input_url`` into ``ring``, reconnecting when the source fails
+    after ``reconnect_delay`` seconds, doubled on every failure in a row up to
+    ``max_reconnect_delay``. ``reconnects`` is an optional shared counter of the
+    reconnections, ``samples`` an optional queue for the ``capture`` latency of
+    every frame read (see ``send_sample``)."""
+    logging.basicConfig(level=logging.INFO)
+    height, width = ring.shape[:2]
+    backoff = Backoff(reconnect_delay, max_reconnect_delay)
+    vcap = open_capture(input_url, backend, width, height, fps, ffmpeg_cmd)
+    try:
+        while not stop_event.is_set():
+            slot = ring.acquire(timeout=reconnect_delay)
+            if slot is None:
+                # still read, a live source must not fall behind
+                vcap.grab()
+                continue
+            # decodes straight into shared memory when the size matches
+            buffer = ring.frame(slot)
+            start = time.perf_counter()
+            ret, frame = vcap.read(buffer)
+            if not ret:
+                ring.release(slot)
+                delay = backoff.next()
+                logging.log(logging.ERROR, f"Could not read from {input_url}, reconnecting in {delay} s")
+                vcap.release()
+                if stop_event.wait(delay):
+                    break
+                vcap = open_capture(input_url, backend, width, height, fps, ffmpeg_cmd)
+                if reconnects is not None:
+                    with reconnects.get_lock():
+                        reconnects.value += 1
+                continue
+            send_sample(samples, "capture", time.perf_counter() - start)
+            backoff.reset()
+            if frame is not buffer:
+                cv2.resize(frame, (width, height), dst=buffer)
+            ring.publish(slot)
+    except Exception:
+        traceback.print_exc()
+    finally:
+        vcap.release()
+        ring.close()
+
+
+def relay_worker(command: List[str], stop_event, restart_delay: float = 1.0, starts=None) -> None:
+    """Keeps an ffmpeg ``command`` running until ``stop_event`` is set, restarting
+    it ``restart_delay`` seconds after it exits. Runs in a thread or a process,
+    ``starts`` is an optional shared counter of the ffmpeg processes started."""
+    logging.basicConfig(level=logging.INFO)
+    process = None
+    try:
+        while not stop_event.is_set():
+            if process is None or process.poll() is not None:
+                if process is not None:
+                    logging.log(logging.ERROR, f"ffmpeg exited with {process.returncode}, restarting in {restart_delay} s")
+                    if stop_event.wait(restart_delay):
+                        break
+                logging.log(logging.INFO, f"Starting ffmpeg process with command {command}")
+                process = sp.Popen(command, stdin=sp.DEVNULL)
+                if starts is not None:
+                    with starts.get_lock():
+                        starts.value += 1
+            stop_event.wait(restart_delay)
+    except Exception:
+        traceback.print_exc()
+    finally:
+        if process is not None:
+            process.kill()
+
+
+def encode_worker(command: List[str], ring: FrameRing, fps: int, stop_event, starts=None, samples=None) -> None:
+    """Pipes the frames of ``ring`` into an ffmpeg ``command`` at ``fps``.
+
+    One frame is written per frame interval on a fixed schedule: the newest one
+    published, or the last one again when nothing new arrived. ffmpeg gets its
+    input at the ``-r`` it was told and the output keeps up with real time,
+    frames published faster than ``fps`` are dropped. ``starts`` is an optional
+    shared counter of the ffmpeg processes started, ``samples`` an optional
+    queue for the ``encode`` latency of every write."""
+    logging.basicConfig(level=logging.INFO)
+    interval = 1 / fps
+    process = None
+    last_slot = None
+    deadline = None
+    try:
+        while not stop_event.is_set():
+            descriptor = ring.get(timeout=interval) if last_slot is None else ring.get_latest()
+            if descriptor is not None:
+                if last_slot is not None:
+                    ring.release(last_slot)
+                last_slot = descriptor[0]
+            if last_slot is None:
+                continue
+            if process is None or process.poll() is not None:
+                logging.log(logging.INFO, f"Starting ffmpeg process with command {command}")
+                process = sp.Popen(command, stdin=sp.PIPE)
+                if starts is not None:
+                    with starts.get_lock():
+                        starts.value += 1
+            try:
+                start = time.perf_counter()
+                process.stdin.write(ring.frame(last_slot).data)
+                send_sample(samples, "encode", time.perf_counter() - start)
+            except BrokenPipeError:
+                logging.log(logging.ERROR, f"Broken pipe error")
+                process.kill()
+                process = None
+            # a slow write is made up by a shorter wait, after a stall the schedule starts over
+            now = time.monotonic()
+            deadline = deadline + interval if deadline is not None and now - deadline < interval else now + interval
+            stop_event.wait(max(0.0, deadline - now))
+    except Exception:
+        traceback.print_exc()
+    finally:
+        if process is not None:
+            process.kill()
+        ring.close()
@@ -4,9 +4,13 @@ import os
 import time
 import signal
 import requests
+import requests.adapters
 import subprocess as sp
 from ultralytics import YOLO
+from ultralytics.engine.results import Results
 from concurrent.futures import ThreadPoolExecutor
+import shapely
+from shapely import STRtree
 from shapely.geometry import Polygon
 from typing import List, Iterable, Union, Tuple
 from dataclasses import dataclass
@@ -19,10 +23,29 @@ import rel
 import traceback
 import threading
 import numpy as np
+import torch
+import torchvision
 import queue
 import uuid
 import datetime
 from threading import Thread
+from collections import deque
+from backends import ExportedModel, StreamTracker, load_model
+from metrics import BATCH_FRAMES, BATCH_SECONDS, RuntimeCollector, StageMetrics, start_metrics_server
+from pipeline import (
+    OUTPUT_MODES,
+    Backoff,
+    FrameMailbox,
+    FramePool,
+    FrameRing,
+    decode_worker,
+    encode_worker,
+    ffmpeg_command,
+    mp_context,
+    open_capture,
+    relay_command,
+    relay_worker,
+)
 
 logging.basicConfig(level=logging.INFO)
 
@@ -41,59 +64,194 @@ def is_valid_bgr24_image(image_array):
 
     return True
 
-def post_report(obj_id, obj_cls, parking_space, runtime):
-    url = "http://api:8000/api/records/99999999/"
-    dt = datetime.datetime.utcnow()
-    formatted_time = dt.strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3]  
-    r = requests.post(url, json={
-                            "obj_id": obj_id,
-                            "in_time": formatted_time,
-                             "obj_type": obj_cls, 
-                             "parking_space": parking_space, 
-                             "runtime": runtime}
-                             )
-    logging.error(r.json().get("details"))
-    logging.error(f"Posted report with status code {r.status_code}")
-    logging.error(r.json())
-    if r.status_code == 200:
-        r = r.json().get("id")
-        if r is not None:
-            return r
+def utc_timestamp(seconds: float = None) -> str:
+    """``seconds`` since the epoch, now by default, in the format of the API."""
+    if seconds is None:
+        dt = datetime.datetime.utcnow()
     else:
-        return None
-
-def patch_report(obj_id, obj_cls, record_id, out=False):
-    url = f"http://api:8000/api/records/{record_id}/"
-    dt = datetime.datetime.utcnow()
-    formatted_time = dt.strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3]  
-    if(out):
-        r = requests.patch(url, json={"obj_id": obj_id, "obj_cls": obj_cls, "out_time": formatted_time, "last_seen": formatted_time})
-    else:
-        r = requests.patch(url, json={"obj_id": obj_id, "obj_cls": obj_cls, "last_seen": formatted_time})
-    return r.json()
+        dt = datetime.datetime.utcfromtimestamp(seconds)
+    return dt.strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3]
+
+
+class RecordReporter:
+    """Reports parking records to the API from a background thread.
+
+    ``enter``, ``heartbeat`` and ``leave`` only timestamp the event and push it
+    to a bounded queue, so the detection loop never waits on HTTP; when the queue
+    is full the event is dropped and counted. The worker coalesces heartbeats to
+    the latest ``last_seen`` per record and flushes everything every
+    ``flush_interval`` seconds as a single request to ``/api/records/bulk/``
+    over one pooled ``requests.Session``.
+
+    Records are addressed by the client-side key returned by ``enter`` until the
+    API has mapped it to a record id. When the API is unreachable or answers with
+    a 5xx the pending events are kept and resent after a growing delay, which is
+    safe because the API deduplicates enters on their key; a 4xx drops the batch.
+    A ``session`` passed in is used as it is, e.g. one that records the batches
+    instead of sending them.
+    """
+    def __init__(
+        self,
+        api_url: str = "http://api:8000",
+        flush_interval: float = 1.0,
+        max_queue: int = 10000,
+        timeout: float = 5.0,
+        session: requests.Session = None,
+    ) -> None:
+        self._api_url = api_url.rstrip("/")
+        self._flush_interval = flush_interval
+        self._timeout = timeout
+        self._queue = queue.Queue(max_queue)
+        if session is None:
+            session = requests.Session()
+            session.mount("http://", requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=2))
+        self._session = session
+        self._record_ids: dict[str, int] = {}
+        self._enters: dict[str, dict] = {}
+        self._last_seen: dict[str, str] = {}
+        self._exits: dict[str, str] = {}
+        self._dropped = 0
+        self._backoff = Backoff(initial=flush_interval, maximum=60.0)
+        self._retry_at = 0.0
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    @property
+    def dropped(self) -> int:
+        return self._dropped
+
+    @property
+    def backlog(self) -> int:
+        return self._queue.qsize() + len(self._enters) + len(self._last_seen) + len(self._exits)
+
+    def start(self) -> None:
+        if self._thread is not None:
+            raise RuntimeError("Reporter already started - must stop before starting it again.")
+        self._stop_event.clear()
+        self._thread = Thread(target=self._run, name="record-reporter", daemon=True)
+        self._thread.start()
+        logging.log(logging.INFO, f"Started record reporter for {self._api_url}")
+
+    def stop(self, timeout: float = None) -> None:
+        if self._thread is None:
+            return
+        self._stop_event.set()
+        self._thread.join(timeout)
+        self._thread = None
+
+    def enter(self, obj_id, obj_cls, parking_space, runtime, at: float = None) -> str:
+        key = uuid.uuid4().hex
+        self._put(("enter", key, {
+            "time": utc_timestamp(at),
+            "obj_id": obj_id,
+            "obj_type": obj_cls,
+            "parking_space": parking_space,
+            "runtime": str(runtime) if runtime is not None else None,
+        }))
+        return key
+
+    def heartbeat(self, *keys: str) -> None:
+        self._put(("heartbeat", keys, utc_timestamp()))
+
+    def leave(self, key: str, at: float = None) -> None:
+        self._put(("exit", key, utc_timestamp(at)))
+
+    def _put(self, event) -> None:
+        try:
+            self._queue.put_nowait(event)
+        except queue.Full:
+            self._dropped += 1
+            logging.log(logging.WARNING, f"Record reporter queue is full, dropped {event[0]} event")
+
+    def _run(self) -> None:
+        deadline = time.monotonic() + self._flush_interval
+        while not self._stop_event.is_set():
+            try:
+                self._apply(self._queue.get(timeout=max(deadline - time.monotonic(), 0)))
+            except queue.Empty:
+                pass
+            if time.monotonic() >= deadline:
+                self._drain()
+                if time.monotonic() >= self._retry_at:
+                    self._flush()
+                deadline = time.monotonic() + self._flush_interval
+        self._drain()
+        self._flush()
+
+    def _drain(self) -> None:
+        while True:
+            try:
+                self._apply(self._queue.get_nowait())
+            except queue.Empty:
+                return
+
+    def _apply(self, event) -> None:
+        kind, key, value = event
+        if kind == "enter":
+            self._enters[key] = value
+        elif kind == "heartbeat":
+            # one event carries the heartbeats of a whole evaluation
+            self._last_seen.update(dict.fromkeys(key, value))
+        elif kind == "exit":
+            self._last_seen.pop(key, None)
+            self._exits[key] = value
+
+    def _flush(self) -> None:
+        events = [{"type": "enter", "key": key, **data} for key, data in self._enters.items()]
+        for kind, pending in (("heartbeat", self._last_seen), ("exit", self._exits)):
+            for key, time_ in pending.items():
+                if key in self._record_ids:
+                    events.append({"type": kind, "record": self._record_ids[key], "time": time_})
+                elif key in self._enters:
+                    events.append({"type": kind, "key": key, "time": time_})
+        if not events:
+            return
+        try:
+            r = self._session.post(f"{self._api_url}/api/records/bulk/", json={"events": events}, timeout=self._timeout)
+        except requests.RequestException as e:
+            self._retry(f"Could not reach the API, keeping {len(events)} pending events: {e}")
+            return
+        if r.status_code >= 500:
+            self._retry(f"API failed with {r.status_code}, keeping {len(events)} pending events")
+            return
+        self._backoff.reset()
+        self._retry_at = 0.0
+        if r.status_code == 200:
+            body = r.json()
+            self._record_ids.update(body.get("records", {}))
+            if body.get("rejected"):
+                logging.log(logging.ERROR, f"API rejected records {body['rejected']}")
+        else:
+            logging.log(logging.ERROR, f"API refused {len(events)} events, dropping them: {r.status_code} {r.text}")
+        for key in self._exits:
+            self._record_ids.pop(key, None)
+        self._enters.clear()
+        self._last_seen.clear()
+        self._exits.clear()
+
+    def _retry(self, message: str) -> None:
+        delay = self._backoff.next()
+        self._retry_at = time.monotonic() + delay
+        logging.log(logging.ERROR, f"{message}, retrying in {delay:.1f}s")
+
 
 @dataclass
 class Vehicle:
     id: int
     cls_id: float
     conf: float
-    polygon: Polygon
+    polygon: Polygon = None
 
 class ParkingSpace:
-    def __init__(self, id: str, selection: List[Iterable[float]], runtime_id=None, connect=False):
+    def __init__(self, id: str, selection: List[Iterable[float]], connect=False):
         self._id = id
-        self._runtime_id = runtime_id
         self._selection_list = []
         self._selection_polygon = Polygon()
-        self._max_inactive_tolerance = 10
-
-        self._vehicles: dict[str, Vehicle] = {}
-        self._ious: dict[str, float] = {}
-        self._starting_time: dict[str, float] = {}
-        self._last_marked_occupy: dict[str, float] = {}
+        self._version = 0
+        # set by the OccupancyStore of the camera after every evaluation
+        self._occupants = 0
 
         self.selection_list = selection
-        self._record_ids: dict[str, float] = {}
         logging.log(logging.INFO, f"Created parking space with id {self._id}")
 
     @property
@@ -106,138 +264,594 @@ class ParkingSpace:
     
     @selection_list.setter
     def selection_list(self, value: List[Iterable[float]]):
+        if value == self._selection_list and self._version > 0:
+            return
         self._selection_list = value
         self._selection_polygon = Polygon(self._selection_list)
+        self._version += 1
 
     @property
     def id(self):
         return self._id
-    
-    def _add_vehicle(self, vehicle: Vehicle, iou: float):
-        self._starting_time[vehicle.id]= time.monotonic()
-        self._record_ids[vehicle.id] = post_report(vehicle.id, vehicle.cls_id, self._id, self._runtime_id)
-        self._ious[vehicle.id] = iou
-        self._vehicles[vehicle.id] = vehicle
-        self._last_marked_occupy[vehicle.id] = time.monotonic()
-
-        logging.log(logging.INFO, f"Vehicle {vehicle.id} entered parking space {self._id}")
-
-    def _del_vehicle(self, vehicle: Vehicle):
-        patch_report(vehicle.id, vehicle.cls_id, self._record_ids[vehicle.id], out=True)
-        del self._vehicles[vehicle.id]
-        del self._ious[vehicle.id]
-        del self._starting_time[vehicle.id]
-        del self._last_marked_occupy[vehicle.id]
-        del self._record_ids[vehicle.id]
-
-        logging.log(logging.INFO, f"Vehicle {vehicle.id} left parking space {self._id}")
-    
-    def _update_vehicle(self, vehicle: Vehicle):
-        patch_report(vehicle.id, vehicle.cls_id, self._record_ids[vehicle.id], out=False)
-        self._vehicles[vehicle.id] = vehicle
-        self._last_marked_occupy[vehicle.id] = time.monotonic()
-    
-    def update_status(self):
-        for vehicle in self._vehicles.values():
-            if(self._should_delete(vehicle)):
-                self._del_vehicle(vehicle)
-    
-    def _should_delete(self, vehicle: Vehicle) -> bool:
-        return time.monotonic() - self._last_marked_occupy[vehicle.id] > self._max_inactive_tolerance
-    
-    def eval_vehicle(self, vehicle: Vehicle, threshold) -> bool:
-
-        intersection = self._selection_polygon.intersection(vehicle.polygon)
-        if(intersection.area == 0):
-            return False
 
-        key_exists = vehicle.id in self._vehicles
-
-        if intersection.area == 0:
-            return False
+    @property
+    def version(self) -> int:
+        return self._version
 
-        intersection_ratio = intersection.area / vehicle.polygon.area
-        logging.log(logging.DEBUG, f"Vehicle area: {vehicle.polygon.area}\nSelection area: {self._selection_polygon.area}\nIntersection ratio: {intersection_ratio}")
+    @property
+    def occupants(self) -> int:
+        return self._occupants
 
-        if intersection_ratio > threshold and not key_exists:
-            self._add_vehicle(vehicle, intersection_ratio)
-            return True
-        elif intersection_ratio > threshold and key_exists:
-            self._update_vehicle(vehicle)
-            return True
+    @property
+    def occupied(self) -> bool:
+        return self._occupants > 0
     
     def __export__(self):
         return {
             "id": self._id,
             "selection": self._selection_list,
-            "vehicles": list(self._vehicles.values())
+            "occupants": self._occupants,
         }
 
 
+class OccupancyStore:
+    """Occupancy of every parking space of a camera, as columns over the
+    ``(space, track id)`` pairs currently inside a space.
+
+    Each pair keeps a score, the exponential moving average of its intersection
+    ratio over ``smoothing`` seconds of the frames it was detected in, so a mask
+    that flickers or misses a few frames does not move it. A pair becomes a
+    record once its score stayed at or above the enter threshold for
+    ``enter_dwell`` seconds and leaves once it was not seen above
+    ``exit_threshold`` for ``exit_dwell`` seconds; pairs that fall under the exit
+    threshold or vanish before entering are dropped without ever being
+    reported. Entries are dated when the pair was first seen and exits when it
+    was last present, so the dwell times do not skew the records.
+
+    When a pair enters a space where another record is fading, which is what a
+    tracker ID switch on a parked vehicle looks like, it takes that record over
+    instead of closing it and opening a new one.
+
+    ``update`` runs all of that in a single vectorized pass per evaluation, only
+    entries and exits reach Python code, as a list of ``(event, space id, track id)``.
+    Spaces get a stable column index the first time they are seen, so the pairs
+    survive a rebuild of the spatial index; pairs of spaces that are no longer
+    indexed leave at once.
+    """
+    def __init__(
+        self,
+        reporter: RecordReporter = None,
+        runtime_id=None,
+        exit_threshold: float = 0.4,
+        smoothing: float = 1.0,
+        enter_dwell: float = 5.0,
+        exit_dwell: float = 10.0,
+    ) -> None:
+        self._reporter = reporter
+        self._runtime_id = runtime_id
+        self.exit_threshold = exit_threshold
+        self.smoothing = smoothing
+        self.enter_dwell = enter_dwell
+        self.exit_dwell = exit_dwell
+        self._columns: dict[str, int] = {}
+        self._space_ids: List[str] = []
+        self._indexed = None
+        self._index_columns = np.empty(0, dtype=np.int64)
+        self._indexed_mask = np.zeros(0, dtype=bool)
+        # one row per vehicle inside a space, sorted by key
+        self._key = np.empty(0, dtype=np.int64)
+        self._space = np.empty(0, dtype=np.int64)
+        self._track = np.empty(0, dtype=np.int64)
+        self._cls = np.empty(0, dtype=np.float32)
+        self._conf = np.empty(0, dtype=np.float32)
+        self._score = np.empty(0, dtype=np.float32)
+        self._entered = np.empty(0, dtype=np.float64)
+        self._last_seen = np.empty(0, dtype=np.float64)
+        # pending: since the score is at or above the enter threshold, confirmed: since it was last present
+        self._since = np.empty(0, dtype=np.float64)
+        self._confirmed = np.empty(0, dtype=bool)
+        self._record = np.empty(0, dtype=object)
+
+    def _sync(self, spaces: List[ParkingSpace]) -> None:
+        if spaces is self._indexed:
+            return
+        for space in spaces:
+            if space.id not in self._columns:
+                self._columns[space.id] = len(self._space_ids)
+                self._space_ids.append(space.id)
+        self._indexed = spaces
+        self._index_columns = np.array([self._columns[space.id] for space in spaces], dtype=np.int64)
+        self._indexed_mask = np.zeros(len(self._space_ids), dtype=bool)
+        self._indexed_mask[self._index_columns] = True
+
+    def update(
+        self,
+        spaces: List[ParkingSpace],
+        vehicles: List[Vehicle],
+        vehicle_idx: np.ndarray,
+        space_idx: np.ndarray,
+        ratios: np.ndarray,
+        threshold: float,
+        now: float = None,
+    ) -> List[Tuple[str, str, int]]:
+        """Applies the overlapping pairs of one evaluation, as returned by the
+        spatial index over ``spaces``, and returns the entries and exits.
+        ``threshold`` is the enter threshold."""
+        now = time.monotonic() if now is None else now
+        # records are dated in wall clock time
+        wall_offset = time.time() - time.monotonic()
+        exit_threshold = min(self.exit_threshold, threshold)
+        self._sync(spaces)
+        events = []
+
+        inside = ratios > exit_threshold
+        vehicle_idx, space_idx, ratios = vehicle_idx[inside], space_idx[inside], ratios[inside].astype(np.float32)
+        columns = self._index_columns[space_idx]
+        tracks = np.array([vehicles[v].id for v in vehicle_idx.tolist()], dtype=np.int64)
+        keys = (columns << 32) | (tracks & 0xFFFFFFFF)
+
+        position = np.searchsorted(self._key, keys)
+        known = position < len(self._key)
+        known[known] = self._key[position[known]] == keys[known]
+        seen = position[known]
+        alpha = 1 - np.exp(-(now - self._last_seen[seen]) / self.smoothing) if self.smoothing > 0 else 1.0
+        self._score[seen] += alpha * (ratios[known] - self._score[seen])
+        self._last_seen[seen] = now
+        self._cls[seen] = [vehicles[v].cls_id for v in vehicle_idx[known].tolist()]
+        self._conf[seen] = [vehicles[v].conf for v in vehicle_idx[known].tolist()]
+
+        # only a ratio over the enter threshold starts a pair
+        new = ~known & (ratios >= threshold)
+        if new.any():
+            keys, first = np.unique(keys[new], return_index=True)
+            added = vehicle_idx[new][first].tolist()
+            self._append(
+                keys,
+                keys >> 32,
+                tracks[new][first],
+                [vehicles[v].cls_id for v in added],
+                [vehicles[v].conf for v in added],
+                ratios[new][first],
+                now,
+            )
+
+        observed = self._last_seen == now
+        indexed = self._indexed_mask[self._space]
+        above = observed & (self._score >= threshold)
+        present = observed & (self._score >= exit_threshold) & indexed
+        pending = ~self._confirmed
+        self._since[pending & observed & ~above] = now
+        self._since[self._confirmed & present] = now
+        entering = np.flatnonzero(pending & above & indexed & (now - self._since >= self.enter_dwell))
+        fading = self._confirmed & ~present
+        leaving = fading & ((now - self._since >= self.exit_dwell) | ~indexed)
+        vanished = (now - self._last_seen > self.exit_dwell) | (observed & (self._score < exit_threshold)) | ~indexed
+        removed = (pending & vanished) | leaving
+
+        for i in entering.tolist():
+            space_id, track = self._space_ids[self._space[i]], int(self._track[i])
+            handover = np.flatnonzero(fading & (self._space == self._space[i]))
+            if len(handover):
+                previous = handover[0]
+                self._record[i] = self._record[previous]
+                fading[previous] = leaving[previous] = False
+                removed[previous] = True
+                events.append(("switch", space_id, track))
+                logging.log(logging.INFO, f"Vehicle {track} took over from vehicle {self._track[previous]} in parking space {space_id}")
+            else:
+                if self._reporter is not None:
+                    self._record[i] = self._reporter.enter(
+                        track, float(self._cls[i]), space_id, self._runtime_id, at=self._entered[i] + wall_offset
+                    )
+                events.append(("enter", space_id, track))
+                logging.log(logging.INFO, f"Vehicle {track} entered parking space {space_id}")
+        self._confirmed[entering] = True
+        # the exit dwell counts from the last presence, which for a pair that just entered is now
+        self._since[entering] = now
+
+        for i in np.flatnonzero(leaving).tolist():
+            space_id, track = self._space_ids[self._space[i]], int(self._track[i])
+            if self._record[i] is not None:
+                self._reporter.leave(self._record[i], at=self._since[i] + wall_offset)
+            events.append(("leave", space_id, track))
+            logging.log(logging.INFO, f"Vehicle {track} left parking space {space_id}")
+
+        if self._reporter is not None:
+            heartbeats = self._record[self._confirmed & present]
+            if len(heartbeats):
+                self._reporter.heartbeat(*heartbeats.tolist())
+        if removed.any():
+            self._keep(~removed)
+
+        occupants = np.bincount(self._space[self._confirmed], minlength=len(self._space_ids))[self._index_columns]
+        for space, count in zip(spaces, occupants.tolist()):
+            space._occupants = count
+        return events
+
+    def _append(self, keys, space, track, cls, conf, score, now) -> None:
+        n = len(keys)
+        order = np.argsort(np.concatenate([self._key, keys]), kind="stable")
+        self._key = np.concatenate([self._key, keys])[order]
+        self._space = np.concatenate([self._space, space])[order]
+        self._track = np.concatenate([self._track, track])[order]
+        self._cls = np.concatenate([self._cls, np.asarray(cls, dtype=np.float32)])[order]
+        self._conf = np.concatenate([self._conf, np.asarray(conf, dtype=np.float32)])[order]
+        self._score = np.concatenate([self._score, score])[order]
+        self._entered = np.concatenate([self._entered, np.full(n, now)])[order]
+        self._last_seen = np.concatenate([self._last_seen, np.full(n, now)])[order]
+        self._since = np.concatenate([self._since, np.full(n, now)])[order]
+        self._confirmed = np.concatenate([self._confirmed, np.zeros(n, dtype=bool)])[order]
+        self._record = np.concatenate([self._record, np.full(n, None, dtype=object)])[order]
+
+    def _keep(self, rows: np.ndarray) -> None:
+        for name in (
+            "_key", "_space", "_track", "_cls", "_conf", "_score", "_entered", "_last_seen", "_since", "_confirmed", "_record"
+        ):
+            setattr(self, name, getattr(self, name)[rows])
+
+
+class SpatialIndex:
+    """STRtree over the selection polygons of every parking space of a camera.
+
+    Vehicles are matched against all spaces with a single bulk query and the
+    intersection ratios are computed with shapely's vectorized functions, so the
+    cost grows with the number of overlapping pairs instead of vehicles x spaces.
+    The tree is only rebuilt when a space is added, removed or reshaped.
+    """
+    def __init__(self) -> None:
+        self._signature = None
+        self._spaces: List[ParkingSpace] = []
+        self._polygons = np.empty(0, dtype=object)
+        self._tree = None
+
+    @property
+    def spaces(self) -> List[ParkingSpace]:
+        return self._spaces
+
+    def sync(self, spaces: List[ParkingSpace]) -> None:
+        signature = tuple((space.id, space.version) for space in spaces)
+        if signature == self._signature:
+            return
+        self._spaces = list(spaces)
+        self._polygons = np.empty(len(self._spaces), dtype=object)
+        self._polygons[:] = [space.selection_polygon for space in self._spaces]
+        self._tree = STRtree(self._polygons)
+        self._signature = signature
+        logging.log(logging.INFO, f"Rebuilt spatial index with {len(self._spaces)} parking spaces")
+
+    def query(self, polygons: List[Polygon]) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Returns ``(vehicle_idx, space_idx, ratio)`` for every overlapping pair,
+        where ratio is the intersection area divided by the vehicle area."""
+        if len(polygons) == 0 or len(self._spaces) == 0:
+            return np.empty(0, dtype=np.intp), np.empty(0, dtype=np.intp), np.empty(0)
+        vehicles = np.empty(len(polygons), dtype=object)
+        vehicles[:] = polygons
+        invalid = ~shapely.is_valid(vehicles)
+        if invalid.any():
+            vehicles[invalid] = shapely.make_valid(vehicles[invalid])
+
+        vehicle_idx, space_idx = self._tree.query(vehicles, predicate="intersects")
+        areas = shapely.area(shapely.intersection(vehicles[vehicle_idx], self._polygons[space_idx]))
+        vehicle_areas = shapely.area(vehicles)[vehicle_idx]
+        keep = (areas > 0) & (vehicle_areas > 0)
+        return vehicle_idx[keep], space_idx[keep], areas[keep] / vehicle_areas[keep]
+
+
+class RasterIndex:
+    """Label image with the parking spaces of a camera rasterized at mask resolution.
+
+    Pixel value ``i + 1`` belongs to the i-th space and 0 to no space (where spaces
+    overlap, the one listed last wins). The overlap between every YOLO mask and
+    every space is then one ``np.bincount`` over the labels under the mask pixels.
+    The image is only redrawn when a selection or the mask resolution changes.
+    """
+    def __init__(self) -> None:
+        self._signature = None
+        self._spaces: List[ParkingSpace] = []
+        self._labels = np.zeros(0, dtype=np.int32)
+        self._width = 0
+        self._frame_shape = None
+        self._mask_shape = None
+
+    @property
+    def spaces(self) -> List[ParkingSpace]:
+        return self._spaces
+
+    def sync(self, spaces: List[ParkingSpace], frame_shape: Tuple[int, int] = None, mask_shape: Tuple[int, int] = None) -> None:
+        """Redraws the label image for ``spaces`` when they changed. Without shapes the
+        last ones are used, so frames without masks still keep the spaces current;
+        before the first mask there is nothing to draw and only the spaces are kept."""
+        frame_shape = self._frame_shape if frame_shape is None else tuple(frame_shape)
+        mask_shape = self._mask_shape if mask_shape is None else tuple(mask_shape)
+        signature = (frame_shape, mask_shape, tuple((space.id, space.version) for space in spaces))
+        if signature == self._signature:
+            return
+        if mask_shape is None:
+            self._spaces = list(spaces)
+            self._signature = signature
+            return
+        # YOLO masks live in the letterboxed network input, map frame coordinates into it
+        height, width = mask_shape
+        gain = min(height / frame_shape[0], width / frame_shape[1])
+        pad = np.array([(width - frame_shape[1] * gain) / 2, (height - frame_shape[0] * gain) / 2])
+        labels = np.zeros((height, width), dtype=np.int32)
+        for idx, space in enumerate(spaces):
+            if len(space.selection_list) < 3:
+                continue
+            pts = np.round(np.asarray(space.selection_list, dtype=np.float64) * gain + pad).astype(np.int32)
+            cv2.fillPoly(labels, [pts], idx + 1)
+
+        self._spaces = list(spaces)
+        self._labels = labels.ravel()
+        self._width = width
+        self._frame_shape, self._mask_shape = frame_shape, mask_shape
+        self._signature = signature
+        logging.log(logging.INFO, f"Rebuilt {width}x{height} label image with {len(self._spaces)} parking spaces")
+
+    def query(self, masks) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Returns ``(vehicle_idx, space_idx, ratio)`` for every overlapping pair.
+
+        ``masks`` is an ``(N, H, W)`` bitmap stack, either a NumPy array or the
+        ``results[0].masks.data`` tensor, at the resolution given to :meth:`sync`.
+        """
+        n_vehicles, n_labels = len(masks), len(self._spaces) + 1
+        if n_vehicles == 0 or len(self._spaces) == 0:
+            return np.empty(0, dtype=np.intp), np.empty(0, dtype=np.intp), np.empty(0)
+        # masks are sparse, only gather the rows a vehicle touches before looking for pixels
+        vehicle_idx, row = np.nonzero(_to_numpy(masks.any(2)))
+        hit, col = np.nonzero(_to_numpy(masks[vehicle_idx, row]))
+        keys = vehicle_idx[hit] * n_labels + self._labels[row[hit] * self._width + col]
+        counts = np.bincount(keys, minlength=n_vehicles * n_labels).reshape(n_vehicles, n_labels)
+        areas = counts.sum(axis=1)
+        vehicle_idx, label = np.nonzero(counts[:, 1:])
+        return vehicle_idx, label, counts[vehicle_idx, label + 1] / areas[vehicle_idx]
+
+
+def _to_numpy(value) -> np.ndarray:
+    if hasattr(value, "cpu"):
+        return value.cpu().numpy()
+    return np.asarray(value)
+
+
+class OverlayRenderer:
+    """Draws the overlay of the output stream in place.
+
+    Parking spaces are prerendered, filled and outlined in their occupancy
+    color, into a layer cached until a selection or an occupancy changes. Each
+    frame then only blends that layer over the bounding box of the spaces with
+    two cv2 calls. Tracked vehicles get box outlines with their track id, masks
+    are only drawn with ``draw_masks``. ``last_render_ms`` is the cost of the
+    last frame.
+
+    ``geometry`` describes the same overlay as JSON for clients that draw it
+    over the original video themselves.
+    """
+    FREE_COLOR = (0, 200, 0)
+    OCCUPIED_COLOR = (0, 0, 230)
+    VEHICLE_COLOR = (255, 160, 0)
+
+    def __init__(self, alpha: float = 0.35, draw_masks: bool = False, mask_alpha: float = 0.5, line_width: int = 2) -> None:
+        self.alpha = alpha
+        self.draw_masks = draw_masks
+        self.mask_alpha = mask_alpha
+        self.line_width = line_width
+        self.last_render_ms = 0.0
+        self._signature = None
+        self._roi = None
+        self._layer = self._fill = self._outline = self._scratch = None
+
+    def render(self, frame: np.ndarray, result=None, spaces: List[ParkingSpace] = ()) -> np.ndarray:
+        start = time.perf_counter()
+        self._sync(spaces, frame.shape)
+        if self._roi is not None:
+            x, y, w, h = self._roi
+            roi = frame[y:y + h, x:x + w]
+            cv2.addWeighted(roi, 1 - self.alpha, self._layer, self.alpha, 0, dst=self._scratch)
+            cv2.copyTo(self._scratch, self._fill, roi)
+            cv2.copyTo(self._layer, self._outline, roi)
+        if result is not None:
+            if self.draw_masks and result.masks is not None and len(result.masks):
+                self._draw_masks(frame, result.masks.data)
+            if result.boxes is not None and len(result.boxes):
+                self._draw_boxes(frame, result.boxes)
+        self.last_render_ms = (time.perf_counter() - start) * 1000
+        logging.log(logging.DEBUG, f"Rendered overlay in {self.last_render_ms:.2f} ms")
+        return frame
+
+    def geometry(self, result=None, spaces: List[ParkingSpace] = ()) -> dict:
+        """The boxes, track ids and occupancy the overlay shows, in frame pixels.
+        Mask outlines are only included with ``draw_masks``."""
+        geometry = {"spaces": [{"id": str(space.id), "occupied": space.occupied} for space in spaces], "vehicles": []}
+        if result is None:
+            return geometry
+        geometry["size"] = list(result.orig_shape[::-1])
+        boxes = result.boxes
+        if boxes is None or not len(boxes):
+            return geometry
+        xyxy = np.round(_to_numpy(boxes.xyxy)).astype(int).tolist()
+        ids = [None] * len(xyxy) if boxes.id is None else _to_numpy(boxes.id).astype(int).tolist()
+        classes = _to_numpy(boxes.cls).astype(int).tolist()
+        confs = np.round(_to_numpy(boxes.conf).astype(float), 3).tolist()
+        outlines = [None] * len(xyxy)
+        if self.draw_masks and result.masks is not None:
+            outlines = [np.round(outline).astype(int).tolist() for outline in result.masks.xy]
+        for box, id, cls_, conf, outline in zip(xyxy, ids, classes, confs, outlines):
+            vehicle = {"box": box, "id": id, "cls": result.names[cls_], "conf": conf}
+            if outline is not None:
+                vehicle["outline"] = outline
+            geometry["vehicles"].append(vehicle)
+        return geometry
+
+    def _sync(self, spaces: List[ParkingSpace], frame_shape: Tuple[int, ...]) -> None:
+        signature = (tuple(frame_shape), tuple((space.id, space.version, space.occupied) for space in spaces))
+        if signature == self._signature:
+            return
+        height, width = frame_shape[:2]
+        layer = np.zeros((height, width, 3), dtype=np.uint8)
+        fill = np.zeros((height, width), dtype=np.uint8)
+        outline = np.zeros((height, width), dtype=np.uint8)
+        polygons = []
+        for space in spaces:
+            if len(space.selection_list) < 3:
+                continue
+            pts = np.round(np.asarray(space.selection_list, dtype=np.float64)).astype(np.int32)
+            color = self.OCCUPIED_COLOR if space.occupied else self.FREE_COLOR
+            cv2.fillPoly(layer, [pts], color)
+            cv2.fillPoly(fill, [pts], 1)
+            polygons.append((pts, color))
+        for pts, color in polygons:
+            cv2.polylines(layer, [pts], True, color, self.line_width)
+            cv2.polylines(outline, [pts], True, 1, self.line_width)
+
+        self._signature = signature
+        x, y, w, h = cv2.boundingRect(fill | outline)
+        if w == 0 or h == 0:
+            self._roi = None
+            return
+        self._roi = (x, y, w, h)
+        self._layer = layer[y:y + h, x:x + w].copy()
+        self._fill = fill[y:y + h, x:x + w].copy()
+        self._outline = outline[y:y + h, x:x + w].copy()
+        self._scratch = np.empty_like(self._layer)
+
+    def _draw_masks(self, frame: np.ndarray, masks) -> None:
+        # masks live in the letterboxed network input, crop the padding and scale back
+        union = _to_numpy(masks.any(0)).astype(np.uint8)
+        height, width = union.shape
+        gain = min(height / frame.shape[0], width / frame.shape[1])
+        pad_x, pad_y = int((width - frame.shape[1] * gain) / 2), int((height - frame.shape[0] * gain) / 2)
+        union = union[pad_y:height - pad_y, pad_x:width - pad_x]
+        union = cv2.resize(union, (frame.shape[1], frame.shape[0]), interpolation=cv2.INTER_NEAREST)
+        x, y, w, h = cv2.boundingRect(union)
+        if w == 0 or h == 0:
+            return
+        roi = frame[y:y + h, x:x + w]
+        tinted = cv2.addWeighted(roi, 1 - self.mask_alpha, np.full_like(roi, self.VEHICLE_COLOR), self.mask_alpha, 0)
+        cv2.copyTo(tinted, union[y:y + h, x:x + w], roi)
+
+    def _draw_boxes(self, frame: np.ndarray, boxes) -> None:
+        xyxy = _to_numpy(boxes.xyxy).astype(np.int32).tolist()
+        ids = [None] * len(xyxy) if boxes.id is None else _to_numpy(boxes.id).astype(int).tolist()
+        for (x0, y0, x1, y1), id in zip(xyxy, ids):
+            cv2.rectangle(frame, (x0, y0), (x1, y1), self.VEHICLE_COLOR, self.line_width)
+            if id is not None:
+                cv2.putText(frame, str(id), (x0 + 2, max(y0 - 4, 12)), cv2.FONT_HERSHEY_SIMPLEX, 0.5, self.VEHICLE_COLOR, 1, cv2.LINE_AA)
+
+
 class DetectionModel():
-    def __init__(self, model: YOLO) -> None:
+    def __init__(self, model: Union[YOLO, ExportedModel]) -> None:
         self.model = model
+    @property
+    def parking_spaces(self) -> List[ParkingSpace]:
+        return []
     def perform_detection(self, frame, *args, **kwargs) -> List:
         return self.model.track(frame, persist=True)
+    def handle_results(self, results, *args, **kwargs) -> List:
+        return results
+    def publish_overlay(self, geometry: dict) -> None:
+        pass
 
 class OccupationDetector(DetectionModel):
     def __init__(
         self,
         ws_url: str,
         threshold: int,
-        model: YOLO,
+        model: Union[YOLO, ExportedModel],
         frame_leap=15,
-        copies = 1,
+        eval_mode: str = "polygon",
+        reporter: RecordReporter = None,
+        exit_threshold: float = 0.4,
+        smoothing: float = 1.0,
+        enter_dwell: float = 5.0,
+        exit_dwell: float = 10.0,
+        poll_interval: float = 30,
+        camera_id: int = 1,
+        api_url: str = "http://api:8000",
+        location: str = "brazil",
+        stream_url: str = "http://mediamtx:8888/opencv",
+        runtime_token: str = None,
     ) -> None:
 
+        if eval_mode not in ("polygon", "raster"):
+            raise ValueError(f"eval_mode must be 'polygon' or 'raster', but got {eval_mode}")
+
         self._runtime_id = uuid.uuid4()
-        self._register()
-        self._selections = [ParkingSpace(id=s["id"], selection=s["pts"]) for s in self._fetch_selections()]
+        self._camera_id = camera_id
+        self._metrics = StageMetrics(camera_id)
+        self._api_url = api_url.rstrip("/")
+        # a reporter passed in is shared with other cameras and started by its owner
+        self._owns_reporter = reporter is None
+        self._reporter = reporter or RecordReporter(self._api_url)
+        self._register(location, stream_url)
         self._thread_pool = None
         self._eval_thread = None
         self._ws = websocket.WebSocketApp(
-            url=ws_url, on_message=self._parse_message, on_error=self.log_error, on_close=self._stop
+            url=ws_url,
+            on_open=self._on_open,
+            on_reconnect=self._on_open,
+            on_message=self._parse_message,
+            on_error=self.log_error,
+            on_close=self._stop,
+            # lets the API accept the overlays of the metadata output mode from this connection
+            header={"Authorization": f"Bearer {runtime_token}"} if runtime_token else None,
         )
-        logging.log(logging.INFO, f"Connected to websocket {ws_url}")
         self.ws_url = ws_url
+        self.poll_interval = poll_interval
         self._parking_spaces_: dict[str, ParkingSpace] = {}
+        self._selection_version = None
+        self._selection_lock = threading.Lock()
         self._threshold = None
-        self._vehicles: dict[str, Vehicle] = {}
+        self._eval_mode = eval_mode
+        self._index = RasterIndex() if eval_mode == "raster" else SpatialIndex()
+        self._occupancy = OccupancyStore(
+            reporter=self._reporter,
+            runtime_id=self._runtime_id,
+            exit_threshold=exit_threshold,
+            smoothing=smoothing,
+            enter_dwell=enter_dwell,
+            exit_dwell=exit_dwell,
+        )
         self.threshold = threshold
-        self._parking_spaces: dict[str, ParkingSpace] = {space.id: space for space in self._selections}
         self.frame_leap = frame_leap
         self.count = frame_leap
-        json._schema = {
+        self._schema = {
             "type": "object",
             "properties": {
+                "type": {"type": "string"},
+                "version": {"type": "integer"},
                 "parking_spaces": {
                     "type": "array",
                     "items": {
                         "type": "object",
                         "properties": {
-                            "type": {
+                            "id": {"type": "string"},
+                            "op": {
                                 "type": "string",
-                                "enum": ["selection_update", "info"],
+                                "enum": ["upsert", "delete"],
                             },
-                            "id": {"type": "integer"},
                             "coordinates": {
                                 "type": "array",
                                 "items": {
                                     "type": "array",
-                                    "items": [{"type": "number"}, {"type": "number"}],
+                                    "items": {"type": "number"},
                                     "minItems": 2,
                                     "maxItems": 2,
                                 },
                             },
                         },
-                        "required": ["type", "id", "coordinates"],
+                        "required": ["id", "op"],
+                        "if": {"properties": {"op": {"const": "upsert"}}},
+                        "then": {"required": ["coordinates"]},
                         "additionalProperties": True,
                     },
-                }
+                },
             },
-            "required": ["selections"],
-            "additionalProperties": False,
+            "required": ["type"],
+            "if": {"properties": {"type": {"const": "selection_update"}}},
+            "then": {"required": ["version", "parking_spaces"]},
+            "additionalProperties": True,
         }
+        self._sync_selections()
 
         super().__init__(model)
     
@@ -248,6 +862,14 @@ class OccupationDetector(DetectionModel):
     @property
     def runtime_id(self):
         return self._runtime_id
+
+    @property
+    def camera_id(self) -> int:
+        return self._camera_id
+
+    @property
+    def parking_spaces(self) -> List[ParkingSpace]:
+        return list(self._parking_spaces.values())
     
     @_parking_spaces.setter
     def _parking_spaces(self, value):
@@ -261,15 +883,10 @@ class OccupationDetector(DetectionModel):
     def threshold(self, value: int):
             self._threshold = value
     
-    @property
-    def _active_vehicles_ids(self) -> List[int]:
-        return self._active_vehicles_ids_
-
     def _parse_message(self, ws, message):
         try:
             message = json.loads(message)
             validate(instance=message, schema=self._schema)
-            logging.log(logging.INFO, f"Received message\n>{message}\n<")
         except (json.decoder.JSONDecodeError, ValueError) as e:
             logging.log(logging.ERROR, f"The message is not a valid JSON")
             return
@@ -278,32 +895,54 @@ class OccupationDetector(DetectionModel):
             return
         match message.get("type"):
             case "selection_update":
-                parking_spaces_list = message.get("parking_spaces")
-                for parking_space in parking_spaces_list:
-                    space_id = parking_space.get("id")
-                    coordinates: List[Iterable[float]] = parking_space.get("coordinates")
-                    new_space = ParkingSpace(id=space_id, selection_polygon=coordinates, runtime_id=self._runtime_id)
-                    if(self._parking_spaces.get(new_space.id) is None):
-                        self._parking_spaces[new_space.id] = new_space
-                        logging.log(logging.INFO, f"Added new parking space with id {new_space.id}")
-                    else:
-                        self._parking_spaces[new_space.id].selection_list = coordinates
-                        logging.log(logging.INFO, f"Updated parking space with id {new_space.id}")
+                self._apply_selection_diff(message["version"], message["parking_spaces"])
             case _:
                 pass
 
+    def _apply_selection_diff(self, version: int, parking_spaces: List[dict]) -> None:
+        with self._selection_lock:
+            if self._selection_version is not None and version <= self._selection_version:
+                return
+            if self._selection_version is None or version != self._selection_version + 1:
+                # missed at least one diff, the full state is the only safe way back
+                logging.log(logging.WARNING, f"Selection version gap ({self._selection_version} -> {version}), refetching")
+                self._sync_selections_locked()
+                return
+            for parking_space in parking_spaces:
+                space_id = parking_space["id"]
+                if parking_space["op"] == "delete":
+                    if self._parking_spaces.pop(space_id, None) is not None:
+                        logging.log(logging.INFO, f"Deleted parking space with id {space_id}")
+                    continue
+                coordinates = [tuple(point) for point in parking_space["coordinates"]]
+                if space_id in self._parking_spaces:
+                    self._parking_spaces[space_id].selection_list = coordinates
+                    logging.log(logging.INFO, f"Updated parking space with id {space_id}")
+                else:
+                    self._parking_spaces[space_id] = self._create_space(space_id, coordinates)
+                    logging.log(logging.INFO, f"Added new parking space with id {space_id}")
+            self._selection_version = version
+
+    def _create_space(self, id: str, selection: List[Iterable[float]]) -> ParkingSpace:
+        return ParkingSpace(id=id, selection=selection)
+
     def log_error(self, ws, error):
         logging.log(logging.ERROR, error)
     
-    def _register(self):
+    def _register(self, location: str, stream_url: str):
         logging.log(logging.INFO, f"Registering runtime with id {self._runtime_id}")
-        r = requests.post(f"http://api:8000/api/cams/1/", json={"location": "brazil", "url": "http://mediamtx:8888/opencv"})
-        logging.error(f"Tried to post cams 1")
-        r2 = requests.post(f"http://api:8000/api/runtime/{self._runtime_id}/", json={"camera": 1})
+        r = requests.post(f"{self._api_url}/api/cams/{self._camera_id}/", json={"location": location, "url": stream_url})
+        logging.error(f"Tried to post cams {self._camera_id}")
+        r2 = requests.post(f"{self._api_url}/api/runtime/{self._runtime_id}/", json={"camera": self._camera_id})
         logging.error(f"Tried to post runtime {self._runtime_id}")
 
-    def _stop(self):
-        pass
+    def _on_open(self, ws):
+        logging.log(logging.INFO, f"Connected to websocket {self.ws_url}")
+        # diffs sent while disconnected are lost, catch up before applying new ones
+        self._sync_selections()
+
+    def _stop(self, ws, status_code, message):
+        logging.log(logging.WARNING, f"Websocket {self.ws_url} closed ({status_code}): {message}")
 
     def start(self):
         if self._thread_pool is not None:
@@ -311,45 +950,65 @@ class OccupationDetector(DetectionModel):
                 "Threadpool already exists - must stop before creating a new one."
         )
         self._thread_pool = ThreadPoolExecutor(max_workers=10)
+        self._thread_pool.submit(self._ws.run_forever, reconnect=5)
         self._thread_pool.submit(self._fetch_polling)
+        if self._owns_reporter:
+            self._reporter.start()
         rel.signal(2, rel.abort)
         logging.log(logging.INFO, f"Started websocket threadpool")
     
     def _fetch_polling(self):
+        # selection changes are pushed through the websocket, this only covers
+        # diffs lost while the socket looked alive and costs a 304 otherwise
         while True:
+            time.sleep(self.poll_interval)
             try:
-                selections = self._fetch_selections()
-                selections_ids = [selection["id"] for selection in selections]
-                for selection in selections:
-                    if(selection["id"] in self._parking_spaces.keys()):
-                        self._parking_spaces[selection["id"]].selection_list = selection["pts"]
-                    else:
-                        self._parking_spaces[selection["id"]] = ParkingSpace(id=selection["id"], selection=selection["pts"])
-                for parking_space in self._parking_spaces.values():
-                    if parking_space.id not in selections_ids:
-                        del self._parking_spaces[parking_space.id]
-                time.sleep(1)
+                self._sync_selections()
             except Exception as e:
                 logging.log(logging.ERROR, f"Error while fetching selections")
                 traceback.print_exc()
-    
-    def _fetch_selections(self) -> List[ParkingSpace]:
-        cams = requests.get("http://api:8000/api/cams/1/").json()
-        parking_spaces = cams.get("parking_spaces")
-        selections = []
-        for parking_space in parking_spaces:
-            points = parking_space.get("selection")
-            points_ = []
-            for point in points:
-                points_.append((point.get("x"), point.get("y")))
-            selections.append({"id": parking_space.get("id"), "pts": points_})
-        return selections
-    
+
+    def _sync_selections(self) -> None:
+        with self._selection_lock:
+            self._sync_selections_locked()
+
+    def _sync_selections_locked(self) -> None:
+        fetched = self._fetch_selections()
+        if fetched is None:
+            return
+        version, selections = fetched
+        for selection in selections:
+            if selection["id"] in self._parking_spaces:
+                self._parking_spaces[selection["id"]].selection_list = selection["pts"]
+            else:
+                self._parking_spaces[selection["id"]] = self._create_space(selection["id"], selection["pts"])
+        selections_ids = {selection["id"] for selection in selections}
+        for space_id in [space_id for space_id in self._parking_spaces if space_id not in selections_ids]:
+            del self._parking_spaces[space_id]
+        self._selection_version = version
+
+    def _fetch_selections(self) -> Union[Tuple[int, List[dict]], None]:
+        """Returns ``(version, selections)``, or None when the known version is still current."""
+        headers = {}
+        if self._selection_version is not None:
+            headers["If-None-Match"] = f'"{self._selection_version}"'
+        # outlines come simplified and as [x, y] pairs, the same as in the websocket diffs
+        response = requests.get(f"{self._api_url}/api/cams/{self._camera_id}/geometry/", headers=headers, timeout=10)
+        if response.status_code == 304:
+            return None
+        response.raise_for_status()
+        geometry = response.json()
+        selections = [
+            {"id": parking_space["id"], "pts": [tuple(point) for point in parking_space["polygon"]]}
+            for parking_space in geometry["parking_spaces"]
+        ]
+        return geometry["version"], selections
+
     def _eval_vehicles(self, results):
         start = time.monotonic()
         masks, cls_list, cls_probs, id_list = [], [], [], []
         if(results[0].masks is not None):
-            masks = results[0].masks.xy
+            masks = results[0].masks.data if self._eval_mode == "raster" else results[0].masks.xy
         if(results[0].boxes.cls is not None):
             cls_list = results[0].boxes.cls.tolist()
         if(results[0].boxes.conf is not None):
@@ -357,17 +1016,37 @@ class OccupationDetector(DetectionModel):
         if(results[0].boxes.id is not None):
             id_list = results[0].boxes.id.tolist()
 
-        for id, mask, cls_, conf in zip(id_list, masks, cls_list, cls_probs):
-            v =  Vehicle(id, cls_, conf, Polygon(mask))
-            for parking_space in self._parking_spaces.values():
-                parking_space.eval_vehicle(v, self.threshold)
-                parking_space.update_status()
+        parking_spaces = list(self._parking_spaces.values())
+        if self._eval_mode == "raster":
+            vehicles = [Vehicle(id, cls_, conf) for id, cls_, conf in zip(id_list, cls_list, cls_probs)]
+            if len(masks) and vehicles:
+                masks = masks[:len(vehicles)]
+                self._index.sync(parking_spaces, results[0].orig_shape, tuple(masks.shape[1:]))
+            else:
+                # an empty scene still drops deleted spaces, and their pairs leave the store
+                self._index.sync(parking_spaces)
+                masks = []
+            vehicle_idx, space_idx, ratios = self._index.query(masks)
+        else:
+            vehicles = [
+                Vehicle(id, cls_, conf, Polygon(mask))
+                for id, mask, cls_, conf in zip(id_list, masks, cls_list, cls_probs)
+                if len(mask) >= 3
+            ]
+            self._index.sync(parking_spaces)
+            vehicle_idx, space_idx, ratios = self._index.query([v.polygon for v in vehicles])
+        self._occupancy.update(self._index.spaces, vehicles, vehicle_idx, space_idx, ratios, self.threshold)
         elapsed = time.monotonic() - start
-        logging.log(logging.INFO, f"Evaluated vehicles in {elapsed*1000} ms\n")
+        self._metrics.observe("eval", elapsed)
+        logging.log(logging.DEBUG, f"Evaluated vehicles in {elapsed*1000} ms\n")
     
     def perform_detection(self, frame, classes, skip_detections=False, *args, **kwargs) -> List:
         logging.log(logging.DEBUG, f"Performing detection on frame")
         results = self.model.track(frame, persist=True, classes=classes, tracker="bytetrack.yaml")
+        return self.handle_results(results, skip_detections)
+
+    def handle_results(self, results, skip_detections=False) -> List:
+        """Evaluates tracked results against the parking spaces, every ``frame_leap`` frames when skipping."""
         if(skip_detections and self.count <= self.frame_leap):
             logging.log(logging.INFO, f"Skipping evaluation\n")
             self.count += 1
@@ -384,6 +1063,13 @@ class OccupationDetector(DetectionModel):
             traceback.print_exc()
         return results
 
+    def publish_overlay(self, geometry: dict) -> None:
+        """Sends the overlay of a frame to the camera websocket, dropped while it is disconnected."""
+        try:
+            self._ws.send(json.dumps({"type": "overlay", "camera": self._camera_id, "time": time.time(), **geometry}))
+        except websocket.WebSocketException as e:
+            logging.log(logging.DEBUG, f"Could not publish overlay: {e}")
+
 
 class YoloRTSP:
     def __init__(
@@ -396,11 +1082,23 @@ class YoloRTSP:
         fps: int = None,
         ffmpeg_cmd: str = "ffmpeg",
         classes: List[str] = None,
+        renderer: OverlayRenderer = None,
+        output_mode: str = "encode",
+        codec: str = "libx264",
+        preset: str = "veryfast",
+        tune: str = "zerolatency",
+        output_size: Tuple[int, int] = None,
+        capture_backend: str = "opencv",
     ) -> None:
 
-        self._frame_to_send = None
-        self.q_limit = 3
-        self._frame_queue = queue.Queue(self.q_limit)
+        if output_mode not in OUTPUT_MODES:
+            raise ValueError(f"output_mode must be one of {OUTPUT_MODES}, but got {output_mode}")
+        self._output_mode = output_mode
+        self._encode_options = {"codec": codec, "preset": preset, "tune": tune, "output_size": output_size}
+        self._renderer = renderer or OverlayRenderer()
+        # newest decoded frame for inference and newest annotated frame for ffmpeg
+        self._decoded = FrameMailbox()
+        self._annotated = FrameMailbox()
 
         self._input_url = input_url
         vcap = cv2.VideoCapture(input_url, cv2.CAP_FFMPEG)
@@ -412,7 +1110,7 @@ class YoloRTSP:
             self._model = DetectionModel(YOLO())
             logging.log(logging.INFO, f"Using default model {DetectionModel.__name__}")
         elif isinstance(model, str):
-            self._model = DetectionModel(YOLO(model))
+            self._model = DetectionModel(load_model(model))
             logging.log(logging.INFO, f"Using default model {DetectionModel.__name__} with file {model}")
         elif isinstance(model, DetectionModel):
             self._model = model
@@ -422,13 +1120,17 @@ class YoloRTSP:
                 f"model attribute must be an instance of {str} or {DetectionModel.__name__}, but got {model.__class__.__name__}"
             )
         self._class_dict = {v: k for k, v in self._model.model.names.items()}
+        self._metrics = StageMetrics(getattr(self._model, "camera_id", input_url))
+        self._reconnects = 0
+        # shared with the relay thread
+        self._ffmpeg_starts = mp_context.Value("Q", 0)
+        self._relay_stop = threading.Event()
 
         self._classes = (
             [self._class_dict[class_] for class_ in classes]
             if classes is not None
             else list(self._class_dict.values())
         )
-        self._lock = threading.Lock()
 
         self._ffmpeg_cmd = ffmpeg_cmd
         self._input_url = input_url
@@ -437,10 +1139,21 @@ class YoloRTSP:
         self._img_height = img_height or int(vcap.get(cv2.CAP_PROP_FRAME_HEIGHT))
         self._fps = fps or int(vcap.get(cv2.CAP_PROP_FPS))
         self._T = 1 / self._fps
+        self._capture_backend = capture_backend
+        # ffmpeg only drops frames at the source for an explicit fps
+        self._capture_fps = fps
         self._process = None
         self._is_stopped_ = True
         self._thread_pool = None
-        self._vcap = vcap
+        if capture_backend == "opencv":
+            self._vcap = vcap
+        else:
+            vcap.release()
+            self._vcap = None
+        # frames alive at once: one in each mailbox, the one being read, inferred and sent
+        self._pool = FramePool((self._img_height, self._img_width, 3), 5)
+        self._held_frame = None
+        self._last_result = None
         self._last_frame_update = 0
         logging.log(logging.WARNING, f"Created YoloRTSP object with input url {self._input_url} and output url {self._output_url}")
 
@@ -464,6 +1177,14 @@ class YoloRTSP:
     def _is_stopped(self, value: bool) -> None:
         self._is_stopped_ = value
 
+    def stats(self) -> dict:
+        return {
+            "decode": self._decoded.stats(),
+            "encode": self._annotated.stats(),
+            "reconnects": self._reconnects,
+            "ffmpeg_restarts": max(self._ffmpeg_starts.value - 1, 0),
+        }
+
     @property
     def elapsed_time_since_update(self) -> float:
         return time() - self._last_frame_update
@@ -481,46 +1202,55 @@ class YoloRTSP:
                 f"Invalid value. Values must be a list of the following possible values: {self._class_dict.keys()}"
             )
     
-    def queue_put(self, value):
-        if(self._frame_queue.qsize() >= self.q_limit-1):
-            self._frame_queue.get()
-            self._frame_queue.task_done()
-        self._frame_queue.put(value)
+    def latest_frame(self):
+        """The newest decoded frame, or None if there is none. The frame is held until ``handle_results``."""
+        self._pool.release(self._held_frame)
+        self._held_frame = None
+        taken = self._decoded.get(timeout=0)
+        if taken is None:
+            return None
+        self._metrics.observe("queue", self._decoded.lag)
+        self._held_frame = taken[0]
+        return self._held_frame
+
+    @property
+    def parking_spaces(self) -> List[ParkingSpace]:
+        return self._model.parking_spaces
+
+    def handle_results(self, results, skip_detections=True) -> None:
+        """Takes the tracked results of a frame inferred outside this stream, see ``InferenceRuntime``."""
+        results = self._model.handle_results(results, skip_detections=skip_detections)
+        self._last_result = results[0]
+        if self._output_mode == "metadata":
+            self._model.publish_overlay(self._renderer.geometry(self._last_result, self._model.parking_spaces))
+        self.skip_frame()
+
+    def skip_frame(self) -> None:
+        """Sends the held frame with the last results drawn on it, for frames that are not inferred."""
+        frame, self._held_frame = self._held_frame, None
+        if self._output_mode == "encode":
+            with self._metrics.time("overlay"):
+                self._renderer.render(frame, self._last_result, self._model.parking_spaces)
+        self._show(frame)
+
+    def _show(self, frame) -> None:
+        """Makes ``frame`` the next one sent to ffmpeg, a frame it replaces unsent goes back to the pool."""
+        if self._output_mode != "encode":
+            # nothing reads the decoded frames after inference
+            self._pool.release(frame)
+            return
+        self._pool.release(self._annotated.put(frame))
 
     def start_ffmpeg_stream(self) -> None:
         if(self._process is not None):
             self._process.kill()
 
-        command = [
-            self._ffmpeg_cmd,
-            "-re",
-            "-f",
-            "rawvideo",
-            "-s",
-            f"{self._img_width}x{self._img_height}",
-            "-pixel_format",
-            "bgr24",
-            "-r",
-            f"{self._fps}",
-            "-i",
-            "-",
-            "-pix_fmt",
-            "yuv420p",
-            "-c:v",
-            "libx264",
-            "-bufsize",
-            "64M",
-            "-maxrate",
-            "4M",
-            "-rtsp_transport",
-            "tcp",
-            "-f",
-            "rtsp",
-            self._output_url,
-        ]
-
-
+        command = ffmpeg_command(
+            self._ffmpeg_cmd, self._img_width, self._img_height, self._fps, self._output_url, **self._encode_options
+        )
         self._process = sp.Popen(command, stdin=sp.PIPE)
+        with self._ffmpeg_starts.get_lock():
+            self._ffmpeg_starts.value += 1
         logging.log(logging.INFO, f"Started ffmpeg process with command {command}")
 
     def _send(self, frame) -> None:
@@ -533,7 +1263,8 @@ class YoloRTSP:
                     logging.log(logging.INFO, f"Starting ffmpeg stream")
                     self.start_ffmpeg_stream()
                 try:
-                    self._process.stdin.write(frame.tobytes())
+                    with self._metrics.time("encode"):
+                        self._process.stdin.write(frame.data)
                 except BrokenPipeError:
                     logging.log(logging.ERROR, f"Broken pipe error")
                     self._process.kill()
@@ -545,55 +1276,83 @@ class YoloRTSP:
     
     def _receive(self):
         logging.log(logging.ERROR, "Started receiving")
-        while self._vcap.isOpened() and not self._is_stopped:
+        backoff = Backoff()
+        if self._vcap is None:
+            self._vcap = self._open_capture()
+        while not self._is_stopped:
             try:
-                retry = False
-                ret, frame = self._vcap.read()
+                buffer = self._pool.acquire()
+                if buffer is None:
+                    # every frame is in use, reuse the one inference has not taken yet
+                    buffer = self._decoded.take_back()
+                    if buffer is None:
+                        self._vcap.grab()
+                        continue
+                start = time.perf_counter()
+                ret, frame = self._vcap.read(buffer)
                 if ret:
-                    if(retry):
-                        logging.error("success!")
-                        retry = False
-                    self.queue_put(frame)
-                elif not ret:
-                    retry = True
-                    if(not retry):
-                        logging.error("invalid VIDEO, trying to recconect...")
-                    else:
-                        logging.error("failed")
-                    self._vcap = cv2.VideoCapture(self._input_url)
+                    self._metrics.observe("capture", time.perf_counter() - start)
+                    backoff.reset()
+                    if frame is not buffer:
+                        cv2.resize(frame, (self._img_width, self._img_height), dst=buffer)
+                    self._pool.release(self._decoded.put(buffer))
+                else:
+                    self._pool.release(buffer)
+                    delay = backoff.next()
+                    logging.error(f"Could not read from {self._input_url}, reconnecting in {delay} s")
+                    self._vcap.release()
+                    time.sleep(delay)
+                    self._reconnects += 1
+                    self._vcap = self._open_capture()
                     continue
             except:
                 traceback.print_exc()
+        self._vcap.release()
+        self._vcap = None
+
+    def _open_capture(self):
+        return open_capture(
+            self._input_url, self._capture_backend, self._img_width, self._img_height, self._capture_fps, self._ffmpeg_cmd
+        )
     
     def _track(self, inference=True) -> None:
         logging.log(logging.INFO, "Started tracking")
         while True:
             try:
-                frame = self._frame_queue.get()
+                frame, _ = self._decoded.get()
+                self._metrics.observe("queue", self._decoded.lag)
                 if(inference):
-                    results = self._model.perform_detection(
-                        frame, classes=self._classes, skip_detections=True
-                    )
-                    with self._lock:
-                        self._frame_to_send = results[0].plot()
-                        self._frame_queue.task_done()
-                else:
-                    with self._lock:
-                        self._frame_to_send = frame
-                        self._frame_queue.task_done()
+                    with self._metrics.time("track"):
+                        results = self._model.perform_detection(
+                            frame, classes=self._classes, skip_detections=True
+                        )
+                    if self._output_mode == "encode":
+                        with self._metrics.time("overlay"):
+                            self._renderer.render(frame, results[0], self._model.parking_spaces)
+                    elif self._output_mode == "metadata":
+                        self._model.publish_overlay(self._renderer.geometry(results[0], self._model.parking_spaces))
+                self._show(frame)
             except:
                 traceback.print_exc()
     
     def _send_loop(self,):
         logging.log(logging.INFO, "Started sending")
+        # the frame being written belongs to this thread until a newer one arrives,
+        # so neither the write nor the overlay waits for the other
+        frame = None
         while True:
             starttime = time.monotonic()
-            with self._lock:
-                self._send(self._frame_to_send)
+            taken = self._annotated.get(timeout=0)
+            if taken is not None:
+                self._pool.release(frame)
+                frame = taken[0]
+            self._send(frame)
             time.sleep(self._T - ((time.monotonic() - starttime) % self._T))
 
     
-    def stream(self, inference: bool = True) -> None:
+    def stream(self, inference: bool = True, batched: bool = False) -> None:
+        """Starts the stream threads. A ``batched`` stream only reads and sends,
+        its frames are inferred by an ``InferenceRuntime``."""
         self._is_stopped = False
         if self._thread_pool is not None:
             raise RuntimeError(
@@ -601,12 +1360,19 @@ class YoloRTSP:
             )
         self._thread_pool = ThreadPoolExecutor(max_workers=10)
         self._thread_pool.submit(self._receive)
-        self._thread_pool.submit(self._track, inference=True)
-        self._thread_pool.submit(self._send_loop)
+        if not batched:
+            self._thread_pool.submit(self._track, inference=inference)
+        if self._output_mode == "encode":
+            self._thread_pool.submit(self._send_loop)
+        elif self._output_mode == "metadata":
+            self._relay_stop.clear()
+            command = relay_command(self._ffmpeg_cmd, self._input_url, self._output_url)
+            self._thread_pool.submit(relay_worker, command, self._relay_stop, starts=self._ffmpeg_starts)
 
     def stop(self) -> None:
         logging.log(logging.INFO, f"Stopping stream")
         self._is_stopped = True
+        self._relay_stop.set()
         if self._thread_pool is not None:
             self._thread_pool.shutdown(wait=True)
             self._thread_pool = None
@@ -615,15 +1381,581 @@ class YoloRTSP:
             self._process = None
 
 
-def get_urls() -> Tuple[List[str], List[str]]:
-    sources = ["rtsp://mediamtx:8554/collingwood"]
-    upload = ["rtsp://mediamtx:8554/opencv"]
-    return sources, upload
+class PipelinedRTSP:
+    """A stream whose decode and encode stages run in their own processes.
+
+    Frames live in one shared memory ``FrameRing``: the decoder reads into its
+    slots, the overlay is drawn in place and the slot is handed to the encoder
+    through a stage of the same ring, so only slot indices cross process
+    boundaries and neither ffmpeg I/O nor decoding competes with inference for
+    the GIL. Inference and the overlay stay in this process, the overlay needs
+    the results. Frames are fed by an ``InferenceRuntime``, ``stats`` reports
+    the depth and drops of each stage. The decode and encode processes send
+    their read and write times back, they are observed as the ``capture`` and
+    ``encode`` stages when the next frame is taken.
+
+    With ``output_mode="metadata"`` no frame is drawn or encoded, an ffmpeg
+    process relays the source as is and the overlay geometry goes through the
+    websocket of the model; ``"none"`` has no output at all.
+    """
+    def __init__(
+        self,
+        input_url: str,
+        output_url: str,
+        model: DetectionModel,
+        img_width: int = None,
+        img_height: int = None,
+        fps: int = None,
+        ffmpeg_cmd: str = "ffmpeg",
+        classes: List[str] = None,
+        slots: int = 6,
+        decode_policy: str = "drop_oldest",
+        encode_depth: int = 1,
+        renderer: OverlayRenderer = None,
+        output_mode: str = "encode",
+        codec: str = "libx264",
+        preset: str = "veryfast",
+        tune: str = "zerolatency",
+        output_size: Tuple[int, int] = None,
+        capture_backend: str = "opencv",
+    ) -> None:
+        if output_mode not in OUTPUT_MODES:
+            raise ValueError(f"output_mode must be one of {OUTPUT_MODES}, but got {output_mode}")
+        vcap = cv2.VideoCapture(input_url, cv2.CAP_FFMPEG)
+        if not vcap.isOpened():
+            raise ConnectionError("Could not open video capture")
+        self._img_width = img_width or int(vcap.get(cv2.CAP_PROP_FRAME_WIDTH))
+        self._img_height = img_height or int(vcap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        self._fps = fps or int(vcap.get(cv2.CAP_PROP_FPS))
+        vcap.release()
+
+        self._model = model
+        self._renderer = renderer or OverlayRenderer()
+        self._metrics = StageMetrics(getattr(model, "camera_id", input_url))
+        # counted by the decode and encode processes
+        self._reconnects = mp_context.Value("Q", 0)
+        self._ffmpeg_starts = mp_context.Value("Q", 0)
+        # their capture and encode latencies, observed here since the histograms live in this process
+        self._samples = mp_context.Queue(1024)
+        class_dict = {v: k for k, v in model.model.names.items()}
+        self._classes = [class_dict[class_] for class_ in classes] if classes is not None else list(class_dict.values())
+        self._input_url = input_url
+        self._output_url = output_url
+        self._decode_options = {"backend": capture_backend, "fps": fps, "ffmpeg_cmd": ffmpeg_cmd}
+        self._output_mode = output_mode
+        if output_mode == "metadata":
+            self._command = relay_command(ffmpeg_cmd, input_url, output_url)
+        else:
+            self._command = ffmpeg_command(
+                ffmpeg_cmd, self._img_width, self._img_height, self._fps, output_url,
+                codec=codec, preset=preset, tune=tune, output_size=output_size,
+            )
+        shape = (self._img_height, self._img_width, 3)
+        self._decoded = FrameRing(shape, slots, decode_policy)
+        self._annotated = self._decoded.stage(max_depth=encode_depth)
+        self._held_slot = None
+        self._last_result = None
+        self._stop_event = mp_context.Event()
+        self._processes = []
+        logging.log(logging.WARNING, f"Created PipelinedRTSP object with input url {self._input_url} and output url {self._output_url}")
+
+    @property
+    def fps(self) -> int:
+        return self._fps
+
+    @property
+    def width(self) -> int:
+        return self._img_width
+
+    @property
+    def height(self) -> int:
+        return self._img_height
+
+    def stats(self) -> dict:
+        return {
+            "decode": self._decoded.stats(),
+            "encode": self._annotated.stats(),
+            "reconnects": self._reconnects.value,
+            "ffmpeg_restarts": max(self._ffmpeg_starts.value - 1, 0),
+        }
+
+    def latest_frame(self):
+        """The newest decoded frame, or None. Its slot is held until ``handle_results``."""
+        if self._held_slot is not None:
+            self._decoded.release(self._held_slot)
+            self._held_slot = None
+        self._observe_samples()
+        descriptor = self._decoded.get_latest()
+        if descriptor is None:
+            return None
+        # time since the decoder published the frame
+        self._metrics.observe("queue", time.time() - descriptor[1])
+        self._held_slot = descriptor[0]
+        return self._decoded.frame(self._held_slot)
+
+    @property
+    def parking_spaces(self) -> List[ParkingSpace]:
+        return self._model.parking_spaces
 
+    def handle_results(self, results, skip_detections=True) -> None:
+        results = self._model.handle_results(results, skip_detections=skip_detections)
+        self._last_result = results[0]
+        if self._output_mode == "metadata":
+            self._model.publish_overlay(self._renderer.geometry(self._last_result, self._model.parking_spaces))
+        self._publish()
 
-def create_signal_handler(streamers: List[YoloRTSP]) -> None:
+    def skip_frame(self) -> None:
+        self._publish()
+
+    def _observe_samples(self) -> None:
+        while True:
+            try:
+                stage, seconds = self._samples.get_nowait()
+            except queue.Empty:
+                return
+            self._metrics.observe(stage, seconds)
+
+    def _publish(self) -> None:
+        slot, self._held_slot = self._held_slot, None
+        if self._output_mode != "encode":
+            self._decoded.release(slot)
+            return
+        with self._metrics.time("overlay"):
+            self._renderer.render(self._decoded.frame(slot), self._last_result, self._model.parking_spaces)
+        self._annotated.publish(slot)
+
+    def stream(self, inference: bool = True, batched: bool = True) -> None:
+        if not batched:
+            raise ValueError("PipelinedRTSP frames are inferred by an InferenceRuntime, it only runs batched")
+        if self._processes:
+            raise RuntimeError("Pipeline already started - must stop before starting it again.")
+        self._stop_event.clear()
+        self._processes = [
+            mp_context.Process(
+                target=decode_worker,
+                args=(self._input_url, self._decoded, self._stop_event),
+                kwargs={"reconnects": self._reconnects, "samples": self._samples, **self._decode_options},
+                name="decode",
+                daemon=True,
+            ),
+        ]
+        if self._output_mode == "encode":
+            self._processes.append(mp_context.Process(
+                target=encode_worker,
+                args=(self._command, self._annotated, self._fps, self._stop_event),
+                kwargs={"starts": self._ffmpeg_starts, "samples": self._samples},
+                name="encode",
+                daemon=True,
+            ))
+        elif self._output_mode == "metadata":
+            self._processes.append(mp_context.Process(
+                target=relay_worker,
+                args=(self._command, self._stop_event),
+                kwargs={"starts": self._ffmpeg_starts},
+                name="relay",
+                daemon=True,
+            ))
+        for process in self._processes:
+            process.start()
+        logging.log(logging.INFO, f"Started {', '.join(process.name for process in self._processes)} processes for {self._input_url}")
+
+    def stop(self) -> None:
+        logging.log(logging.INFO, f"Stopping stream")
+        self._stop_event.set()
+        for process in self._processes:
+            process.join(timeout=5)
+            if process.is_alive():
+                process.kill()
+        self._processes = []
+        self._annotated.close()
+        self._decoded.close()
+
+
+def letterbox_shape(shape: Tuple[int, int], imgsz: int = 640, stride: int = 32) -> Tuple[int, int]:
+    """Network input (and mask) size YOLO letterboxes a frame of ``shape`` to."""
+    gain = min(imgsz / shape[0], imgsz / shape[1])
+    height, width = round(shape[0] * gain), round(shape[1] * gain)
+    return int(np.ceil(height / stride) * stride), int(np.ceil(width / stride) * stride)
+
+
+class RoiCropper:
+    """Crops frames to the regions holding parking spaces and maps detections back.
+
+    Every space is padded by ``margin`` times its own size, since vehicles stick
+    out of the painted lines, and the padded boxes are merged while merging
+    adds no pixels or there are more than ``max_crops`` regions left. When the
+    regions cover most of the frame, or there are no spaces, the full frame is
+    used. ``merge`` turns the per crop results back into one ``Results`` in
+    frame coordinates, masks at the size the full frame would have had, so
+    tracking, evaluation and the overlay do not know about the crops.
+    """
+    def __init__(self, margin: float = 0.5, max_crops: int = 1, max_coverage: float = 0.8, iou: float = 0.5) -> None:
+        self.margin = margin
+        self.max_crops = max_crops
+        self.max_coverage = max_coverage
+        self.iou = iou
+        self._signature = None
+        self._regions: List[Tuple[int, int, int, int]] = []
+
+    @property
+    def regions(self) -> List[Tuple[int, int, int, int]]:
+        return self._regions
+
+    def crops(self, frame: np.ndarray, spaces: List[ParkingSpace]) -> List[np.ndarray]:
+        self._sync(spaces, frame.shape)
+        return [frame[y0:y1, x0:x1] for x0, y0, x1, y1 in self._regions]
+
+    def merge(self, frame: np.ndarray, results: List[Results]) -> Results:
+        height, width = frame.shape[:2]
+        if len(results) == 1 and self._regions[0] == (0, 0, width, height):
+            return results[0]
+        mask_shape = letterbox_shape((height, width))
+        gain = min(mask_shape[0] / height, mask_shape[1] / width)
+        pad_x, pad_y = (mask_shape[1] - width * gain) / 2, (mask_shape[0] - height * gain) / 2
+        boxes, masks = [], []
+        for (x0, y0, x1, y1), result in zip(self._regions, results):
+            if result.boxes is None or not len(result.boxes):
+                continue
+            data = result.boxes.data.clone()
+            data[:, [0, 2]] += x0
+            data[:, [1, 3]] += y0
+            boxes.append(data)
+            if result.masks is not None:
+                masks.append(self._paste_masks(result, (x0, y0, x1, y1), mask_shape, gain, (pad_x, pad_y)))
+        names, path = results[0].names, results[0].path
+        if not boxes:
+            return Results(frame, path, names, boxes=torch.zeros((0, 6)))
+        boxes = torch.cat(boxes)
+        masks = torch.cat(masks) if masks else None
+        if len(self._regions) > 1:
+            # vehicles on the border of two regions are found in both
+            keep = torchvision.ops.batched_nms(boxes[:, :4], boxes[:, 4], boxes[:, 5], self.iou)
+            boxes = boxes[keep]
+            masks = masks[keep] if masks is not None else None
+        return Results(frame, path, names, boxes=boxes, masks=masks)
+
+    @staticmethod
+    def _paste_masks(result: Results, region, mask_shape, gain, pad):
+        data = result.masks.data
+        crop_height, crop_width = result.orig_shape
+        height, width = data.shape[1:]
+        crop_gain = min(height / crop_height, width / crop_width)
+        crop_pad_x, crop_pad_y = (width - crop_width * crop_gain) / 2, (height - crop_height * crop_gain) / 2
+        data = data[:, int(crop_pad_y):int(height - crop_pad_y), int(crop_pad_x):int(width - crop_pad_x)]
+
+        x0, y0, x1, y1 = region
+        left, top = int(round(x0 * gain + pad[0])), int(round(y0 * gain + pad[1]))
+        right = min(mask_shape[1], max(left + 1, int(round(x1 * gain + pad[0]))))
+        bottom = min(mask_shape[0], max(top + 1, int(round(y1 * gain + pad[1]))))
+        scaled = torch.nn.functional.interpolate(data[None].float(), size=(bottom - top, right - left), mode="bilinear")[0]
+        pasted = torch.zeros((len(data),) + tuple(mask_shape), dtype=data.dtype, device=data.device)
+        pasted[:, top:bottom, left:right] = (scaled > 0.5).to(data.dtype)
+        return pasted
+
+    def _sync(self, spaces: List[ParkingSpace], frame_shape: Tuple[int, ...]) -> None:
+        signature = (tuple(frame_shape), tuple((space.id, space.version) for space in spaces))
+        if signature == self._signature:
+            return
+        height, width = frame_shape[:2]
+        boxes = []
+        for space in spaces:
+            if len(space.selection_list) < 3:
+                continue
+            pts = np.asarray(space.selection_list, dtype=np.float64)
+            (x0, y0), (x1, y1) = pts.min(0), pts.max(0)
+            pad = self.margin * max(x1 - x0, y1 - y0)
+            boxes.append([x0 - pad, y0 - pad, x1 + pad, y1 + pad])
+        boxes = np.clip(np.array(boxes).reshape(-1, 4), 0, [width, height, width, height])
+        while len(boxes) > 1:
+            # pixels a merge would add on top of the two regions, negative when they overlap
+            x0 = np.minimum.outer(boxes[:, 0], boxes[:, 0])
+            y0 = np.minimum.outer(boxes[:, 1], boxes[:, 1])
+            x1 = np.maximum.outer(boxes[:, 2], boxes[:, 2])
+            y1 = np.maximum.outer(boxes[:, 3], boxes[:, 3])
+            areas = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+            waste = (x1 - x0) * (y1 - y0) - areas[:, None] - areas[None, :]
+            np.fill_diagonal(waste, np.inf)
+            i, j = np.unravel_index(np.argmin(waste), waste.shape)
+            if waste[i, j] > 0 and len(boxes) <= self.max_crops:
+                break
+            boxes[i] = [x0[i, j], y0[i, j], x1[i, j], y1[i, j]]
+            boxes = np.delete(boxes, j, axis=0)
+
+        areas = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+        if len(boxes) == 0 or areas.sum() > self.max_coverage * width * height:
+            self._regions = [(0, 0, width, height)]
+        else:
+            self._regions = [tuple(int(round(v)) for v in box) for box in boxes]
+        self._signature = signature
+        logging.log(logging.INFO, f"Cropping {width}x{height} frames to regions {self._regions}")
+
+
+class MotionScheduler:
+    """Decides per frame whether a stream needs inference.
+
+    Each frame is compared with the last inferred one on a small blurred
+    grayscale copy, and the changed pixels are counted per parking space with
+    one bincount over a label image of the spaces. YOLO only runs when a space
+    changed by more than ``area_threshold`` of its area, or when the last
+    inference is older than ``max_staleness`` seconds. Skipped frames never
+    reach the tracker, so in a static scene its tracks stay where they were.
+    ``max_staleness`` should stay below the ``exit_dwell`` after which the
+    occupancy store lets go of a vehicle it has not seen; the runtime defaults
+    it to half of it.
+
+    ``stats`` reports, over the last ``window`` seconds, the inference rate, the
+    skip ratio and the latency from the first motion in a space to the change
+    of its occupancy. With ``metrics`` every latency is also observed in the
+    ``parking_occupancy_change_seconds`` histogram, the rate and the skip ratio
+    are exported through the ``parking_frames`` counter by the runtime.
+    """
+    def __init__(
+        self,
+        max_staleness: float = 5.0,
+        area_threshold: float = 0.02,
+        pixel_threshold: int = 25,
+        width: int = 320,
+        window: float = 60.0,
+        metrics: StageMetrics = None,
+    ) -> None:
+        self.max_staleness = max_staleness
+        self.area_threshold = area_threshold
+        self.pixel_threshold = pixel_threshold
+        self.width = width
+        self.window = window
+        self._reference = None
+        self._last_inference = 0.0
+        self._signature = None
+        self._spaces: List[ParkingSpace] = []
+        self._labels = None
+        self._areas = None
+        self._history = deque()
+        self._motion_since: dict[str, float] = {}
+        self._occupied: dict[str, bool] = {}
+        self._latencies = deque()
+        self._metrics = metrics
+
+    def should_infer(self, frame: np.ndarray, spaces: List[ParkingSpace]) -> bool:
+        now = time.monotonic()
+        self._track_occupancy(spaces, now)
+        small = self._preprocess(frame)
+        self._sync(spaces, frame.shape, small.shape)
+        infer = (
+            self._reference is None
+            or not self._spaces
+            or now - self._last_inference >= self.max_staleness
+        )
+        if self._reference is not None and self._spaces:
+            for idx in self._moving(small).tolist():
+                self._motion_since.setdefault(self._spaces[idx].id, now)
+                infer = True
+        if infer:
+            self._reference = small
+            self._last_inference = now
+        self._history.append((now, infer))
+        while self._history[0][0] < now - self.window:
+            self._history.popleft()
+        return infer
+
+    def stats(self) -> dict:
+        inferred = sum(infer for _, infer in self._history)
+        span = self._history[-1][0] - self._history[0][0] if len(self._history) > 1 else 0.0
+        latencies = [latency for _, latency in self._latencies]
+        return {
+            "inference_fps": inferred / span if span else 0.0,
+            "skip_ratio": 1 - inferred / len(self._history) if self._history else 0.0,
+            "occupancy_latency_s": float(np.mean(latencies)) if latencies else None,
+            "occupancy_changes": len(latencies),
+        }
+
+    def _preprocess(self, frame: np.ndarray) -> np.ndarray:
+        height = max(1, round(frame.shape[0] * self.width / frame.shape[1]))
+        small = cv2.resize(frame, (self.width, height), interpolation=cv2.INTER_AREA)
+        return cv2.GaussianBlur(cv2.cvtColor(small, cv2.COLOR_BGR2GRAY), (5, 5), 0)
+
+    def _sync(self, spaces: List[ParkingSpace], frame_shape: Tuple[int, ...], shape: Tuple[int, int]) -> None:
+        signature = (tuple(frame_shape), tuple((space.id, space.version) for space in spaces))
+        if signature == self._signature:
+            return
+        scale = shape[1] / frame_shape[1]
+        labels = np.zeros(shape, dtype=np.int32)
+        for idx, space in enumerate(spaces):
+            if len(space.selection_list) < 3:
+                continue
+            pts = np.round(np.asarray(space.selection_list, dtype=np.float64) * scale).astype(np.int32)
+            cv2.fillPoly(labels, [pts], idx + 1)
+        self._spaces = list(spaces)
+        self._labels = labels
+        self._areas = np.bincount(labels.ravel(), minlength=len(spaces) + 1)[1:]
+        self._signature = signature
+
+    def _moving(self, small: np.ndarray) -> np.ndarray:
+        changed = cv2.absdiff(small, self._reference) > self.pixel_threshold
+        counts = np.bincount(self._labels[changed], minlength=len(self._spaces) + 1)[1:]
+        return np.flatnonzero((self._areas > 0) & (counts > self.area_threshold * self._areas))
+
+    def _track_occupancy(self, spaces: List[ParkingSpace], now: float) -> None:
+        for space in spaces:
+            occupied = space.occupied
+            if self._occupied.get(space.id, occupied) != occupied:
+                since = self._motion_since.pop(space.id, None)
+                if since is not None:
+                    self._latencies.append((now, now - since))
+                    if self._metrics is not None:
+                        self._metrics.occupancy_change(now - since)
+            self._occupied[space.id] = occupied
+        # motion that did not change the occupancy (people, shadows) is forgotten
+        for space_id, since in list(self._motion_since.items()):
+            if now - since > self.window:
+                del self._motion_since[space_id]
+        while self._latencies and self._latencies[0][0] < now - self.window:
+            self._latencies.popleft()
+
+
+class InferenceRuntime:
+    """Runs one batched forward pass over the latest frame of every stream.
+
+    The streams must be started with ``batched=True``. Streams without a new
+    frame are left out of the batch, so a stalled camera does not hold the
+    others back. Each stream keeps its own ``StreamTracker`` and gets its
+    results back through ``YoloRTSP.handle_results``.
+
+    With ``motion_gate`` every stream gets a ``MotionScheduler``: frames it
+    skips are sent with the last results through ``skip_frame``, and inferred
+    frames are evaluated right away instead of every ``frame_leap`` frames.
+
+    With ``roi`` every stream gets a ``RoiCropper`` and only the regions around
+    its parking spaces go into the batch, at ``imgsz`` when given.
+    """
+    def __init__(
+        self,
+        model: Union[YOLO, ExportedModel],
+        streams: List[Union[YoloRTSP, PipelinedRTSP]],
+        tracker: str = "bytetrack.yaml",
+        idle_wait: float = 0.005,
+        motion_gate: bool = False,
+        max_staleness: float = 5.0,
+        stats_interval: float = 60.0,
+        roi: bool = False,
+        roi_margin: float = 0.5,
+        roi_max_crops: int = 1,
+        imgsz: int = None,
+    ) -> None:
+        self._model = model
+        self._streams = streams
+        self._trackers = [StreamTracker(tracker) for _ in streams]
+        self._schedulers = [
+            MotionScheduler(max_staleness=max_staleness, metrics=stream._metrics) for stream in streams
+        ] if motion_gate else None
+        self._croppers = [RoiCropper(roi_margin, roi_max_crops) for _ in streams] if roi else None
+        self._predict_args = {"imgsz": imgsz} if imgsz else {}
+        # streams may filter different classes, the batch detects all of them
+        self._classes = sorted(set().union(*(stream._classes for stream in streams)))
+        self._idle_wait = idle_wait
+        self._stats_interval = stats_interval
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def stats(self) -> List[dict]:
+        if self._schedulers is None:
+            return []
+        return [scheduler.stats() for scheduler in self._schedulers]
+
+    def start(self) -> None:
+        if self._thread is not None:
+            raise RuntimeError("Runtime already started - must stop before starting it again.")
+        self._stop_event.clear()
+        self._thread = Thread(target=self._run, name="inference-runtime", daemon=True)
+        self._thread.start()
+        logging.log(logging.INFO, f"Started inference runtime with {len(self._streams)} streams")
+
+    def stop(self) -> None:
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self) -> None:
+        last_stats = time.monotonic()
+        while not self._stop_event.is_set():
+            try:
+                if not self.step():
+                    time.sleep(self._idle_wait)
+                if self._schedulers is not None and time.monotonic() - last_stats >= self._stats_interval:
+                    last_stats = time.monotonic()
+                    for stream, stats in zip(self._streams, self.stats()):
+                        logging.log(logging.INFO, f"Scheduler {stream._input_url}: {stats}")
+            except Exception:
+                traceback.print_exc()
+
+    def step(self) -> int:
+        """Infers one batch and returns the number of frames handled, skipped ones included."""
+        batch, skipped = [], 0
+        for i, stream in enumerate(self._streams):
+            frame = stream.latest_frame()
+            if frame is None:
+                continue
+            if self._schedulers is not None and not self._schedulers[i].should_infer(frame, stream.parking_spaces):
+                stream._metrics.frame("skipped")
+                stream.skip_frame()
+                skipped += 1
+                continue
+            stream._metrics.frame("inferred")
+            batch.append((i, frame))
+        if not batch:
+            return skipped
+        inputs, sizes = [], []
+        for i, frame in batch:
+            crops = [frame] if self._croppers is None else self._croppers[i].crops(frame, self._streams[i].parking_spaces)
+            inputs += crops
+            sizes.append(len(crops))
+        start = time.perf_counter()
+        predictions = self._model.predict(inputs, classes=self._classes, verbose=False, **self._predict_args)
+        BATCH_SECONDS.observe(time.perf_counter() - start)
+        BATCH_FRAMES.observe(len(inputs))
+        results, start = [], 0
+        for (i, frame), size in zip(batch, sizes):
+            if self._croppers is None:
+                results.append(predictions[start])
+            else:
+                results.append(self._croppers[i].merge(frame, predictions[start:start + size]))
+            start += size
+        for (i, _), result in zip(batch, results):
+            stream = self._streams[i]
+            if len(stream._classes) != len(self._classes) and result.boxes is not None:
+                result = result[np.isin(result.boxes.cls.cpu().numpy(), stream._classes)]
+            with stream._metrics.time("track"):
+                result = self._trackers[i].update(result)
+            stream.handle_results([result], skip_detections=self._schedulers is None)
+        return len(batch) + skipped
+
+
+def get_cameras() -> List[dict]:
+    """Cameras to run, from the JSON list in ``$CAMERAS`` (inline or a file path).
+
+    Each camera has an ``id``, a ``source`` to read, an ``output`` to publish the
+    annotated stream to, and the ``location`` and playback ``url`` registered in
+    the API.
+    """
+    config = os.environ.get("CAMERAS")
+    if not config:
+        return [{
+            "id": 1,
+            "location": "Brazil",
+            "source": "rtsp://mediamtx:8554/collingwood",
+            "output": "rtsp://mediamtx:8554/opencv",
+            "url": "http://mediamtx:8888/opencv",
+        }]
+    if os.path.isfile(config):
+        with open(config) as f:
+            return json.load(f)
+    return json.loads(config)
+
+
+def create_signal_handler(runtime: InferenceRuntime, streamers: List[Union[YoloRTSP, PipelinedRTSP]]) -> None:
     def stop_processes(sig, frame) -> None:
         print("\n\nStopping processes...\n")
+        runtime.stop()
         total = len(streamers)
         for i, streamer in enumerate(streamers):
             streamer.stop()
@@ -633,15 +1965,92 @@ def create_signal_handler(streamers: List[YoloRTSP]) -> None:
 
 
 if __name__ == "__main__":
-    urls = get_urls()
+    cameras = get_cameras()
     yolo_model_name = os.environ.get("YOLO_MODEL", "yolov8x-seg.pt")
+    api_url = os.environ.get("API_URL") or "http://api:8000"
+    eval_mode = os.environ.get("EVAL_MODE") or "polygon"
+    # "processes" decodes and encodes every camera in its own processes, "threads" keeps the single process streams
+    pipeline = os.environ.get("PIPELINE") or "processes"
+    draw_masks = os.environ.get("OVERLAY_MASKS", "0") == "1"
+    motion_gate = os.environ.get("MOTION_GATE", "1") == "1"
+    # only infer the regions around the parking spaces, ROI_IMGSZ can lower the input size of the crops
+    roi = os.environ.get("ROI", "0") == "1"
+    roi_imgsz = int(os.environ.get("ROI_IMGSZ") or 0) or None
+    # Prometheus /metrics, 0 turns it off
+    metrics_port = int(os.environ.get("METRICS_PORT") or 8001)
+    # .pt runs on ultralytics, .onnx on ONNX Runtime and *_openvino_model on OpenVINO
+    threads = int(os.environ.get("INFERENCE_THREADS") or 0) or None
+    # a vehicle enters a space after ENTER_DWELL seconds over the threshold and leaves after
+    # EXIT_DWELL seconds under EXIT_THRESHOLD, with ratios smoothed over OCCUPANCY_SMOOTHING seconds
+    exit_threshold = float(os.environ.get("EXIT_THRESHOLD") or 0.4)
+    enter_dwell = float(os.environ.get("ENTER_DWELL") or 5.0)
+    exit_dwell = float(os.environ.get("EXIT_DWELL") or 10.0)
+    smoothing = float(os.environ.get("OCCUPANCY_SMOOTHING") or 1.0)
+    # only infer frames where a parking space changed, or at least every MAX_STALENESS seconds,
+    # by default half of EXIT_DWELL so an idle scene is re-checked before its vehicles time out
+    max_staleness = float(os.environ.get("MAX_STALENESS") or exit_dwell / 2)
+    if max_staleness >= exit_dwell:
+        logging.log(logging.WARNING, f"MAX_STALENESS {max_staleness}s is not below EXIT_DWELL {exit_dwell}s, idle vehicles will time out")
+    # CAPTURE_BACKEND=ffmpeg decodes in an ffmpeg process that drops frames down to CAPTURE_FPS
+    # and scales them to CAPTURE_SIZE (WIDTHxHEIGHT) before they reach Python
+    capture_backend = os.environ.get("CAPTURE_BACKEND") or "opencv"
+    capture_size = os.environ.get("CAPTURE_SIZE")
+    capture_width, capture_height = (int(side) for side in capture_size.split("x")) if capture_size else (None, None)
+    capture_fps = int(os.environ.get("CAPTURE_FPS") or 0) or None
+    # "encode" streams the annotated video, "metadata" relays the source and sends the overlay
+    # through the websocket, "none" has no output; ENCODE_CODEC can be a hardware encoder (h264_nvenc)
+    output_mode = os.environ.get("OUTPUT_MODE") or "encode"
+    # the API only relays overlays from websockets that present its RUNTIME_TOKEN
+    runtime_token = os.environ.get("RUNTIME_TOKEN")
+    if output_mode == "metadata" and not runtime_token:
+        logging.log(logging.WARNING, "OUTPUT_MODE is metadata but RUNTIME_TOKEN is not set, the API will drop the overlays")
+    # WIDTHxHEIGHT, the input size by default
+    output_size = os.environ.get("OUTPUT_SIZE")
+    encode_options = {
+        "codec": os.environ.get("ENCODE_CODEC") or "libx264",
+        "preset": os.environ.get("ENCODE_PRESET", "veryfast"),
+        "tune": os.environ.get("ENCODE_TUNE", "zerolatency"),
+        "output_size": tuple(int(side) for side in output_size.split("x")) if output_size else None,
+    }
+    # one set of weights serves every camera, batched by the runtime
+    yolo = load_model(yolo_model_name, threads=threads)
+    reporter = RecordReporter(api_url)
+    reporter.start()
+    collector = RuntimeCollector()
+    collector.add_reporter(reporter)
     streamers = []
-    requests.post("http://api:8000/api/cams/1/", json={"location": "Brazil", "url": "http://mediamtx:8888/opencv"})
-    model = OccupationDetector("ws://api:8000/ws/1/", threshold=0.6, model=YOLO(yolo_model_name))
-    logging.log(logging.INFO, f"Created model {model}")
-    model.start()
-    for file_url, rtsp_server in zip(*urls):
-        streamer = YoloRTSP(file_url, rtsp_server, classes=["car", "truck"], model=model)
-        streamer.stream(inference=True)
+    for camera in cameras:
+        model = OccupationDetector(
+            f"{api_url.replace('http', 'ws', 1)}/ws/{camera['id']}/",
+            threshold=0.6,
+            model=yolo,
+            eval_mode=eval_mode,
+            reporter=reporter,
+            exit_threshold=exit_threshold,
+            smoothing=smoothing,
+            enter_dwell=enter_dwell,
+            exit_dwell=exit_dwell,
+            camera_id=camera["id"],
+            api_url=api_url,
+            location=camera.get("location", "brazil"),
+            stream_url=camera.get("url", "http://mediamtx:8888/opencv"),
+            runtime_token=runtime_token,
+        )
+        logging.log(logging.INFO, f"Created model {model} for camera {camera['id']}")
+        model.start()
+        stream_class = PipelinedRTSP if pipeline == "processes" else YoloRTSP
+        streamer = stream_class(
+            camera["source"], camera["output"], classes=["car", "truck"], model=model,
+            renderer=OverlayRenderer(draw_masks=draw_masks), output_mode=output_mode, **encode_options,
+            capture_backend=capture_backend, img_width=capture_width, img_height=capture_height, fps=capture_fps,
+        )
+        streamer.stream(inference=True, batched=True)
         streamers.append(streamer)
-    signal.signal(signal.SIGINT, create_signal_handler(streamers))
\ No newline at end of file
+        collector.add_stream(camera["id"], streamer)
+    runtime = InferenceRuntime(
+        yolo, streamers, motion_gate=motion_gate, max_staleness=max_staleness, roi=roi, imgsz=roi_imgsz,
+    )
+    runtime.start()
+    if metrics_port:
+        start_metrics_server(metrics_port, collector)
+    signal.signal(signal.SIGINT, create_signal_handler(runtime, streamers))
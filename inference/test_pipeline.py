@@ -0,0 +1,71 @@
+import tempfile
+import threading
+import time
+import unittest
+from pathlib import Path
+
+from pipeline import FfmpegReader, FrameRing, encode_worker
+
+# larger than the pipe's write buffer, so every frame reaches ffmpeg when it is written
+SHAPE = (64, 64, 3)
+FRAME_SIZE = 64 * 64 * 3
+
+
+class EncodeWorkerTests(unittest.TestCase):
+    def frames_per_second(self, source_fps: float, fps: int = 30, duration: float = 2.0) -> float:
+        ring = FrameRing(SHAPE, slots=4)
+        stop_event = threading.Event()
+        with tempfile.TemporaryDirectory() as directory:
+            output = Path(directory) / "stdin"
+            # stands in for ffmpeg, keeps whatever it is fed
+            command = ["sh", "-c", 'exec cat > "$0"', str(output)]
+            worker = threading.Thread(target=encode_worker, args=(command, ring, fps, stop_event))
+            worker.start()
+            start = time.monotonic()
+            while time.monotonic() - start < duration:
+                slot = ring.acquire(timeout=1)
+                if slot is not None:
+                    ring.publish(slot)
+                time.sleep(1 / source_fps)
+            stop_event.set()
+            worker.join()
+            return output.stat().st_size / FRAME_SIZE / duration
+
+    def test_a_slower_source_is_written_at_fps(self):
+        # the last frame is repeated in between, but never on top of the new ones
+        self.assertAlmostEqual(self.frames_per_second(source_fps=20), 30, delta=3)
+
+    def test_a_faster_source_is_written_at_fps(self):
+        self.assertAlmostEqual(self.frames_per_second(source_fps=60), 30, delta=3)
+
+
+class FfmpegReaderTests(unittest.TestCase):
+    def reader(self, script: str, timeout: float) -> FfmpegReader:
+        # stands in for ffmpeg: ignores its arguments and runs ``script``
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        ffmpeg = Path(directory.name) / "ffmpeg"
+        ffmpeg.write_text(f"#!/bin/sh\n{script}\n")
+        ffmpeg.chmod(0o755)
+        reader = FfmpegReader("rtsp://stalled", SHAPE[1], SHAPE[0], ffmpeg_cmd=str(ffmpeg), timeout=timeout)
+        self.addCleanup(reader.release)
+        return reader
+
+    def test_a_stalled_source_fails_the_read_after_the_timeout(self):
+        # one frame, then the connection stays open without data
+        reader = self.reader(f"head -c {FRAME_SIZE} /dev/zero; exec sleep 60", timeout=0.5)
+        self.assertTrue(reader.read()[0])
+        start = time.monotonic()
+        with self.assertLogs(level="ERROR"):
+            self.assertEqual(reader.read(), (False, None))
+        self.assertLess(time.monotonic() - start, 5)
+
+    def test_a_closed_source_fails_the_read_at_once(self):
+        reader = self.reader("exit 1", timeout=30)
+        start = time.monotonic()
+        self.assertEqual(reader.read(), (False, None))
+        self.assertLess(time.monotonic() - start, 5)
+
+
+if __name__ == "__main__":
+    unittest.main()
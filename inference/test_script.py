@@ -0,0 +1,300 @@
+import tempfile
+import time
+import unittest
+from pathlib import Path
+from unittest import mock
+
+import cv2
+import numpy as np
+import requests
+from prometheus_client import REGISTRY
+
+from script import OccupancyStore, ParkingSpace, PipelinedRTSP, RasterIndex, RecordReporter, Vehicle
+
+THRESHOLD = 0.5
+SQUARE = [(0, 0), (10, 0), (10, 10), (0, 10)]
+
+
+class RasterIndexTests(unittest.TestCase):
+    def setUp(self):
+        self.a = ParkingSpace("A", [(0, 0), (10, 0), (10, 10), (0, 10)])
+        self.b = ParkingSpace("B", [(10, 0), (20, 0), (20, 10), (10, 10)])
+
+    def mask(self, x0: int, x1: int) -> np.ndarray:
+        masks = np.zeros((1, 10, 20), dtype=bool)
+        masks[0, :, x0:x1] = True
+        return masks
+
+    def test_masks_are_matched_against_the_labels(self):
+        index = RasterIndex()
+        index.sync([self.a, self.b], (10, 20), (10, 20))
+        vehicle_idx, space_idx, ratios = index.query(self.mask(2, 8))
+        self.assertEqual((vehicle_idx.tolist(), space_idx.tolist(), ratios.tolist()), ([0], [0], [1.0]))
+
+    def test_the_spaces_follow_the_selections_without_masks(self):
+        index = RasterIndex()
+        # nothing to draw before the first mask, the spaces are still current
+        index.sync([self.a, self.b])
+        self.assertEqual(index.spaces, [self.a, self.b])
+        index.sync([self.a, self.b], (10, 20), (10, 20))
+
+        # an empty scene while A is deleted, the label image is redrawn at the last shape
+        index.sync([self.b])
+        self.assertEqual(index.spaces, [self.b])
+        self.assertEqual(index.query(self.mask(2, 8))[1].tolist(), [])
+        vehicle_idx, space_idx, ratios = index.query(self.mask(12, 18))
+        self.assertEqual((vehicle_idx.tolist(), space_idx.tolist(), ratios.tolist()), ([0], [0], [1.0]))
+
+
+class FakeReporter:
+    """Keeps the record events instead of sending them, ``enter`` returns the record key."""
+    def __init__(self) -> None:
+        self.events = []
+
+    def enter(self, obj_id, obj_cls, parking_space, runtime, at: float = None) -> str:
+        key = f"record-{obj_id}"
+        self.events.append(("enter", key, parking_space, at))
+        return key
+
+    def heartbeat(self, *keys: str) -> None:
+        pass
+
+    def leave(self, key: str, at: float = None) -> None:
+        self.events.append(("leave", key, at))
+
+
+class OccupancyStoreTests(unittest.TestCase):
+    def setUp(self):
+        self.reporter = FakeReporter()
+        self.store = OccupancyStore(self.reporter, runtime_id="runtime", exit_threshold=0.4, smoothing=1.0, enter_dwell=5, exit_dwell=10)
+        self.a, self.b = ParkingSpace("A", SQUARE), ParkingSpace("B", SQUARE)
+        self.spaces = [self.a, self.b]
+
+    def observe(self, now: float, pairs: dict = None, spaces: list = None) -> list:
+        """One evaluation at ``now`` of ``{(space index, track id): ratio}``."""
+        pairs = pairs or {}
+        vehicles = [Vehicle(track, 2.0, 0.9) for _, track in pairs]
+        vehicle_idx = np.arange(len(pairs), dtype=np.intp)
+        space_idx = np.array([space for space, _ in pairs], dtype=np.intp)
+        ratios = np.array(list(pairs.values()), dtype=np.float64)
+        return self.store.update(spaces or self.spaces, vehicles, vehicle_idx, space_idx, ratios, THRESHOLD, now=now)
+
+    def park(self, track: int = 1, space: int = 0, start: float = 0) -> None:
+        for now in range(start, start + 6):
+            self.observe(now, {(space, track): 0.9})
+
+    def dates(self) -> dict:
+        """The wall clock offsets of the record events, relative to the first one."""
+        first = self.reporter.events[0][-1]
+        return {(event[0], event[1]): event[-1] - first for event in self.reporter.events}
+
+    def test_a_pair_enters_after_the_enter_dwell(self):
+        for now in range(5):
+            self.assertEqual(self.observe(now, {(0, 1): 0.9}), [])
+        self.assertFalse(self.a.occupied)
+
+        self.assertEqual(self.observe(5, {(0, 1): 0.9}), [("enter", "A", 1)])
+        self.assertEqual(self.a.occupants, 1)
+        self.assertFalse(self.b.occupied)
+        self.assertEqual([event[:3] for event in self.reporter.events], [("enter", "record-1", "A")])
+
+    def test_dips_and_missed_masks_do_not_close_the_record(self):
+        self.park()
+        # missed mask, ratio under the exit threshold, a dip over it, back in full
+        for now, pairs in ((6, {}), (7, {(0, 1): 0.1}), (8, {(0, 1): 0.45}), (9, {(0, 1): 0.9})):
+            self.assertEqual(self.observe(now, pairs), [])
+            self.assertTrue(self.a.occupied)
+        self.assertEqual(len(self.reporter.events), 1)
+
+    def test_the_exit_is_dated_at_the_last_presence(self):
+        self.park()
+        self.observe(7, {(0, 1): 0.9})
+        for now in range(8, 17):
+            self.assertEqual(self.observe(now), [])
+        self.assertEqual(self.observe(17), [("leave", "A", 1)])
+
+        self.assertFalse(self.a.occupied)
+        dates = self.dates()
+        self.assertAlmostEqual(dates[("enter", "record-1")], 0, places=2)
+        self.assertAlmostEqual(dates[("leave", "record-1")], 7, places=2)
+
+    def test_a_pair_leaving_right_after_entering_is_dated_at_its_entry(self):
+        # the exit dwell starts when the pair was last present, not when it started entering
+        self.park()
+        for now in range(6, 15):
+            self.assertEqual(self.observe(now), [])
+        self.assertEqual(self.observe(15), [("leave", "A", 1)])
+        self.assertAlmostEqual(self.dates()[("leave", "record-1")], 5, places=2)
+
+    def test_a_pair_that_vanishes_while_pending_writes_no_record(self):
+        for now in range(3):
+            self.observe(now, {(0, 1): 0.9, (1, 2): 0.9})
+        # one falls under the exit threshold, the other is never seen again
+        self.observe(3, {(0, 1): 0.9, (1, 2): 0.2})
+        for now in range(4, 20):
+            self.assertEqual(self.observe(now), [])
+        self.assertEqual(self.reporter.events, [])
+        self.assertEqual(len(self.store._key), 0)
+
+    def test_a_new_track_in_a_fading_space_takes_the_record_over(self):
+        self.park(track=1)
+        # the tracker switches the id of the parked vehicle
+        for now in range(7, 12):
+            self.assertEqual(self.observe(now, {(0, 2): 0.9}), [])
+        self.assertEqual(self.observe(12, {(0, 2): 0.9}), [("switch", "A", 2)])
+        self.assertEqual(self.a.occupants, 1)
+
+        for now in range(13, 22):
+            self.assertEqual(self.observe(now), [])
+        self.assertEqual(self.observe(22), [("leave", "A", 2)])
+        self.assertEqual([event[:2] for event in self.reporter.events], [("enter", "record-1"), ("leave", "record-1")])
+        self.assertAlmostEqual(self.dates()[("leave", "record-1")], 12, places=2)
+
+    def test_removing_a_space_closes_its_pairs(self):
+        self.park(track=1, space=0)
+        self.observe(6, {(0, 1): 0.9, (1, 2): 0.9})
+
+        events = self.observe(7, {(0, 2): 0.9}, spaces=[self.b])
+        self.assertEqual(events, [("leave", "A", 1)])
+        self.assertEqual([event[:2] for event in self.reporter.events], [("enter", "record-1"), ("leave", "record-1")])
+        # the pending pair of the removed space goes without a record, the other space keeps its own
+        self.assertEqual(self.store._space_ids[self.store._space[0]], "B")
+        self.assertEqual(len(self.store._key), 1)
+
+
+class FakeResponse:
+    def __init__(self, status_code: int, body: dict = None) -> None:
+        self.status_code = status_code
+        self._body = body or {}
+        self.text = str(self._body)
+
+    def json(self) -> dict:
+        return self._body
+
+
+class FakeSession:
+    """Answers the bulk requests of a ``RecordReporter`` with ``responses`` in order
+    (an exception is raised instead of returned) and keeps their events."""
+    def __init__(self, *responses) -> None:
+        self.responses = list(responses)
+        self.batches = []
+
+    def post(self, url: str, json: dict = None, timeout: float = None) -> FakeResponse:
+        self.batches.append(json["events"])
+        response = self.responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+
+class RecordReporterTests(unittest.TestCase):
+    def reporter(self, *responses) -> RecordReporter:
+        self.session = FakeSession(*responses)
+        return RecordReporter("http://api", session=self.session)
+
+    def flush(self, reporter: RecordReporter) -> list:
+        """Sends what the worker thread would on its next flush and returns the batch."""
+        reporter._drain()
+        sent = len(self.session.batches)
+        reporter._flush()
+        return self.session.batches[sent] if len(self.session.batches) > sent else None
+
+    def test_failed_requests_keep_the_events_for_a_retry(self):
+        for failure in (FakeResponse(503), requests.ConnectionError("refused")):
+            with self.subTest(failure=failure):
+                reporter = self.reporter(failure, FakeResponse(200, {"records": {}}))
+                key = reporter.enter(7, 2.0, "A", None, at=0)
+                with self.assertLogs(level="ERROR"):
+                    first = self.flush(reporter)
+                self.assertEqual(reporter.backlog, 1)
+                self.assertGreater(reporter._retry_at, 0)
+
+                self.assertEqual(self.flush(reporter), first)
+                self.assertEqual(first[0]["key"], key)
+                self.assertEqual(reporter.backlog, 0)
+                self.assertEqual(reporter._retry_at, 0)
+
+    def test_a_refused_batch_is_dropped(self):
+        reporter = self.reporter(FakeResponse(400, {"details": "bad"}))
+        reporter.enter(7, 2.0, "A", None, at=0)
+        with self.assertLogs(level="ERROR"):
+            self.flush(reporter)
+        self.assertEqual(reporter.backlog, 0)
+        self.assertIsNone(self.flush(reporter))
+
+    def test_heartbeats_collapse_to_the_latest_time(self):
+        reporter = self.reporter()
+        key = reporter.enter(7, 2.0, "A", None, at=0)
+        self.session.responses += [FakeResponse(200, {"records": {key: 42}}), FakeResponse(200, {"records": {}})]
+        self.flush(reporter)
+
+        with mock.patch("script.utc_timestamp", side_effect=["2026-10-18T10:00:01.000", "2026-10-18T10:00:02.000"]):
+            reporter.heartbeat(key)
+            reporter.heartbeat(key)
+        self.assertEqual(self.flush(reporter), [{"type": "heartbeat", "record": 42, "time": "2026-10-18T10:00:02.000"}])
+
+    def test_an_exit_goes_with_its_pending_enter(self):
+        reporter = self.reporter(FakeResponse(200, {"records": {}}))
+        key = reporter.enter(7, 2.0, "A", None, at=0)
+        reporter.leave(key, at=90)
+
+        batch = self.flush(reporter)
+        self.assertEqual([(event["type"], event["key"]) for event in batch], [("enter", key), ("exit", key)])
+        self.assertEqual(batch[1]["time"], "1970-01-01T00:01:30.000")
+
+    def test_an_exit_of_a_known_record_is_sent_by_id_and_forgets_it(self):
+        reporter = self.reporter()
+        key = reporter.enter(7, 2.0, "A", None, at=0)
+        self.session.responses += [FakeResponse(200, {"records": {key: 42}}), FakeResponse(200, {"records": {}})]
+        self.flush(reporter)
+        self.assertEqual(reporter._record_ids, {key: 42})
+
+        reporter.leave(key, at=90)
+        self.assertEqual(self.flush(reporter), [{"type": "exit", "record": 42, "time": "1970-01-01T00:01:30.000"}])
+        self.assertEqual(reporter._record_ids, {})
+
+
+class FakeModel:
+    """What a stream needs from an ``OccupationDetector``, without a model or an API."""
+    camera_id = "pipelined-test"
+    parking_spaces = []
+
+    class model:
+        names = {0: "car"}
+
+
+class PipelinedRTSPTests(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.video = Path(directory.name) / "parking.avi"
+        writer = cv2.VideoWriter(str(self.video), cv2.VideoWriter_fourcc(*"MJPG"), 10, (64, 48))
+        for i in range(10):
+            writer.write(np.full((48, 64, 3), i * 20, dtype=np.uint8))
+        writer.release()
+        # stands in for the ffmpeg encoder, throws the frames away
+        self.ffmpeg = Path(directory.name) / "ffmpeg"
+        self.ffmpeg.write_text("#!/bin/sh\nexec cat > /dev/null\n")
+        self.ffmpeg.chmod(0o755)
+
+    def samples(self, stage: str) -> float:
+        labels = {"camera": FakeModel.camera_id, "stage": stage}
+        return REGISTRY.get_sample_value("parking_stage_seconds_count", labels) or 0
+
+    def test_the_worker_processes_report_capture_and_encode_times(self):
+        before = {stage: self.samples(stage) for stage in ("capture", "encode")}
+        stream = PipelinedRTSP(str(self.video), "rtsp://out", FakeModel(), fps=10, ffmpeg_cmd=str(self.ffmpeg))
+        stream.stream()
+        self.addCleanup(stream.stop)
+
+        deadline = time.monotonic() + 30
+        while time.monotonic() < deadline and any(self.samples(stage) == before[stage] for stage in before):
+            if stream.latest_frame() is not None:
+                stream.skip_frame()
+            time.sleep(0.05)
+        for stage in before:
+            self.assertGreater(self.samples(stage), before[stage], stage)
+
+
+if __name__ == "__main__":
+    unittest.main()